@@ -1,21 +1,33 @@
 #!/usr/bin/env python3
 
+import time
+_start_time = time.perf_counter()
+
 import argparse
 import sys
 
 try:
-    from pycgtool.pycgtool import main, map_only
+    from pycgtool.pycgtool import main, map_only, warmup
     from pycgtool.interface import Options
     from pycgtool.functionalforms import FunctionalForms
+    from pycgtool.util import Timer
+    from pycgtool.kernels import set_backend
 except SyntaxError:
     raise RuntimeError("PyCGTOOL requires Python 3.2 or greater")
 
 if __name__ == "__main__":
+    if sys.argv[1:] == ["warmup"]:
+        # Compile numba kernels once, e.g. before submitting many short jobs
+        timer = Timer(_start_time)
+        print("Compiled {0} kernels in {1:.1f} s".format(warmup(), timer.lap("Warmup")))
+        sys.exit(0)
+
     parser = argparse.ArgumentParser(description="Perform coarse-grain mapping of atomistic trajectory")
     input_files = parser.add_argument_group("Input files")
     input_files.add_argument('-g', '--gro', type=str, required=True, help="GROMACS GRO file")
     input_files.add_argument('-m', '--map', type=str, help="Mapping file")
-    input_files.add_argument('-x', '--xtc', type=str, help="GROMACS XTC file")
+    input_files.add_argument('-x', '--xtc', type=str, nargs='+',
+                             help="GROMACS XTC file, or several files to read as one trajectory")
     input_files.add_argument('-b', '--bnd', type=str, help="Bonds file")
     input_files.add_argument('-i', '--itp', type=str, help="GROMACS ITP file")
 
@@ -24,6 +36,19 @@ if __name__ == "__main__":
     parser.add_argument('--quiet', default=False, action='store_true', help="Hide progress bars")
     input_files.add_argument('--begin', type=int, default=0, help="Frame number to begin")
     input_files.add_argument('--end', type=int, default=-1, help="Frame number to end")
+    input_files.add_argument('--stride', type=int, default=1, help="Use only every n-th frame")
+    input_files.add_argument('--begin-time', type=float, default=None, help="Time (ps) of first frame to use")
+    input_files.add_argument('--end-time', type=float, default=None, help="Time (ps) of last frame to use")
+    parser.add_argument('--prefetch', type=int, default=0, help="Number of frames to decode ahead on a background thread")
+    parser.add_argument('--timing', default=False, action='store_true', help="Report time taken by each stage of the run")
+    parser.add_argument('--jit-background', default=False, action='store_true',
+                        help="Compile numba kernels on a background thread while reading input - run "
+                             "'pycgtool.py warmup' once to store compiled kernels for later runs")
+    parser.add_argument('--backend', default="auto", choices=["auto", "numpy", "numba", "numba-parallel"],
+                        help="Numerical backend used to process frames - auto uses numba if it is installed")
+    parser.add_argument('--cache', nargs='?', const="selected", default=None, choices=["selected", "all"],
+                        help="Keep decoded trajectory frames in a cache next to the XTC for later runs, "
+                             "storing only the residues used or all atoms")
 
     advanced = parser.add_argument_group("Advanced configuration")
     advanced.add_argument("--output_name", help="Base name of output files", default="out", type=str, metavar="STRING")
@@ -33,6 +58,7 @@ if __name__ == "__main__":
     advanced.add_argument("--constr-threshold", help="Convert stiff bonds to constraints over", default=100000.0, type=float, metavar="FLOAT")
     advanced.add_argument("--dump-measurements", help="Whether to output bond measurements", default=None, metavar="BOOL")
     advanced.add_argument("--dump-n-values", help="How many measurements to output", default=10000, type=int, metavar="INT")
+    advanced.add_argument("--dump-float32", help="Store measurements in single precision", default=False, type=bool, metavar="BOOL")
     advanced.add_argument("--output-forcefield", help="Output a GROMACS forcefield directory?", default=False, type=bool, metavar="BOOL")
     advanced.add_argument("--temperature", help="Temperature of reference simulation", default=310.0, type=float, metavar="FLOAT")
     advanced.add_argument("--default-fc", help="Use default MARTINI force constants?", default=False, type=bool, metavar="BOOL")
@@ -51,6 +77,7 @@ if __name__ == "__main__":
         ("constr_threshold", args.constr_threshold),
         ("dump_measurements", args.dump_measurements or (args.dump_measurements is None and bool(args.bnd) and not bool(args.map))),
         ("dump_n_values", args.dump_n_values),
+        ("dump_float32", args.dump_float32),
         ("output_forcefield", args.output_forcefield),
         ("temperature", args.temperature),
         ("default_fc", args.default_fc),
@@ -71,9 +98,20 @@ if __name__ == "__main__":
             sys.exit(0)
     else:
         print("Using GRO: {0}".format(args.gro))
-        print("Using XTC: {0}".format(args.xtc))
+        print("Using XTC: {0}".format(" ".join(args.xtc) if args.xtc else None))
+
+    try:
+        set_backend(args.backend)
+    except ImportError as e:
+        parser.error(e)
+
+    timer = Timer(_start_time)
+    timer.lap("Startup")
 
     if config.map_only:
-        map_only(args, config)
+        map_only(args, config, timer=timer)
     else:
-        main(args, config)
+        main(args, config, timer=timer)
+
+    if args.timing:
+        print(timer.report())
@@ -10,17 +10,12 @@ import logging
 
 import numpy as np
 
-
-try:
-    from tqdm import tqdm
-except ImportError:
-    from .util import tqdm_dummy as tqdm
-
-from .util import sliding, dist_with_pbc, transpose_and_sample
+from .util import transpose_and_sample, RunningMoments, GrowableArray
 from .util import extend_graph_chain, backup_file
-from .util import vector_len, vector_cross, vector_angle, vector_angle_signed
+from .util import dist_with_pbc_many, vector_len_many, vector_cross_many, vector_angle_many, vector_angle_signed_many
 from .parsers.cfg import CFG
 from .functionalforms import FunctionalForms
+from .kernels import register, get_kernel
 
 logger = logging.getLogger(__name__)
 
@@ -30,24 +25,33 @@ class Bond:
     Class holding the properties of a single bonded term.
 
     Bond lengths, angles and dihedrals are all equivalent, distinguished by the number of atoms present.
+
+    Measured values are accumulated into running moments.  The values themselves are only stored if
+    requested, or if the functional form cannot be inverted from moments.
     """
-    __slots__ = ["atoms", "atom_numbers", "values", "eqm", "fconst", "gromacs_type_id", "_func_form"]
+    __slots__ = ["atoms", "atom_numbers", "values", "moments", "eqm", "fconst", "gromacs_type_id",
+                 "_func_form", "_keep_values"]
 
-    def __init__(self, atoms, atom_numbers=None, func_form=None):
+    def __init__(self, atoms, atom_numbers=None, func_form=None, keep_values=True, values_dtype=np.float64):
         """
         Create a single bond definition.
 
         :param List[str] atoms: List of atom names defining the bond
         :param List[int] atom_numbers: List of atom numbers defining the bond
         :param func_form: Functional form to use for Boltzmann Inversion
+        :param bool keep_values: Store all measured values, required to dump measurements
+        :param values_dtype: Numpy dtype used to store measured values, float32 halves memory use
         """
         self.atoms = atoms
         self.atom_numbers = atom_numbers
-        self.values = []
+        self.values = GrowableArray(dtype=values_dtype)
+        # Dihedrals are periodic so their moments must be taken on the circle
+        self.moments = RunningMoments(periodic=(len(atoms) == 4))
         self.eqm = None
         self.fconst = None
 
         self._func_form = func_form
+        self._keep_values = keep_values or not func_form.uses_moments
         self.gromacs_type_id = func_form.gromacs_type_id_by_natoms(len(atoms))
 
     def __len__(self):
@@ -56,22 +60,37 @@ class Bond:
     def __iter__(self):
         return iter(self.atoms)
 
+    def add_values(self, vals):
+        """
+        Add a batch of measured values to this bond.
+
+        :param vals: Array of measured values
+        """
+        self.moments.update(vals)
+        if self._keep_values:
+            self.values.extend(vals)
+
     def boltzmann_invert(self, temp=310):
         """
         Perform Boltzmann Inversion using measured values of bond to calculate equilibrium value and force constant.
 
         :param temp: Temperature at which the simulation was performed
         """
-        if not self.values:
+        if not self.moments.count:
             raise ValueError("No bonds were measured between atoms {0}".format(self.atoms))
 
-        values = np.array(self.values)
+        if self._func_form.uses_moments:
+            eqm_func, fconst_func = self._func_form.eqm_from_moments, self._func_form.fconst_from_moments
+            data = self.moments
+        else:
+            eqm_func, fconst_func = self._func_form.eqm, self._func_form.fconst
+            data = np.array(self.values)
 
         with np.errstate(divide="raise"):
-            self.eqm = self._func_form.eqm(values, temp)
+            self.eqm = eqm_func(data, temp)
             try:
-                self.fconst = self._func_form.fconst(values, temp)
-            except FloatingPointError:
+                self.fconst = fconst_func(data, temp)
+            except (FloatingPointError, ZeroDivisionError):
                 # Happens when variance is 0, i.e. we only have one value
                 self.fconst = float("inf")
 
@@ -99,6 +118,11 @@ class BondSet:
         """
         self._molecules = {}
 
+        # Atom index tables used to measure a whole frame at once - created by BondSet._compile
+        self._compiled_frame = None
+        self._bond_tables = None
+        self._bond_rows = None
+
         self._fconst_constr_threshold = options.constr_threshold
 
         try:
@@ -111,6 +135,17 @@ class BondSet:
         except AttributeError:
             self._default_fc = False
 
+        # Storing every measured value is only required if they are to be dumped
+        try:
+            self._keep_values = options.dump_measurements
+        except AttributeError:
+            self._keep_values = True
+
+        try:
+            self._values_dtype = np.float32 if options.dump_float32 else np.float64
+        except AttributeError:
+            self._values_dtype = np.float64
+
         # Setup default functional forms
         functional_forms = FunctionalForms()
         if self._default_fc:
@@ -152,7 +187,9 @@ class BondSet:
                     if {x for x in atomlist if atomlist.count(x) > 1}:
                         raise ValueError("Defined bond '{0}' contains duplicate atoms".format(atomlist))
 
-                    mol_bonds.append(Bond(atoms=atomlist, func_form=func_form))
+                    mol_bonds.append(Bond(atoms=atomlist, func_form=func_form,
+                                          keep_values=self._keep_values,
+                                          values_dtype=self._values_dtype))
                     if len(atomlist) > 2:
                         angles_defined = True
 
@@ -161,11 +198,15 @@ class BondSet:
 
                     if options.generate_angles:
                         for atomlist in angles:
-                            mol_bonds.append(Bond(atoms=atomlist, func_form=self._functional_forms[3]))
+                            mol_bonds.append(Bond(atoms=atomlist, func_form=self._functional_forms[3],
+                                                   keep_values=self._keep_values,
+                                                   values_dtype=self._values_dtype))
 
                     if options.generate_dihedrals:
                         for atomlist in dihedrals:
-                            mol_bonds.append(Bond(atoms=atomlist, func_form=self._functional_forms[4]))
+                            mol_bonds.append(Bond(atoms=atomlist, func_form=self._functional_forms[4],
+                                                   keep_values=self._keep_values,
+                                                   values_dtype=self._values_dtype))
 
     @staticmethod
     def _create_angles(mol_bonds):
@@ -317,58 +358,88 @@ class BondSet:
                 write_bond_angle_dih(self.get_bond_dihedrals(mol), "dihedrals", itp, multiplicity=1, rad2deg=True)
                 write_bond_angle_dih(self.get_bond_length_constraints(mol), "constraints", itp, print_fconst=False)
 
-    def apply(self, frame):
+    def _compile(self, frame):
         """
-        Calculate bond lengths/angles for a given Frame and store into Bonds.
+        Resolve all bond definitions to atom indices within a Frame.
 
-        :param frame: Frame from which to calculate values
+        Inter-residue links using '+' or '-' are resolved against the next or previous residue.
+        If Residues were removed from the Frame by selection, only residues adjacent in the topology are linked.
+        Bonds which cannot be resolved, such as links from residues at the end of a chain, are skipped.
+        Rows in each index table are grouped by Bond so that values can be stored as contiguous slices.
+
+        :param frame: Frame for which to create index tables
         """
-        def calc_length(atoms):
-            vec = dist_with_pbc(atoms[0].coords, atoms[1].coords, frame.box)
-            return vector_len(vec)
+        residues = frame.residues
+        offsets = frame.residue_starts.tolist()
+        origins = frame.residue_origins
+
+        def atom_index(res_num, name):
+            step = 0
+            if name[0] == "+":
+                step = 1
+            elif name[0] == "-":
+                step = -1
+            linked = res_num + step
+            if not 0 <= linked < len(residues):
+                return None
+            # Residues removed by selection must not be bridged by a link
+            if step and origins is not None and origins[linked] - origins[res_num] != step:
+                return None
+            res_num = linked
+            try:
+                return offsets[res_num] + residues[res_num].name_to_num[name.lstrip("-+")]
+            except KeyError:
+                return None
 
-        def calc_angle(atoms):
-            veca = dist_with_pbc(atoms[0].coords, atoms[1].coords, frame.box)
-            vecb = dist_with_pbc(atoms[1].coords, atoms[2].coords, frame.box)
-            return math.pi - vector_angle(veca, vecb)
+        tables = {2: [], 3: [], 4: []}
+        self._bond_rows = []
 
-        def calc_dihedral(atoms):
-            veca = dist_with_pbc(atoms[0].coords, atoms[1].coords, frame.box)
-            vecb = dist_with_pbc(atoms[1].coords, atoms[2].coords, frame.box)
-            vecc = dist_with_pbc(atoms[2].coords, atoms[3].coords, frame.box)
+        for mol_name, mol_bonds in self._molecules.items():
+            mol_residues = frame.residue_positions((mol_name,)).tolist()
 
-            c1 = vector_cross(veca, vecb)
-            c2 = vector_cross(vecb, vecc)
+            for bond in mol_bonds:
+                table = tables[len(bond)]
+                start = len(table)
+                for res_num in mol_residues:
+                    indices = [atom_index(res_num, name) for name in bond.atoms]
+                    if None not in indices:
+                        table.append(indices)
+                self._bond_rows.append((bond, start, len(table)))
 
-            return vector_angle_signed(c1, c2, vecb)
+        self._bond_tables = {natoms: np.array(table, dtype=np.intp).reshape(-1, natoms)
+                             for natoms, table in tables.items()}
+        self._compiled_frame = frame
 
-        calc = {2: calc_length,
-                3: calc_angle,
-                4: calc_dihedral}
+    def apply(self, frame):
+        """
+        Calculate bond lengths/angles for a given Frame and store into Bonds.
 
-        for prev_res, res, next_res in sliding(frame):
-            try:
-                mol_meas = self._molecules[res.name]
-            except KeyError:
-                # Bonds have not been specified for molecule - probably water - ignore this residue
-                continue
+        :param frame: Frame from which to calculate values
+        """
+        if frame is not self._compiled_frame:
+            self._compile(frame)
 
-            adj_res = {"-": prev_res,
-                       "+": next_res}
+        calc = {2: get_kernel("bond_lengths"),
+                3: get_kernel("bond_angles"),
+                4: get_kernel("bond_dihedrals")}
 
-            for bond in mol_meas:
+        values = {}
+        for natoms, table in self._bond_tables.items():
+            if len(table):
                 try:
-                    # TODO tidy this
-                    atoms = [adj_res.get(name[0], res)[name.lstrip("-+")] for name in bond.atoms]
-                    val = calc[len(atoms)](atoms)
-                    bond.values.append(val)
-                except (NotImplementedError, TypeError):
-                    # TypeError is raised when residues on end of chain calc bond to next
-                    pass
+                    values[natoms] = calc[natoms](frame.coords, table, frame.box)
                 except ZeroDivisionError as e:
-                    e.args = ("Zero division in calculation of <{0}>".format(" ".join(bond.atoms)),)
+                    # Find which bond caused the problem to report it
+                    row = e.args[1]
+                    for bond, start, stop in self._bond_rows:
+                        if len(bond) == natoms and start <= row < stop:
+                            e.args = ("Zero division in calculation of <{0}>".format(" ".join(bond.atoms)),)
                     raise e
 
+        for bond, start, stop in self._bond_rows:
+            if stop > start:
+                bond.add_values(values[len(bond)][start:stop])
+
     def boltzmann_invert(self, progress=False):
         """
         Perform Boltzmann Inversion of all bonds to calculate equilibrium value and force constant.
@@ -378,6 +449,10 @@ class BondSet:
         bond_iter = itertools.chain(*self._molecules.values())
         bond_iter_wrap = bond_iter
         if progress:
+            try:
+                from tqdm import tqdm
+            except ImportError:
+                from .util import tqdm_dummy as tqdm
             total = sum(map(len, self._molecules.values()))
             bond_iter_wrap = tqdm(bond_iter, total=total, ncols=80)
 
@@ -417,6 +492,14 @@ class BondSet:
             if bonds:
                 write_bonds_to_file(bonds, "{0}_dihedral.dat".format(mol), rad2deg=True)
 
+    @property
+    def links_residues(self):
+        """
+        True if any bond links atoms in neighbouring residues using '+' or '-'
+        """
+        return any(name[0] in "+-" for mol_bonds in self._molecules.values()
+                   for bond in mol_bonds for name in bond.atoms)
+
     def __len__(self):
         return len(self._molecules)
 
@@ -428,3 +511,59 @@ class BondSet:
 
     def __iter__(self):
         return iter(self._molecules)
+
+
+def _bond_vectors(coords, table, box):
+    """
+    Calculate vectors between consecutive atoms in each row of a bond index table.
+
+    :param coords: Array of coordinates of all atoms in the Frame
+    :param table: Array of atom indices, one row per measurement
+    :param box: PBC box vectors, periodicity is ignored if any are zero
+    :return: Array of shape (nrows, natoms - 1, 3) of minimum image vectors
+    """
+    return dist_with_pbc_many(coords[table[:, :-1]], coords[table[:, 1:]], box)
+
+
+@register("bond_lengths", "numpy")
+def calc_lengths(coords, table, box):
+    """
+    Calculate bond lengths for each row of a two atom index table.
+
+    :param coords: Array of coordinates of all atoms in the Frame
+    :param table: Array of atom indices of shape (nbonds, 2)
+    :param box: PBC box vectors
+    :return: Array of bond lengths
+    """
+    vectors = _bond_vectors(coords, table, box)[:, 0]
+    return vector_len_many(vectors, dtype=np.float64)
+
+
+@register("bond_angles", "numpy")
+def calc_angles(coords, table, box):
+    """
+    Calculate bond angles for each row of a three atom index table.
+
+    :param coords: Array of coordinates of all atoms in the Frame
+    :param table: Array of atom indices of shape (nangles, 3)
+    :param box: PBC box vectors
+    :return: Array of angles in radians
+    """
+    vectors = _bond_vectors(coords, table, box)
+    return math.pi - vector_angle_many(vectors[:, 0], vectors[:, 1])
+
+
+@register("bond_dihedrals", "numpy")
+def calc_dihedrals(coords, table, box):
+    """
+    Calculate signed dihedral angles for each row of a four atom index table.
+
+    :param coords: Array of coordinates of all atoms in the Frame
+    :param table: Array of atom indices of shape (ndihedrals, 4)
+    :param box: PBC box vectors
+    :return: Array of dihedral angles in radians
+    """
+    vectors = _bond_vectors(coords, table, box)
+    c1 = vector_cross_many(vectors[:, 0], vectors[:, 1])
+    c2 = vector_cross_many(vectors[:, 1], vectors[:, 2])
+    return vector_angle_signed_many(c1, c2, ref=vectors[:, 1])
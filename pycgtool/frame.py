@@ -3,13 +3,18 @@ This module contains classes for storing atomic data.
 
 The Frame class may contain multiple Residues which may each contain multiple Atoms.
 Both Frame and Residue are iterable. Residue is indexable with either atom numbers or names.
+
+Coordinates are stored in a single contiguous array owned by the Frame.
+Atom and Residue coordinates are views into this array.
+
+Residues of the same type share a single ResidueTemplate holding their Atoms, so that large systems
+do not hold a separate set of Atoms for every residue.
 """
 
 import logging
 
 import numpy as np
 
-from .util import backup_file
 from .parsers.cfg import CFG
 
 logger = logging.getLogger(__name__)
@@ -66,35 +71,186 @@ class Atom:
                 setattr(self, attr, getattr(other, attr))
 
 
+class AtomView(Atom):
+    """
+    Read-only Atom of a Residue created from a ResidueTemplate
+
+    Data is taken from the template Atom and coordinates from the Residue.  Since the template is shared
+    by all Residues of the type, assigning to an attribute raises AttributeError rather than being lost.
+    Coordinates may still be modified in place.
+    """
+    __slots__ = ["_atom", "_residue", "_index"]
+
+    def __init__(self, residue, index):
+        """
+        Create a view of an Atom in a Residue.
+
+        :param Residue residue: Residue containing the Atom
+        :param int index: Index of the Atom within the Residue
+        """
+        self._residue = residue
+        self._index = index
+        self._atom = residue.template.atoms[index]
+
+    def _read_only(attr):
+        def getter(self):
+            return getattr(self._atom, attr)
+
+        def setter(self, value):
+            raise AttributeError("Cannot set {0} of atom {1} in residue {2} - it is shared through a "
+                                 "ResidueTemplate".format(attr, self._atom.name, self._residue.name))
+
+        return property(getter, setter)
+
+    name = _read_only("name")
+    num = _read_only("num")
+    type = _read_only("type")
+    mass = _read_only("mass")
+    charge = _read_only("charge")
+    del _read_only
+
+    @property
+    def coords(self):
+        coords = self._residue.coords
+        return None if coords is None else coords[self._index]
+
+    @coords.setter
+    def coords(self, coords):
+        raise AttributeError("Cannot set coords of atom {0} in residue {1} - assign to the residue's "
+                             "coordinates instead".format(self._atom.name, self._residue.name))
+
+
+class ResidueTemplate:
+    """
+    Hold the atoms shared by all Residues of a single type
+
+    Residues of the same type refer to a single template rather than each holding their own Atoms.
+    Template Atoms have no coordinates.
+    """
+    __slots__ = ["name", "atoms", "atom_names", "name_to_num"]
+
+    def __init__(self, name, atoms):
+        """
+        Create a residue template.
+
+        :param str name: The name of the residue type
+        :param atoms: Iterable of Atoms in this residue type, in order
+        """
+        self.name = name
+        self.atoms = list(atoms)
+        self.atom_names = tuple(atom.name for atom in self.atoms)
+        self.name_to_num = {name: i for i, name in enumerate(self.atom_names)}
+
+    def __len__(self):
+        return len(self.atoms)
+
+
 class Residue:
     """
     Hold data for a residue - list of atoms
+
+    A Residue created from a ResidueTemplate does not store its own Atoms; they are created on demand
+    as read-only AtomViews of the template with coordinates taken from the Residue.  Adding an Atom to
+    such a Residue detaches it from the template, giving it a copy of each Atom.
     """
-    __slots__ = ["name", "num", "atoms", "name_to_num"]
+    __slots__ = ["name", "num", "template", "_atoms", "_name_to_num", "_coords", "_frame_coords", "_start"]
 
-    def __init__(self, name=None, num=None):
-        self.atoms = []
-        self.name = name
+    def __init__(self, name=None, num=None, template=None):
+        """
+        Create a residue.
+
+        :param str name: The name of the residue, taken from the template if not provided
+        :param int num: The residue number
+        :param ResidueTemplate template: Template holding the Atoms of this residue type
+        """
+        self.name = name if name is not None or template is None else template.name
         self.num = num
-        self.name_to_num = {}
+        self.template = template
+        self._atoms = None if template is not None else []
+        self._name_to_num = None if template is not None else {}
+        self._coords = None
+        self._frame_coords = None
+        self._start = 0
 
     def __iter__(self):
         return iter(self.atoms)
 
     def __getitem__(self, item):
         try:
-            return self.atoms[self.name_to_num[item]]
+            item = self.name_to_num[item]
         except KeyError:
             pass
 
         try:
-            return self.atoms[item]
+            if self.template is None:
+                return self._atoms[item]
+            return AtomView(self, item)
         except TypeError as e:
             e.args = ("Atom {0} does not exist in residue {1}".format(item, self.name),)
             raise
 
     def __len__(self):
-        return len(self.atoms)
+        if self.template is not None:
+            return len(self.template.atoms)
+        return len(self._atoms)
+
+    @property
+    def atoms(self):
+        """
+        List of Atoms in this Residue - if created from a template, these are read-only AtomViews
+        """
+        if self.template is None:
+            return self._atoms
+        return [AtomView(self, i) for i in range(len(self.template.atoms))]
+
+    @atoms.setter
+    def atoms(self, atoms):
+        self.template = None
+        self._atoms = list(atoms)
+        self._name_to_num = {atom.name: i for i, atom in enumerate(self._atoms)}
+
+    @property
+    def atom_names(self):
+        """
+        Tuple of the names of the Atoms in this Residue
+        """
+        if self.template is not None:
+            return self.template.atom_names
+        return tuple(atom.name for atom in self._atoms)
+
+    @property
+    def name_to_num(self):
+        """
+        Dictionary of atom names to their index within this Residue
+        """
+        if self.template is not None:
+            return self.template.name_to_num
+        return self._name_to_num
+
+    @property
+    def coords(self):
+        """
+        Coordinates of the Atoms in this Residue - after packing, a view into the Frame's coordinate array
+        """
+        if self._frame_coords is not None:
+            return self._frame_coords[self._start:self._start + len(self)]
+        return self._coords
+
+    @coords.setter
+    def coords(self, coords):
+        self._coords = coords
+        self._frame_coords = None
+
+    def _set_frame_coords(self, frame_coords, start):
+        """
+        Refer to a block of a Frame's coordinate array without creating a view.
+
+        :param frame_coords: Coordinate array of the Frame
+        :param int start: Index of this Residue's first Atom in the array
+        """
+        self._coords = None
+        self._frame_coords = frame_coords
+        self._start = start
 
     def add_atom(self, atom):
         """
@@ -103,21 +259,38 @@ class Residue:
         :param atom: Atom to add to Residue
         :return: None
         """
-        self.atoms.append(atom)
-        self.name_to_num[atom.name] = len(self.atoms) - 1
+        if self.template is not None:
+            coords = self.coords
+            self.atoms = [Atom(atom.name, atom.num, type=atom.type, mass=atom.mass, charge=atom.charge,
+                               coords=None if coords is None else coords[i])
+                          for i, atom in enumerate(self.template.atoms)]
+        self._atoms.append(atom)
+        self._name_to_num[atom.name] = len(self._atoms) - 1
 
 
 class Frame:
     """
     Hold Atom data separated into Residues
     """
-    def __init__(self, gro=None, xtc=None, itp=None, frame_start=0, xtc_reader="simpletraj"):
+    def __init__(self, gro=None, xtc=None, itp=None, frame_start=0, xtc_reader=None, prefetch=0,
+                 frame_end=None, stride=1, time_start=None, time_end=None, selection=None, cache=None):
         """
         Return Frame instance having read Residues and Atoms from GRO if provided
 
         :param gro: GROMACS GRO file to read initial frame and extract residues
-        :param xtc: GROMACS XTC file to read subsequent frames
+        :param xtc: GROMACS XTC file to read subsequent frames, or list of files to read in sequence
         :param itp: GROMACS ITP file to read masses and charges
+        :param frame_start: Number of first XTC frame to read
+        :param xtc_reader: Name of trajectory reader to use, None to select one automatically, or "fastest" to
+            select the fastest by opening the files with each reader
+        :param prefetch: Number of XTC frames to decode ahead on a background thread, 0 to disable
+        :param frame_end: Number of XTC frame at which to stop, exclusive, None to read all frames
+        :param stride: Read only every stride-th XTC frame
+        :param time_start: Skip XTC frames before this time
+        :param time_end: Skip XTC frames after this time
+        :param selection: Collection of residue names to read, None to read all residues
+        :param cache: Keep decoded XTC frames in a memory-mapped cache for later runs - "selected" to store only
+            the atoms read, "all" to store all atoms, None to disable.  Call close to write the cache to disk
         :return: Frame instance
         """
         self.name = ""
@@ -125,21 +298,41 @@ class Frame:
         self.number = frame_start - 1
         self.time = 0
         self.numframes = 0
+        self.numframes_selected = 0
         self.natoms = 0
         self.box = np.zeros(3, dtype=np.float32)
-
-        self._xtc_buffer = None
+        # Also records the Residues for which coordinates are packed - see Frame.coords
+        self.coords = np.zeros((0, 3), dtype=np.float32)
+
+        self._xtc_writer = None
+        # Residue templates keyed by residue name and atom names
+        self._templates = {}
+        # Positions of residues by name and first atom of each residue - created by Frame._index_residues
+        self._resname_index = None
+        self._residue_starts = None
+        self._indexed = None
+        # Position of each Residue among all Residues in the topology, None if none were removed by selection
+        self.residue_origins = None
 
         if gro is not None:
-            from .framereader import get_frame_reader
-            self._trajreader = get_frame_reader(gro, traj=xtc, frame_start=frame_start)
-
-            self._trajreader.initialise_frame(self)
-
-            if self._trajreader.num_atoms != self.natoms:
-                raise AssertionError("Number of atoms does not match between gro and xtc files.")
+            from .framereader import get_frame_reader, FrameReaderPrefetch, FrameReaderCached
+            self._trajreader = get_frame_reader(gro, traj=xtc, frame_start=frame_start, name=xtc_reader)
+            if cache and xtc is not None:
+                self._trajreader = FrameReaderCached(self._trajreader, atoms=cache)
+            if prefetch and xtc is not None:
+                self._trajreader = FrameReaderPrefetch(self._trajreader, depth=prefetch)
+
+            self._trajreader.initialise_frame(self, selection)
             self.numframes += self._trajreader.num_frames
 
+            if time_start is not None:
+                frame_start = max(frame_start, self._trajreader.frame_number_at_time(time_start))
+            if time_end is not None:
+                end = self._trajreader.frame_number_at_time(time_end, after=True)
+                frame_end = end if frame_end is None else min(frame_end, end)
+            self._trajreader.set_window(frame_start, frame_end, stride)
+            self.numframes_selected = self._trajreader.num_frames_in_window()
+
             if itp is not None:
                 self._parse_itp(itp)
 
@@ -174,10 +367,131 @@ class Frame:
         rep += "\n".join(atoms)
         return rep
 
+    @property
+    def coords(self):
+        """
+        Contiguous (natoms, 3) array of the coordinates of all Atoms - packed again if Residues have been added
+        """
+        if self._packed != (id(self.residues), len(self.residues)):
+            self.pack_coords()
+        return self._coords
+
+    @coords.setter
+    def coords(self, coords):
+        self._coords = coords
+        self._packed = (id(self.residues), len(self.residues))
+
+    def pack_coords(self):
+        """
+        Move Atom coordinates into a single contiguous (natoms, 3) array owned by this Frame.
+
+        Atom and Residue coordinates become views into this array, so it may be refilled in place.
+        If a Residue already has an array of coordinates for all its atoms, these are used instead of the Atoms'.
+        Residues created from a template refer to their block of the array without creating any views.
+        This is done automatically when coords is used after Residues have been added to the Frame, but must
+        be called explicitly if Atoms are added to a Residue already in the Frame.
+        """
+        coords = np.zeros((sum(map(len, self.residues)), 3), dtype=np.float32)
+
+        start = 0
+        for res in self.residues:
+            stop = start + len(res)
+            block = coords[start:stop]
+            res_coords = res.coords
+            if res_coords is not None and len(res_coords) == len(block):
+                block[:] = res_coords
+                if res.template is None:
+                    for atom, atom_coords in zip(res.atoms, block):
+                        atom.coords = atom_coords
+            elif res.template is None:
+                for atom, atom_coords in zip(res.atoms, block):
+                    if atom.coords is not None:
+                        atom_coords[:] = atom.coords
+                    atom.coords = atom_coords
+            res._set_frame_coords(coords, start)
+            start = stop
+
+        self._coords = coords
+        self._packed = (id(self.residues), len(self.residues))
+        self._indexed = None
+        self._index_residues()
+
+    def residue_template(self, name, atom_names):
+        """
+        Return the shared ResidueTemplate for a residue type, creating it if necessary.
+
+        :param str name: Name of the residue type
+        :param atom_names: Names of the atoms in the residue, in order
+        :return: ResidueTemplate instance
+        """
+        atom_names = tuple(atom_names)
+        key = (name, atom_names)
+        try:
+            return self._templates[key]
+        except KeyError:
+            template = ResidueTemplate(name, (Atom(name=atom_name, num=i) for i, atom_name in enumerate(atom_names)))
+            self._templates[key] = template
+            return template
+
+    def _index_residues(self):
+        """
+        Index the positions of Residues by name and record the position of each Residue's first atom.
+
+        The index is rebuilt if Residues have since been added to the Frame.
+        """
+        if self._indexed == (id(self.residues), len(self.residues)):
+            return
+
+        positions = {}
+        for i, res in enumerate(self.residues):
+            positions.setdefault(res.name, []).append(i)
+        self._resname_index = {name: np.array(pos, dtype=np.intp) for name, pos in positions.items()}
+
+        lengths = np.fromiter(map(len, self.residues), dtype=np.intp, count=len(self.residues))
+        self._residue_starts = np.zeros(len(lengths), dtype=np.intp)
+        self._residue_starts[1:] = np.cumsum(lengths)[:-1]
+        self._indexed = (id(self.residues), len(self.residues))
+
+    @property
+    def resname_index(self):
+        """
+        Dictionary of residue names to arrays of the positions of Residues with that name in this Frame
+        """
+        self._index_residues()
+        return self._resname_index
+
+    @property
+    def residue_starts(self):
+        """
+        Array of the index of the first atom of each Residue in this Frame's coordinate array
+        """
+        if self._packed != (id(self.residues), len(self.residues)):
+            self.pack_coords()
+        self._index_residues()
+        return self._residue_starts
+
+    def residue_positions(self, names):
+        """
+        Return the positions of all Residues with a name in a collection, in the order they occur in the Frame.
+
+        :param names: Collection of residue names
+        :return: Numpy array of residue positions
+        """
+        index = self.resname_index
+        positions = [index[name] for name in names if name in index]
+        if not positions:
+            return np.zeros(0, dtype=np.intp)
+        return np.sort(np.concatenate(positions))
+
     def yield_resname_in(self, container):
-        for res in self:
-            if res.name in container:
-                yield res
+        """
+        Yield Residues with a name in a collection, in the order they occur in the Frame.
+
+        :param container: Collection of residue names
+        """
+        residues = self.residues
+        for i in self.residue_positions(container).tolist():
+            yield residues[i]
 
     def next_frame(self):
         """
@@ -185,45 +499,41 @@ class Frame:
 
         :return: True if successful else False
         """
-        result = self._trajreader.read_next(self)
-        if result:
-            self.number += 1
-        return result
+        return self._trajreader.read_next(self)
 
     def write_xtc(self, filename):
         """
         Write frame to output XTC file.
 
+        Frames are written in blocks on a background thread, so the file may be incomplete until close_xtc
+        is called after the last frame.  Any remaining frames are also written when the Frame is garbage
+        collected or the interpreter exits.
+
         :param filename: XTC filename to write to
         """
-        if self._xtc_buffer is None:
-            try:
-                import mdtraj
-            except ImportError as e:
-                if "scipy" in repr(e):
-                    e.msg = "XTC output with MDTraj also requires Scipy"
-                else:
-                    e.msg = "XTC output requires the module MDTraj (and probably Scipy)"
-                raise
-
-            backup_file(filename)
-            self._xtc_buffer = mdtraj.formats.XTCTrajectoryFile(filename, mode="w")
+        if self._xtc_writer is None:
+            from .framewriter import FrameWriterXTC
+            self._xtc_writer = FrameWriterXTC(filename, len(self.coords))
+        self._xtc_writer.write(self)
 
-        xyz = np.ndarray((1, self.natoms, 3), dtype=np.float32)
-        i = 0
-        for residue in self.residues:
-            for atom in residue.atoms:
-                xyz[0][i] = atom.coords
-                i += 1
-
-        time = np.array([self.time], dtype=np.float32)
-        step = np.array([self.number], dtype=np.int32)
+    def close_xtc(self):
+        """
+        Finish writing the output XTC file, if one is open.
 
-        box = np.zeros((1, 3, 3), dtype=np.float32)
-        for i in range(3):
-            box[0][i][i] = self.box[i]
+        Writes any frames still buffered by write_xtc and closes the file.  Calling write_xtc again afterwards
+        starts a new file.
+        """
+        if self._xtc_writer is not None:
+            self._xtc_writer.close()
+            self._xtc_writer = None
 
-        self._xtc_buffer.write(xyz, time=time, step=step, box=box)
+    def close(self):
+        """
+        Close the trajectory reader, writing any frames held in a frame cache to disk.
+        """
+        reader = getattr(self, "_trajreader", None)
+        if reader is not None:
+            reader.close()
 
     def _parse_itp(self, filename):
         """
@@ -239,10 +549,18 @@ class Frame:
                 atom = Atom(num=int(line[0]) - 1, type=line[1], name=line[4], charge=float(line[6]), mass=float(line[7]))
                 itpres.add_atom(atom)
 
-            for res in self.residues:
-                if res.name == itpres.name:
-                    for atom, itpatom in zip(res, itpres):
-                        atom.add_missing_data(itpatom)
+            templates = set()
+            for res in self.yield_resname_in((itpres.name,)):
+                if res.template is not None:
+                    # Update each shared template only once
+                    if res.template not in templates:
+                        templates.add(res.template)
+                        for atom, itpatom in zip(res.template.atoms, itpres):
+                            atom.add_missing_data(itpatom)
+                    continue
+
+                for atom, itpatom in zip(res, itpres):
+                    atom.add_missing_data(itpatom)
 
     def output(self, filename, format="gro"):
         """
@@ -272,20 +590,9 @@ class Frame:
 
         :param filename: Name of GRO file to create
         """
-        backup_file(filename)
-
-        with open(filename, "w") as gro:
-            print(self.name, file=gro)
-            print("{0:5d}".format(self.natoms), file=gro)
-            i = 1
-            format_string = "{0:5d}{1:5s}{2:>5s}{3:5d}{4:8.3f}{5:8.3f}{6:8.3f}"
-            for res in self.residues:
-                for atom in res:
-                    print(format_string.format(res.num, res.name,
-                                               atom.name, i,
-                                               *atom.coords), file=gro)
-                    i += 1
-            print("{0:10.5f}{1:10.5f}{2:10.5f}".format(*self.box), file=gro)
+        from .framewriter import FrameWriterGRO
+        with FrameWriterGRO(filename) as gro:
+            gro.write(self)
 
     def add_residue(self, residue):
         """
@@ -7,72 +7,429 @@ This module is tightly coupled with the frame.py module, so shares a set of unit
 
 import os
 import abc
-import itertools
+import bisect
+import time
+import struct
 import logging
 import collections
+import functools
+import hashlib
+import importlib.util
+import queue
+import threading
+import zipfile
 
 import numpy as np
 
-from .frame import Atom, Residue
-from .util import FixedFormatUnpacker
+from .frame import Frame, Residue
+from .parsers.gro import GRO
 
 logger = logging.getLogger(__name__)
 
 
+# Trajectory formats for which a persistent index of frame offsets is kept
+_offset_index_extensions = (".xtc", ".trr")
+
+
 class UnsupportedFormatException(Exception):
     pass
 
 
-def get_frame_reader(top, traj=None, frame_start=0, name=None):
-    readers = collections.OrderedDict([
+def frame_offsets_filename(trajname):
+    """
+    Return the name of the frame offset index file for a trajectory.
+
+    :param trajname: Trajectory file
+    :return: Name of hidden index file in the same directory as the trajectory
+    """
+    head, tail = os.path.split(trajname)
+    return os.path.join(head, ".{0}.pycgtool_offsets.npz".format(tail))
+
+
+def load_frame_offsets(trajname, calculate):
+    """
+    Return the byte offsets of frames in a trajectory, using a persistent index file where possible.
+
+    The index is rebuilt if the size or modification time of the trajectory change.
+    If the index cannot be written the offsets are still returned.
+
+    :param trajname: Trajectory file
+    :param calculate: Function returning frame offsets by scanning the trajectory, used if there is no valid index
+    :return: Numpy array of frame offsets in bytes
+    """
+    stat = os.stat(trajname)
+    key = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    indexname = frame_offsets_filename(trajname)
+
+    try:
+        with np.load(indexname) as index:
+            if np.array_equal(index["key"], key):
+                return index["offsets"]
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        pass
+
+    offsets = np.asarray(calculate(), dtype=np.int64)
+
+    # Write to a temporary file then rename, so that concurrent readers never see a partial index
+    tmpname = "{0}.{1}.tmp".format(indexname, os.getpid())
+    try:
+        with open(tmpname, "wb") as index:
+            np.savez(index, key=key, offsets=offsets)
+        os.replace(tmpname, indexname)
+    except OSError as e:
+        logger.warning("Could not write frame offset index '{0}': {1}".format(indexname, e))
+        try:
+            os.remove(tmpname)
+        except OSError:
+            pass
+
+    return offsets
+
+
+# Reader chosen for each (topology, trajectory) pair of input files
+_reader_choice_cache = {}
+# Fastest reader for each (topology, trajectory) pair of file extensions, found by _measure_throughput
+_reader_throughput_cache = {}
+
+# Magic numbers at the start of GROMACS XDR trajectory frames
+_xdr_magic = {".xtc": 1995, ".trr": 1993}
+
+
+def _frame_readers():
+    return collections.OrderedDict([
         ("simpletraj", FrameReaderSimpleTraj),
         ("mdtraj", FrameReaderMDTraj),
         ("mdanalysis", FrameReaderMDAnalysis),
     ])
 
+
+def get_frame_reader(top, traj=None, frame_start=0, name=None):
+    """
+    Open a topology and trajectory using the named reader, or select a suitable reader.
+
+    :param top: MD topology file
+    :param traj: MD trajectory file, or list of files to read in sequence
+    :param frame_start: Frame number to start on, default 0
+    :param name: Name of reader to use, None to select a reader using select_frame_reader, or "fastest" to
+        select the fastest by opening the files with each reader
+    :return: FrameReader instance
+    """
+    if isinstance(traj, (list, tuple)):
+        if len(traj) > 1:
+            return FrameReaderConcat(top, traj, frame_start, name)
+        traj = traj[0] if traj else None
+
+    if name is None or name == "fastest":
+        name = select_frame_reader(top, traj, probe=name == "fastest")
+
     try:
-        return readers[name](top, traj, frame_start)
+        reader = _frame_readers()[name]
     except KeyError as e:
-        if name is not None:
-            e.args = ("Frame reader '{0}' is not a valid option.".format(name),)
-            raise
-        for name, reader in readers.items():  # Return first reader that accepts given files
+        e.args = ("Frame reader '{0}' is not a valid option.".format(name),)
+        raise
+    return reader(top, traj, frame_start)
+
+
+def _extension(filename):
+    return None if filename is None else os.path.splitext(filename)[1].lower()
+
+
+def _probe_header(filename):
+    """
+    Check that the start of a file matches the format implied by its extension.
+
+    Only formats which are cheap to recognise are checked, others are assumed to be correct.
+
+    :param filename: File to check
+    :return: True if the file header is consistent with its extension
+    """
+    ext = _extension(filename)
+    if ext in _xdr_magic:
+        with open(filename, "rb") as f:
+            header = f.read(4)
+        # Empty trajectories are valid
+        return not header or (len(header) == 4 and struct.unpack(">i", header)[0] == _xdr_magic[ext])
+
+    if ext == ".gro":
+        with open(filename) as f:
+            f.readline()
             try:
-                return reader(top, traj, frame_start)
-            except (UnsupportedFormatException, ImportError) as e:
-                print(e)
-                continue
-        raise UnsupportedFormatException("None of the available readers support the trajector format provided, {0} {1}".format(top, traj))
+                int(f.readline())
+            except ValueError:
+                return False
+    return True
+
+
+def _measure_throughput(reader, top, traj, max_frames=5):
+    """
+    Measure the time taken by a reader to open a topology and trajectory and read a few frames.
+
+    :param reader: FrameReader subclass
+    :param top: MD topology file
+    :param traj: MD trajectory file
+    :param max_frames: Maximum number of frames to read
+    :return: Time in seconds, or None if the reader cannot read the files
+    """
+    try:
+        start = time.perf_counter()
+        instance = reader(top, traj)
+        instance._initialise_frame(Frame())
+        for i in range(min(max_frames, instance.num_frames)):
+            instance._read_frame_number(i)
+        return time.perf_counter() - start
+    except Exception as e:
+        # Any failure of a candidate, including errors from its library, means it is skipped
+        logger.debug("Frame reader {0} rejected {1} {2}: {3!r}".format(reader.__name__, top, traj, e))
+        return None
+
+
+def select_frame_reader(top, traj=None, probe=False):
+    """
+    Select a reader for a topology and trajectory without opening them fully.
+
+    Readers are filtered by file extension, after checking the file headers, and by whether their library
+    is installed.  Readers which preserve residue names are preferred.  Of those remaining, the first in
+    the order simpletraj, mdtraj, mdanalysis is chosen, unless probe is set and a trajectory is given.
+    Then each reader opens the files and reads a few frames, and the fastest is chosen.
+    Choices are cached for the lifetime of the process.
+
+    :param top: MD topology file
+    :param traj: MD trajectory file, None if only reading the topology
+    :param probe: Choose the fastest reader by timing each one - this may take as long as opening the files
+        once with every reader
+    :return: Name of reader
+    """
+    key = (top, traj, probe)
+    try:
+        return _reader_choice_cache[key]
+    except KeyError:
+        pass
+
+    for filename in (top, traj):
+        if filename is not None and not _probe_header(filename):
+            raise UnsupportedFormatException("File '{0}' does not match the format implied by its extension".format(filename))
+
+    top_ext, traj_ext = _extension(top), _extension(traj)
+    candidates = collections.OrderedDict((name, reader) for name, reader in _frame_readers().items()
+                                         if reader.supports(top_ext, traj_ext) and reader.installed())
+    preserving = [name for name, reader in candidates.items() if not reader.renames_residues]
+    if preserving:
+        candidates = collections.OrderedDict((name, candidates[name]) for name in preserving)
+
+    if not candidates:
+        raise UnsupportedFormatException("None of the available readers support the trajectory format provided, {0} {1}".format(top, traj))
+
+    name = next(iter(candidates))
+    if probe and traj is not None and len(candidates) > 1:
+        try:
+            name = _reader_throughput_cache[(top_ext, traj_ext)]
+        except KeyError:
+            times = {}
+            for candidate, reader in candidates.items():
+                elapsed = _measure_throughput(reader, top, traj)
+                if elapsed is not None:
+                    times[candidate] = elapsed
+            if not times:
+                raise UnsupportedFormatException("None of the available readers support the trajectory format provided, {0} {1}".format(top, traj))
+            name = min(times, key=times.get)
+            _reader_throughput_cache[(top_ext, traj_ext)] = name
+            logger.debug("Selected frame reader {0} for {1} {2}".format(name, top_ext, traj_ext))
+
+    _reader_choice_cache[key] = name
+    return name
 
 
 class FrameReader(metaclass=abc.ABCMeta):
+    # Coordinates returned by _read_frame_number are divided by this to convert to nanometres
+    _coords_divisor = 1
+    # Module required by this reader - checked without importing it
+    module = None
+    # File extensions of topologies and trajectories this reader can open
+    topology_extensions = ()
+    trajectory_extensions = ()
+    # Residue names read by this reader may differ from those in the input files
+    renames_residues = False
+
+    @classmethod
+    def supports(cls, top_ext, traj_ext=None):
+        """
+        Can this reader open files with the given extensions?
+
+        :param top_ext: Extension of topology file, including dot
+        :param traj_ext: Extension of trajectory file, None if no trajectory
+        :return: True if the formats are supported
+        """
+        return top_ext in cls.topology_extensions and (traj_ext is None or traj_ext in cls.trajectory_extensions)
+
+    @classmethod
+    def installed(cls):
+        """
+        Is the library required by this reader installed?
+
+        :return: True if the library can be imported
+        """
+        return cls.module is None or importlib.util.find_spec(cls.module) is not None
+
+    @classmethod
+    def count_frames(cls, topname, trajname):
+        """
+        Count the frames in a trajectory, without opening a reader where possible.
+
+        Frames in XDR trajectories are counted using the frame offset index, other formats are opened.
+
+        :param topname: MD topology file
+        :param trajname: MD trajectory file
+        :return: Number of frames
+        """
+        ext = _extension(trajname)
+        if ext in _offset_index_extensions:
+            try:
+                return len(load_frame_offsets(trajname, lambda: cls._scan_offsets(trajname, ext)))
+            except NotImplementedError:
+                pass
+        return cls(topname, trajname).num_frames
+
+    @classmethod
+    def _scan_offsets(cls, trajname, ext):
+        """
+        Scan an XDR trajectory for the byte offsets of its frames.
+
+        :param trajname: MD trajectory file
+        :param ext: Extension of trajectory file
+        :return: Sequence of frame offsets
+        """
+        raise NotImplementedError
+
     def __init__(self, topname, trajname=None, frame_start=0):
         self._topname = topname
         self._trajname = trajname
         self._frame_number = frame_start
+        self._frame_end = None
+        self._stride = 1
+        # Indices of the atoms copied into the Frame, None to copy all atoms
+        self._atom_index = None
 
         self.num_atoms = 0
         self.num_frames = 0
 
-    def initialise_frame(self, frame):
+    def initialise_frame(self, frame, selection=None):
+        """
+        Create Residues/Atoms in a Frame and pack their coordinates.
+
+        :param frame: Frame instance to initialise
+        :param selection: Collection of residue names to include in the Frame, None to include all residues
+        """
         self._initialise_frame(frame)
+        if self.num_atoms != frame.natoms:
+            raise AssertionError("Number of atoms does not match between gro and xtc files.")
+
+        if selection is not None:
+            self._select_residues(frame, selection)
+        frame.pack_coords()
+
+    def _select_residues(self, frame, selection):
+        """
+        Remove Residues not named in selection from a Frame and record which atoms must be read.
+
+        The original position of each remaining Residue is stored in Frame.residue_origins.
+
+        :param frame: Frame instance from which to remove Residues
+        :param selection: Collection of residue names to keep
+        """
+        residues = []
+        origins = []
+        index = []
+        offset = 0
+        for i, res in enumerate(frame.residues):
+            if res.name in selection:
+                residues.append(res)
+                origins.append(i)
+                index.extend(range(offset, offset + len(res)))
+            offset += len(res)
+
+        frame.residues = residues
+        frame.residue_origins = np.array(origins, dtype=np.intp)
+        frame.natoms = len(index)
+        if len(index) != self.num_atoms:
+            self._atom_index = np.array(index, dtype=np.intp)
+
+    def set_window(self, start=0, end=None, stride=1):
+        """
+        Select the frames which will be returned by read_next.
+
+        Frames outside the window are skipped by seeking rather than being decoded, where the reader allows.
+
+        :param start: Number of first frame to read
+        :param end: Number of frame at which to stop, exclusive, None to read until end of trajectory
+        :param stride: Read only every stride-th frame
+        """
+        self._frame_number = start
+        self._frame_end = end
+        self._stride = stride
+
+    def num_frames_in_window(self):
+        """
+        Return the number of frames which will be returned by read_next from the current position.
+
+        :return: Number of frames
+        """
+        end = self.num_frames if self._frame_end is None else min(self._frame_end, self.num_frames)
+        return max(0, -(-(end - self._frame_number) // self._stride))
+
+    def frame_number_at_time(self, time, after=False):
+        """
+        Return the number of the first frame at or after a given time.
+
+        Frames are found by binary search on their times, so frame times must not decrease, but need not
+        be evenly spaced.  Only a few frames are read.
+
+        :param time: Time in the same units as the trajectory, usually picoseconds
+        :param after: Return the first frame strictly after the given time instead
+        :return: Frame number, or number of frames if there is no such frame
+        """
+        # Allow for rounding error in stored frame times
+        tolerance = 1e-6 * max(1., abs(time))
+
+        low, high = 0, self.num_frames
+        while low < high:
+            middle = (low + high) // 2
+            frame_time = self._read_frame_time(middle)
+            if (frame_time > time + tolerance) if after else (frame_time >= time - tolerance):
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def _read_frame_time(self, number):
+        """
+        Read the time of a frame.
+
+        :param number: Frame number to read
+        :return: Frame time
+        """
+        return self._read_frame_number(number)[0]
+
+    def close(self):
+        """
+        Release any resources held by the reader, such as background threads or caches.
+        """
+        pass
 
     def read_next(self, frame):
-        result = self.read_frame_number(self._frame_number, frame)
+        number = self._frame_number
+        if self._frame_end is not None and number >= self._frame_end:
+            return False
+
+        result = self.read_frame_number(number, frame)
         if result:
-            self._frame_number += 1
+            frame.number = number
+            self._frame_number += self._stride
         return result
 
     def read_frame_number(self, number, frame):
         try:
-            time, coords, box = self._read_frame_number(number)
-            if box is None:
-                box = np.zeros(3)
-            frame.time = time
-            frame.box = box
-
-            for atom, coord_line in zip(itertools.chain.from_iterable(frame.residues), coords):
-                atom.coords = coord_line
+            # Refill the Frame's coordinate array in place - Atoms hold views into it
+            frame.time, frame.box = self._read_into(number, frame.coords)
 
         except (IndexError, AttributeError):
             # IndexError - run out of xtc frames
@@ -80,6 +437,31 @@ class FrameReader(metaclass=abc.ABCMeta):
             return False
         return True
 
+    def _read_into(self, number, coords):
+        """
+        Read a frame and copy its coordinates, in nanometres, into an existing array.
+
+        :param number: Frame number to read
+        :param coords: Array of shape (natoms, 3) into which to copy coordinates
+        :return: Tuple of frame time and box
+        """
+        time, frame_coords, box = self._read_frame_number(number)
+        if box is None:
+            box = np.zeros(3)
+
+        if self._atom_index is not None and len(frame_coords) != len(coords):
+            # Copy only the selected atoms - then convert units in place
+            np.take(frame_coords, self._atom_index, axis=0, out=coords)
+            if self._coords_divisor != 1:
+                coords /= self._coords_divisor
+        elif len(coords):
+            if self._coords_divisor == 1:
+                np.copyto(coords, frame_coords)
+            else:
+                np.divide(frame_coords, self._coords_divisor, out=coords)
+
+        return time, box
+
     @abc.abstractmethod
     def _initialise_frame(self, frame):
         pass
@@ -90,6 +472,12 @@ class FrameReader(metaclass=abc.ABCMeta):
 
 
 class FrameReaderSimpleTraj(FrameReader):
+    # SimpleTraj uses Angstrom, we want nanometers
+    _coords_divisor = 10
+    module = "simpletraj"
+    topology_extensions = (".gro",)
+    trajectory_extensions = (".xtc", ".trr", ".dcd", ".nc", ".ncdf", ".netcdf")
+
     def __init__(self, topname, trajname=None, frame_start=0):
         """
         Open input XTC file from which to read coordinates using simpletraj library.
@@ -111,7 +499,14 @@ class FrameReaderSimpleTraj(FrameReader):
 
         if trajname is not None:
             try:
-                self._traj = trajectory.get_trajectory(trajname)
+                ext = _extension(trajname)
+                if ext in _offset_index_extensions:
+                    self._traj = self._indexed_trajectory_class(ext)(trajname)
+                elif ext == ".ncdf":
+                    # Not recognised by simpletraj.trajectory.get_trajectory
+                    self._traj = trajectory.NetcdfTrajectory(trajname)
+                else:
+                    self._traj = trajectory.get_trajectory(trajname)
             except OSError as e:
                 if not os.path.isfile(trajname):
                     raise FileNotFoundError(trajname) from e
@@ -126,62 +521,89 @@ class FrameReaderSimpleTraj(FrameReader):
                 raise UnsupportedFormatException
             self.num_frames = self._traj.numframes
 
-    def _initialise_frame(self, frame):
+    @classmethod
+    def _scan_offsets(cls, trajname, ext):
+        from simpletraj import trajectory
+        base = {".xtc": trajectory.XtcTrajectory, ".trr": trajectory.TrrTrajectory}[ext]
+        return base._read_numframes(None, trajname)[1]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _indexed_trajectory_class(ext):
         """
-        Parse a GROMACS GRO file and create Residues/Atoms
-        Required before reading coordinates from XTC file
+        Return a simpletraj trajectory class which uses the shared frame offset index.
 
-        :param frame: Frame instance to initialise from GRO file
+        :param ext: Trajectory file extension
+        :return: Subclass of simpletraj trajectory
         """
-        with open(self._topname) as gro:
-            frame.name = gro.readline().strip()
-            try:
-                self.num_atoms = int(gro.readline())
-            except ValueError as e:
-                raise UnsupportedFormatException from e
+        from simpletraj import trajectory
+        base = {".xtc": trajectory.XtcTrajectory, ".trr": trajectory.TrrTrajectory}[ext]
 
-            frame.natoms = self.num_atoms
-            resnum_last = None
-            atnum = 0
+        class IndexedTrajectory(base):
+            def update(self, force=False):
+                self.offsets = load_frame_offsets(self.file_name,
+                                                  lambda: self._read_numframes(self.file_name)[1])
+                self.numframes = len(self.offsets)
 
-            unpacker = FixedFormatUnpacker("I5,2A5,5X,3F8",
-                                           FixedFormatUnpacker.FormatStyle.Fortran)
+        return IndexedTrajectory
 
-            for _ in range(self.num_atoms):
-                resnum, resname, atomname, *coords = unpacker.unpack(gro.readline())
-                coords = np.array(coords, dtype=np.float32)
+    def _initialise_frame(self, frame):
+        """
+        Parse a GROMACS GRO file and create Residues/Atoms
+        Required before reading coordinates from XTC file
 
-                if resnum != resnum_last:
-                    frame.residues.append(Residue(name=resname,
-                                                  num=resnum))
-                    resnum_last = resnum
-                    atnum = 0
+        :param frame: Frame instance to initialise from GRO file
+        """
+        try:
+            gro = GRO(self._topname)
+        except ValueError as e:
+            raise UnsupportedFormatException from e
 
-                atom = Atom(name=atomname, num=atnum, coords=coords)
-                frame.residues[-1].add_atom(atom)
-                atnum += 1
+        frame.name = gro.name
+        self.num_atoms = gro.natoms
+        frame.natoms = self.num_atoms
+        frame.box = gro.box
 
-            frame.box = np.array([float(x) for x in gro.readline().split()[0:3]], dtype=np.float32)
+        atomnames = gro.atomnames.tolist()
+        starts = gro.residue_starts.tolist()
+        stops = starts[1:] + [gro.natoms]
+        for start, stop, resname, resnum in zip(starts, stops, gro.resnames.tolist(),
+                                                gro.resnums[gro.residue_starts].tolist()):
+            residue = Residue(num=resnum, template=frame.residue_template(resname, atomnames[start:stop]))
+            # Atom coordinates are filled from this when the Frame is packed
+            residue.coords = gro.coords[start:stop]
+            frame.residues.append(residue)
 
     def _read_frame_number(self, number):
         """
         Read next frame from XTC using simpletraj library.
         """
         self._traj.get_frame(number)
-        # SimpleTraj uses Angstrom, we want nanometers
-        xyz = self._traj.x / 10
         box = np.diag(self._traj.box)[0:3] / 10
 
-        return self._traj.time, xyz, box
+        return self._traj.time, self._traj.x, box
 
 
 class FrameReaderMDTraj(FrameReader):
+    # Maximum number of trajectory frames held in memory at once
+    chunk_size = 100
+    # Trajectory formats which MDTraj can seek within - others are loaded whole
+    _seekable_extensions = (".xtc", ".trr", ".dcd", ".nc", ".ncdf", ".netcdf")
+    module = "mdtraj"
+    topology_extensions = (".gro", ".pdb", ".h5", ".mol2")
+    trajectory_extensions = _seekable_extensions + (".gro", ".pdb", ".h5", ".lammpstrj", ".xyz", ".binpos")
+    # MDTraj renames solvent molecules
+    renames_residues = True
+
     def __init__(self, topname, trajname=None, frame_start=0):
         """
         Open input XTC file from which to read coordinates using mdtraj library.
 
+        The trajectory is streamed in chunks of chunk_size frames, so memory use does not depend on its length.
+
         :param topname: GROMACS GRO file from which to read topology
         :param trajname: GROMACS XTC file to read subsequent frames
+        :param frame_start: Frame number to start on, default 0
         """
         FrameReader.__init__(self, topname, trajname, frame_start)
 
@@ -195,11 +617,26 @@ class FrameReaderMDTraj(FrameReader):
             raise
         logger.warning("WARNING: Using MDTraj which renames solvent molecules")
 
+        self._file = None
+        self._chunk = None
+        self._chunk_start = 0
+
         try:
+            self._top = mdtraj.load(topname)
             if trajname is None:
-                self._traj = mdtraj.load(topname)
+                self._chunk = self._top
+            elif _extension(trajname) in self._seekable_extensions:
+                self._file = self._open_file(trajname)
+                if _extension(trajname) in _offset_index_extensions:
+                    self._file.offsets = load_frame_offsets(trajname, lambda: self._file.offsets)
+                    self.num_frames = len(self._file.offsets)
+                else:
+                    self.num_frames = len(self._file)
+                if frame_start < self.num_frames:
+                    # Reading the first frame checks that the trajectory matches the topology
+                    self._load_chunk(frame_start, n_frames=1)
             else:
-                self._traj = mdtraj.load(trajname, top=topname)
+                self._chunk = mdtraj.load(trajname, top=self._top.topology)
         except OSError as e:
             if not os.path.isfile(topname):
                 raise FileNotFoundError(topname) from e
@@ -210,8 +647,50 @@ class FrameReaderMDTraj(FrameReader):
             e.args = ("Error opening file '{0}' or '{1}'".format(topname, trajname),)
             raise
 
-        self.num_atoms = self._traj.n_atoms
-        self.num_frames = self._traj.n_frames
+        if self._file is None:
+            self.num_frames = self._chunk.n_frames
+        self.num_atoms = self._top.n_atoms
+
+    @staticmethod
+    def _open_file(trajname):
+        """
+        Open a trajectory file object - unlike mdtraj.open, extensions are not case sensitive.
+
+        :param trajname: Trajectory file with an extension in _seekable_extensions
+        :return: MDTraj trajectory file object
+        """
+        from mdtraj.formats.registry import FormatRegistry
+        return FormatRegistry.fileobjects[_extension(trajname)](trajname)
+
+    @classmethod
+    def _scan_offsets(cls, trajname, ext):
+        with cls._open_file(trajname) as traj:
+            return traj.offsets
+
+    def _load_chunk(self, number, n_frames=None):
+        """
+        Read the chunk of frames beginning with a given frame number.
+
+        Continues from the current file position if possible, otherwise seeks to the requested frame.
+        When striding, only the requested frame is decoded.
+        If residues have been selected, only the selected atoms are kept.
+
+        :param number: Number of first frame in chunk
+        :param n_frames: Number of frames to read, default chunk_size
+        """
+        if number != self._file.tell():
+            self._file.seek(number)
+
+        if n_frames is None:
+            n_frames = self.chunk_size if self._stride == 1 else 1
+
+        self._chunk = None
+        self._chunk = self._file.read_as_traj(self._top.topology, n_frames=n_frames,
+                                              atom_indices=self._atom_index)
+        self._chunk_start = number
+
+        if not self._chunk.n_frames:
+            raise IndexError("Frame {0} is not present in '{1}'".format(number, self._trajname))
 
     def _initialise_frame(self, frame):
         """
@@ -220,34 +699,65 @@ class FrameReaderMDTraj(FrameReader):
 
         :param frame: Frame instance to initialise from GRO file
         """
-        import mdtraj
-        top = mdtraj.load(self._topname)
+        top = self._top
 
         frame.name = ""
         self.num_atoms = top.n_atoms
         frame.natoms = top.n_atoms
 
-        frame.residues = [Residue(name=res.name, num=res.resSeq) for res in top.topology.residues]
-
-        for atom in top.topology.atoms:
-            new_atom = Atom(name=atom.name, num=atom.serial,
-                            coords=top.xyz[0][atom.index])
-            frame.residues[atom.residue.index].add_atom(new_atom)
+        for res in top.topology.residues:
+            atoms = list(res.atoms)
+            residue = Residue(num=res.resSeq,
+                              template=frame.residue_template(res.name, (atom.name for atom in atoms)))
+            residue.coords = top.xyz[0][[atom.index for atom in atoms]]
+            frame.residues.append(residue)
 
         frame.box = top.unitcell_lengths[0]
 
+    def _read_frame_time(self, number):
+        i = number - self._chunk_start
+        in_chunk = self._chunk is not None and 0 <= i < self._chunk.n_frames
+        if self._file is not None and not in_chunk and _extension(self._trajname) in _offset_index_extensions:
+            # Decode only this frame, rather than loading a chunk
+            if number != self._file.tell():
+                self._file.seek(number)
+            return self._file.read(n_frames=1, atom_indices=[0])[1][0]
+        return FrameReader._read_frame_time(self, number)
+
     def _read_frame_number(self, number):
         """
         Read next frame from XTC using mdtraj library.
         """
+        if not 0 <= number < self.num_frames:
+            raise IndexError("Frame {0} is not present in the trajectory".format(number))
+
+        i = number - self._chunk_start
+        if self._chunk is None or not 0 <= i < self._chunk.n_frames:
+            self._load_chunk(number)
+            i = 0
         try:
-            return self._traj.time[number], self._traj.xyz[number], self._traj.unitcell_lengths[number]
+            return self._chunk.time[i], self._chunk.xyz[i], self._chunk.unitcell_lengths[i]
         except TypeError:
-            return self._traj.time[number], self._traj.xyz[number], None
+            return self._chunk.time[i], self._chunk.xyz[i], None
 
 
 class FrameReaderMDAnalysis(FrameReader):
+    # MDAnalysis uses Angstrom, we want nanometers
+    _coords_divisor = 10
+    module = "MDAnalysis"
+    topology_extensions = (".gro", ".pdb", ".pqr", ".crd", ".mol2", ".xyz")
+    trajectory_extensions = (".xtc", ".trr", ".dcd", ".nc", ".ncdf", ".gro", ".pdb", ".xyz", ".lammpstrj")
+
     def __init__(self, topname, trajname=None, frame_start=0):
+        """
+        Open input XTC file from which to read coordinates using MDAnalysis library.
+
+        Frames read in sequence use MDAnalysis' iterator, random access is used only when skipping frames.
+
+        :param topname: MD topology file from which to read topology
+        :param trajname: MD trajectory file to read subsequent frames
+        :param frame_start: Frame number to start on, default 0
+        """
         import MDAnalysis
 
         super().__init__(topname, trajname, frame_start)
@@ -255,6 +765,9 @@ class FrameReaderMDAnalysis(FrameReader):
         try:
             if trajname is None:
                 self._traj = MDAnalysis.Universe(topname)
+            elif _extension(trajname) in _offset_index_extensions:
+                ext = _extension(trajname)
+                self._traj = MDAnalysis.Universe(topname, trajname, format=self._indexed_reader_class(ext))
             else:
                 self._traj = MDAnalysis.Universe(topname, trajname)
         except ValueError as e:
@@ -265,21 +778,449 @@ class FrameReaderMDAnalysis(FrameReader):
         self.num_atoms = self._traj.atoms.n_atoms
         self.num_frames = self._traj.trajectory.n_frames
 
+    @classmethod
+    def _scan_offsets(cls, trajname, ext):
+        from MDAnalysis.lib.formats.libmdaxdr import XTCFile, TRRFile
+        with {".xtc": XTCFile, ".trr": TRRFile}[ext](trajname) as traj:
+            return traj.offsets
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _indexed_reader_class(ext):
+        """
+        Return an MDAnalysis trajectory reader class which uses the shared frame offset index.
+
+        :param ext: Trajectory file extension
+        :return: Subclass of MDAnalysis XDR reader
+        """
+        from MDAnalysis.coordinates.XTC import XTCReader
+        from MDAnalysis.coordinates.TRR import TRRReader
+        base = {".xtc": XTCReader, ".trr": TRRReader}[ext]
+
+        class IndexedReader(base):
+            def _load_offsets(self):
+                self._xdr.set_offsets(load_frame_offsets(self.filename, lambda: self._xdr.offsets))
+
+        return IndexedReader
+
     def _initialise_frame(self, frame):
+        """
+        Create Residues/Atoms using the topology of the already open Universe.
+
+        :param frame: Frame instance to initialise
+        """
         frame.name = ""
         frame.natoms = self.num_atoms
 
-        import MDAnalysis
-        topol = MDAnalysis.Universe(self._topname)
-        frame.box = topol.dimensions[0:3] / 10.
+        if self._trajname is None:
+            ts = self._traj.trajectory.ts
+            positions = ts.positions
+            dimensions = ts.dimensions
+        else:
+            # Universe is reading the trajectory - initial coordinates must come from the topology file
+            from MDAnalysis.coordinates.core import get_reader_for
+            top_reader = get_reader_for(self._topname)(self._topname)
+            positions = top_reader.ts.positions.copy()
+            dimensions = top_reader.ts.dimensions
+            top_reader.close()
+
+        frame.box = dimensions[0:3] / 10.
 
-        for res in topol.residues:
-            residue = Residue(name=res.resname, num=res.resnum)
-            for atom in res.atoms:
-                residue.add_atom(Atom(name=atom.name, num=atom.id, coords=atom.position / 10.))
+        for res in self._traj.residues:
+            residue = Residue(num=res.resnum, template=frame.residue_template(res.resname, res.atoms.names))
+            residue.coords = positions[res.atoms.ix] / 10.
             frame.residues.append(residue)
 
     def _read_frame_number(self, number):
-        traj_frame = self._traj.trajectory[number]
-        return traj_frame.time, traj_frame.positions / 10., traj_frame.dimensions[0:3] / 10.
+        traj = self._traj.trajectory
+
+        if number == traj.ts.frame:
+            # Already positioned on this frame - happens on the first read
+            traj_frame = traj.ts
+        elif number == traj.ts.frame + 1:
+            # Sequential access - continue from the current frame rather than seeking
+            try:
+                traj_frame = next(traj)
+            except StopIteration as e:
+                raise IndexError("Frame {0} is not present in the trajectory".format(number)) from e
+        else:
+            traj_frame = traj[number]
+
+        return traj_frame.time, traj_frame.positions, traj_frame.dimensions[0:3] / 10.
+
+
+class FrameReaderConcat(FrameReader):
+    """
+    Read several trajectory files in sequence as a single trajectory.
+
+    The same underlying reader is used for every part.  Only one part is held open at a time and the reader
+    for each part is opened when a frame is first read from it.
+    """
+    def __init__(self, topname, trajnames, frame_start=0, name=None):
+        """
+        Open the first trajectory part and count the frames in each part.
+
+        Other parts are not opened until they are read - their frames are counted using the frame offset
+        index where the format allows.
+
+        :param topname: MD topology file from which to read topology
+        :param trajnames: List of MD trajectory files, in order
+        :param frame_start: Frame number to start on, default 0
+        :param name: Name of reader to use, None to select the first which accepts the files
+        """
+        FrameReader.__init__(self, topname, list(trajnames), frame_start)
+
+        first = get_frame_reader(topname, self._trajname[0], name=name)
+        self._reader_class = type(first)
+        self._coords_divisor = first._coords_divisor
+
+        # Frame number at which each part begins - the last entry is the total number of frames
+        self._part_starts = [0, first.num_frames]
+        for trajname in self._trajname[1:]:
+            self._part_starts.append(self._part_starts[-1] + self._reader_class.count_frames(topname, trajname))
+
+        self._part = 0
+        self._reader = first
+
+        self.num_atoms = first.num_atoms
+        self.num_frames = self._part_starts[-1]
+
+    def _open_part(self, part):
+        """
+        Return the reader for a trajectory part, closing the previous part if necessary.
+
+        :param part: Index of trajectory part
+        :return: FrameReader for part
+        """
+        if part != self._part:
+            self._reader = None
+            self._reader = self._reader_class(self._topname, self._trajname[part])
+            self._reader.set_window(stride=self._stride)
+            self._reader._atom_index = self._atom_index
+            self._part = part
+        return self._reader
+
+    def _initialise_frame(self, frame):
+        self._open_part(0)._initialise_frame(frame)
+
+    def _select_residues(self, frame, selection):
+        FrameReader._select_residues(self, frame, selection)
+        self._reader._atom_index = self._atom_index
+
+    def set_window(self, start=0, end=None, stride=1):
+        FrameReader.set_window(self, start, end, stride)
+        self._reader.set_window(stride=stride)
+
+    def _read_frame_number(self, number):
+        if not 0 <= number < self.num_frames:
+            raise IndexError("Frame {0} is not present in the trajectory".format(number))
+
+        part = bisect.bisect_right(self._part_starts, number) - 1
+        return self._open_part(part)._read_frame_number(number - self._part_starts[part])
+
+    def _read_frame_time(self, number):
+        if not 0 <= number < self.num_frames:
+            raise IndexError("Frame {0} is not present in the trajectory".format(number))
+
+        part = bisect.bisect_right(self._part_starts, number) - 1
+        return self._open_part(part)._read_frame_time(number - self._part_starts[part])
+
+
+class FrameReaderCached(FrameReader):
+    """
+    Wrap another FrameReader, storing decoded frames in a memory-mapped cache next to the trajectory.
+
+    Frames are written to the cache as they are first read, so later runs on the same trajectory read
+    from the cache instead of decoding the trajectory again.  The cache holds either the atoms of the
+    selected residues, or all atoms so that it may be reused with any selection.  It is rebuilt if the
+    size or modification time of the trajectory change.
+
+    Each frame is copied once from the cache into the Frame's coordinate array, since Atoms and Residues
+    hold views into that array.  The trajectory is still opened by the wrapped reader, to count its frames
+    and to read any frames missing from the cache.  Call close to write the cache to disk.
+    """
+    _cache_files = ("coords", "times", "boxes", "filled")
+
+    def __init__(self, reader, atoms="selected"):
+        """
+        Wrap an existing FrameReader.
+
+        :param FrameReader reader: Reader from which frames will be cached
+        :param str atoms: Atoms to store in cache, "selected" or "all"
+        """
+        if atoms not in ("selected", "all"):
+            raise ValueError("Frame cache must store 'selected' or 'all' atoms, not '{0}'".format(atoms))
+
+        FrameReader.__init__(self, reader._topname, reader._trajname, reader._frame_number)
+        self._reader = reader
+        self._cache_all = atoms == "all"
+
+        self.num_atoms = reader.num_atoms
+        self.num_frames = reader.num_frames
+
+        self._cache = None
+
+    @staticmethod
+    def cache_dirname(trajname):
+        """
+        Return the name of the directory holding frame caches for a trajectory.
+
+        :param trajname: Trajectory file, or list of files read in sequence
+        :return: Name of hidden directory in the same directory as the (first) trajectory
+        """
+        first = trajname[0] if isinstance(trajname, (list, tuple)) else trajname
+        head, tail = os.path.split(first)
+        return os.path.join(head, ".{0}.pycgtool_cache".format(tail))
+
+    def initialise_frame(self, frame, selection=None):
+        if self._cache_all:
+            # Selection is applied when copying from the cache, which holds every atom
+            FrameReader.initialise_frame(self, frame, selection)
+            natoms = self.num_atoms
+        else:
+            self._reader.initialise_frame(frame, selection)
+            self.num_atoms = self._reader.num_atoms
+            natoms = frame.natoms
+
+        if self._trajname is not None:
+            self._open_cache(natoms)
+
+    def _initialise_frame(self, frame):
+        self._reader._initialise_frame(frame)
+        self.num_atoms = self._reader.num_atoms
+
+    def _open_cache(self, natoms):
+        """
+        Open an existing cache if it is valid for this trajectory and selection, otherwise create a new one.
+
+        If the cache cannot be created frames are read directly from the wrapped reader.
+
+        :param natoms: Number of atoms per frame to store in cache
+        """
+        trajnames = self._trajname if isinstance(self._trajname, (list, tuple)) else [self._trajname]
+        key = [self.num_frames, natoms]
+        for trajname in trajnames:
+            stat = os.stat(trajname)
+            key.extend((stat.st_size, stat.st_mtime_ns))
+        key = np.array(key, dtype=np.int64)
+
+        # Caches for different selections and lists of trajectory parts may coexist
+        digest = hashlib.sha1("\0".join(map(os.path.basename, trajnames)).encode())
+        if not self._cache_all and self._reader._atom_index is not None:
+            digest.update(self._reader._atom_index.tobytes())
+        dirname = os.path.join(self.cache_dirname(trajnames), digest.hexdigest()[:16])
+        filenames = {name: os.path.join(dirname, name + ".npy") for name in self._cache_files + ("key",)}
+
+        try:
+            if np.array_equal(np.load(filenames["key"]), key):
+                self._cache = {name: np.load(filenames[name], mmap_mode="r+") for name in self._cache_files}
+                return
+        except (OSError, ValueError):
+            pass
+
+        shapes = {"coords": (self.num_frames, natoms, 3), "times": (self.num_frames,),
+                  "boxes": (self.num_frames, 3), "filled": (self.num_frames,)}
+        dtypes = {"coords": np.float32, "times": np.float64, "boxes": np.float32, "filled": np.bool_}
+        try:
+            os.makedirs(dirname, exist_ok=True)
+            # Remove key first, so that an interrupted rebuild is never mistaken for a valid cache
+            if os.path.exists(filenames["key"]):
+                os.remove(filenames["key"])
+            self._cache = {name: np.lib.format.open_memmap(filenames[name], mode="w+",
+                                                           dtype=dtypes[name], shape=shapes[name])
+                           for name in self._cache_files}
+            np.save(filenames["key"], key)
+        except (OSError, ValueError) as e:
+            # ValueError - empty trajectory cannot be memory-mapped
+            logger.warning("Could not create frame cache '{0}': {1}".format(dirname, e))
+            self._cache = None
+            if self._cache_all:
+                # Frames are read directly from the wrapped reader, which must now apply the selection
+                self._reader._atom_index = self._atom_index
+
+    def set_window(self, start=0, end=None, stride=1):
+        FrameReader.set_window(self, start, end, stride)
+        # Stride is used by the wrapped reader to skip frames when decoding
+        self._reader.set_window(start, end, stride)
+
+    def frame_number_at_time(self, time, after=False):
+        return self._reader.frame_number_at_time(time, after)
+
+    def _read_into(self, number, coords):
+        if self._cache is None:
+            # No cache - the wrapped reader converts units and selects atoms
+            return self._reader._read_into(number, coords)
+        return FrameReader._read_into(self, number, coords)
+
+    def _read_frame_number(self, number):
+        if self._cache is None:
+            time, coords, box = self._reader._read_frame_number(number)
+            return time, coords / self._reader._coords_divisor, box
+
+        cache = self._cache
+        if not 0 <= number < self.num_frames:
+            raise IndexError("Frame {0} is not present in the trajectory".format(number))
+
+        if not cache["filled"][number]:
+            if self._cache_all:
+                time, coords, box = self._reader._read_frame_number(number)
+                np.divide(coords, self._reader._coords_divisor, out=cache["coords"][number])
+            else:
+                # Wrapped reader selects atoms and converts units directly into the cache
+                time, box = self._reader._read_into(number, cache["coords"][number])
+            cache["times"][number] = time
+            cache["boxes"][number] = np.zeros(3) if box is None else box
+            cache["filled"][number] = True
+
+        return cache["times"][number], cache["coords"][number], cache["boxes"][number]
+
+    def close(self):
+        """
+        Write cached frames to disk and close the wrapped reader.
+        """
+        if self._cache is not None:
+            for array in self._cache.values():
+                array.flush()
+        self._reader.close()
+
+
+class FrameReaderPrefetch(FrameReader):
+    """
+    Wrap another FrameReader, decoding upcoming frames on a background thread.
+
+    Frames are decoded into a bounded ring of preallocated coordinate buffers so that decoding of the
+    trajectory overlaps with processing of the current frame.  Since this uses a thread, the amount of
+    overlap depends on the underlying trajectory library releasing the GIL while decoding.
+    """
+    def __init__(self, reader, depth=4):
+        """
+        Wrap an existing FrameReader.
+
+        :param FrameReader reader: Reader from which frames will be prefetched
+        :param int depth: Maximum number of frames to decode ahead of the current frame
+        """
+        FrameReader.__init__(self, reader._topname, reader._trajname, reader._frame_number)
+        self._reader = reader
+        self._depth = max(1, depth)
+        self._coords_divisor = reader._coords_divisor
+
+        self.num_atoms = reader.num_atoms
+        self.num_frames = reader.num_frames
+
+        self._thread = None
+        self._stop_event = None
+        self._free = None
+        self._ready = None
+        self._next_number = None
+
+    def __del__(self):
+        self._stop()
+
+    def initialise_frame(self, frame, selection=None):
+        # Selection must be applied by the wrapped reader, since it fills the prefetch buffers
+        self._reader.initialise_frame(frame, selection)
+        self.num_atoms = self._reader.num_atoms
+
+    def _initialise_frame(self, frame):
+        self._reader._initialise_frame(frame)
+        self.num_atoms = self._reader.num_atoms
+
+    def set_window(self, start=0, end=None, stride=1):
+        FrameReader.set_window(self, start, end, stride)
+        # Stride is used by the wrapped reader to skip frames when decoding
+        self._reader.set_window(start, end, stride)
+        self._stop()
+
+    def frame_number_at_time(self, time, after=False):
+        self._stop()
+        return self._reader.frame_number_at_time(time, after)
+
+    def _read_frame_number(self, number):
+        # The wrapped reader must not be used by the worker at the same time
+        self._stop()
+        return self._reader._read_frame_number(number)
+
+    def _read_frame_time(self, number):
+        self._stop()
+        return self._reader._read_frame_time(number)
+
+    @staticmethod
+    def _worker(reader, number, end, stride, free, ready, stop_event):
+        """
+        Decode frames in sequence into free buffers until stopped, the window ends or the trajectory ends.
+
+        Exceptions are passed back to the reading thread in place of a buffer.
+        Does not hold a reference to the FrameReaderPrefetch, so that it may be garbage collected.
+        """
+        while not stop_event.is_set() and (end is None or number < end):
+            buffer = free.get()
+            if buffer is None:
+                break
+            try:
+                time, box = reader._read_into(number, buffer)
+                box = np.array(box, dtype=np.float32)
+            except Exception as e:
+                ready.put((None, e, None))
+                break
+            ready.put((buffer, time, box))
+            number += stride
+
+    def _start(self, number, shape):
+        """
+        Start prefetching frames from a given frame number, stopping any existing worker.
+
+        :param number: Frame number at which to start
+        :param shape: Shape of coordinate buffers
+        """
+        self._stop()
+
+        self._free = queue.Queue()
+        self._ready = queue.Queue()
+        for _ in range(self._depth):
+            self._free.put(np.empty(shape, dtype=np.float32))
+
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._worker,
+                                        args=(self._reader, number, self._frame_end, self._stride,
+                                              self._free, self._ready, self._stop_event),
+                                        daemon=True)
+        self._next_number = number
+        self._thread.start()
+
+    def close(self):
+        """
+        Stop the background thread and close the wrapped reader.
+        """
+        self._stop()
+        self._reader.close()
+
+    def _stop(self):
+        """
+        Stop the background thread if it is running.
+        """
+        if self._thread is not None:
+            self._stop_event.set()
+            self._free.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _read_into(self, number, coords):
+        if self._frame_end is not None and number >= self._frame_end:
+            # Frames outside the window are not prefetched
+            self._stop()
+            return self._reader._read_into(number, coords)
+
+        if self._thread is None or number != self._next_number:
+            self._start(number, coords.shape)
+
+        buffer, time, box = self._ready.get()
+        if buffer is None:
+            # Worker has stopped - this frame will be retried if requested again
+            self._thread.join()
+            self._thread = None
+            raise time
 
+        np.copyto(coords, buffer)
+        self._free.put(buffer)
+        self._next_number = number + self._stride
+        return time, box
@@ -0,0 +1,247 @@
+"""
+This module contains classes for writing coordinates and trajectories from a Frame instance.
+
+XTC frames are copied into preallocated blocks which are compressed and written on a background thread.
+GRO records are formatted in bulk, many atoms to each string formatting operation.
+"""
+
+import atexit
+import queue
+import threading
+import weakref
+
+import numpy as np
+
+from .util import backup_file
+
+# XTC writers which have not been closed - closed at exit so that buffered frames are not lost
+_open_writers = weakref.WeakSet()
+
+
+@atexit.register
+def _close_open_writers():
+    errors = []
+    for writer in list(_open_writers):
+        try:
+            writer.close()
+        except Exception as e:
+            errors.append(e)
+    if errors:
+        raise errors[0]
+
+
+class FrameWriterXTC:
+    """
+    Write Frames to a GROMACS XTC file using the mdtraj library.
+
+    Each Frame is copied into a preallocated block of frames.  Full blocks are passed to a background
+    thread, which compresses and writes them while the next block is filled.  Remaining frames are written
+    by close, which is also called when the writer is garbage collected or the interpreter exits.
+    """
+    def __init__(self, filename, natoms, block_size=100, depth=2):
+        """
+        Open an XTC file for writing, backing up any existing file.
+
+        :param filename: XTC file to write
+        :param natoms: Number of atoms in each Frame
+        :param int block_size: Number of frames written in each call to the underlying library
+        :param int depth: Number of blocks which may be filled or waiting to be written at once
+        """
+        self._thread = None
+        try:
+            import mdtraj
+        except ImportError as e:
+            if "scipy" in repr(e):
+                e.msg = "XTC output with MDTraj also requires Scipy"
+            else:
+                e.msg = "XTC output requires the module MDTraj (and probably Scipy)"
+            raise
+
+        backup_file(filename)
+        self._file = mdtraj.formats.XTCTrajectoryFile(filename, mode="w")
+        self.filename = filename
+        self.natoms = natoms
+        self.num_frames = 0
+
+        self._block_size = max(1, block_size)
+        self._free = queue.Queue()
+        self._full = queue.Queue()
+        for _ in range(max(1, depth)):
+            self._free.put(self._allocate_block())
+        self._block = None
+        self._used = 0
+        # Exceptions raised by the background thread - once one is set, every later call raises it
+        self._errors = []
+
+        self._thread = threading.Thread(target=self._worker,
+                                        args=(self._file, self._full, self._free, self._errors),
+                                        daemon=True)
+        self._thread.start()
+        _open_writers.add(self)
+
+    def __del__(self):
+        if self._thread is not None:
+            self.close()
+
+    def _allocate_block(self):
+        return {"xyz": np.empty((self._block_size, self.natoms, 3), dtype=np.float32),
+                "time": np.empty(self._block_size, dtype=np.float32),
+                "step": np.empty(self._block_size, dtype=np.int32),
+                "box": np.zeros((self._block_size, 3, 3), dtype=np.float32)}
+
+    @staticmethod
+    def _worker(xtc, full, free, errors):
+        """
+        Write full blocks to the XTC file until a None block is received.
+
+        After a write fails no further blocks are written, so that the file is not left with a gap.
+        Blocks are still returned to the free queue, so that the writing thread is never left waiting.
+        Does not hold a reference to the FrameWriterXTC, so that it may be garbage collected.
+        """
+        while True:
+            block, used = full.get()
+            if block is None:
+                break
+            if not errors:
+                try:
+                    xtc.write(block["xyz"][:used], time=block["time"][:used],
+                              step=block["step"][:used], box=block["box"][:used])
+                except Exception as e:
+                    errors.append(e)
+            free.put(block)
+
+    def _check_error(self):
+        if self._errors:
+            raise self._errors[0]
+
+    def write(self, frame):
+        """
+        Add a Frame to the trajectory.
+
+        :param frame: Frame to write, must contain natoms atoms
+        :raises: Any exception raised while writing in the background
+        """
+        self._check_error()
+        if self._block is None:
+            self._block = self._free.get()
+            self._used = 0
+
+        i = self._used
+        self._block["xyz"][i] = frame.coords
+        self._block["time"][i] = frame.time
+        self._block["step"][i] = frame.number
+        box = self._block["box"][i]
+        box[0, 0], box[1, 1], box[2, 2] = frame.box[0:3]
+
+        self._used += 1
+        self.num_frames += 1
+        if self._used == self._block_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Pass any partially filled block to the background thread to be written.
+        """
+        if self._block is not None and self._used:
+            self._full.put((self._block, self._used))
+            self._block = None
+
+    def close(self):
+        """
+        Write all remaining frames and close the file.
+
+        :raises: Any exception raised while writing in the background, on every call after it occurred
+        """
+        if self._thread is None:
+            self._check_error()
+            return
+        _open_writers.discard(self)
+        self.flush()
+        self._full.put((None, 0))
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+        self._check_error()
+
+
+class FrameWriterGRO:
+    """
+    Write Frames to a GROMACS GRO file, which may contain multiple frames.
+
+    Residue and atom names and numbers are collected into columns from the first Frame written and reused
+    for later frames, so all Frames written must have the same residues and atoms.
+    """
+    # Number of atom records formatted in each string formatting operation
+    chunk_size = 100000
+    # GROMACS writes residue and atom numbers modulo this, to fit their five digit columns
+    wrap = 100000
+
+    _record_format = "%5d%-5s%5s%5d%8.3f%8.3f%8.3f\n"
+
+    def __init__(self, filename):
+        """
+        Open a GRO file for writing, backing up any existing file.
+
+        :param filename: GRO file to write
+        """
+        backup_file(filename)
+        self._file = open(filename, "w")
+        self.filename = filename
+        self.num_frames = 0
+        # Values of each atom record - coordinates are replaced for each frame
+        self._records = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _collect_records(self, frame):
+        """
+        Collect the residue and atom columns of the atom records for a Frame.
+
+        :param frame: Frame from which to collect residues and atoms
+        :return: Numpy object array with one row of values per atom record
+        """
+        natoms = sum(map(len, frame.residues))
+        records = np.empty((natoms, 7), dtype=object)
+        records[:, 0] = np.repeat([res.num for res in frame.residues],
+                                  [len(res) for res in frame.residues]) % self.wrap
+        records[:, 1] = [res.name for res in frame.residues for _ in range(len(res))]
+        records[:, 2] = [atom_name for res in frame.residues for atom_name in res.atom_names]
+        records[:, 3] = np.arange(1, natoms + 1) % self.wrap
+        return records
+
+    def write(self, frame):
+        """
+        Write a Frame to the file.
+
+        :param frame: Frame to write
+        """
+        coords = frame.coords
+        if self._records is None:
+            self._records = self._collect_records(frame)
+            if len(self._records) != len(coords):
+                self._records = None
+                raise ValueError("Frame has coordinates for {0} atoms but its residues contain {1} atoms - "
+                                 "call pack_coords after adding atoms".format(len(coords), sum(map(len, frame))))
+        records = self._records
+        if len(records) != len(coords):
+            raise ValueError("Frame contains {0} atoms but the first frame written contained {1}".format(
+                len(coords), len(records)))
+
+        records[:, 4:] = coords.astype(np.float64)
+
+        self._file.write("{0}\n{1:5d}\n".format(frame.name, len(records)))
+        for start in range(0, len(records), self.chunk_size):
+            chunk = records[start:start + self.chunk_size]
+            self._file.write((self._record_format * len(chunk)) % tuple(chunk.ravel()))
+        self._file.write("{0:10.5f}{1:10.5f}{2:10.5f}\n".format(*frame.box))
+        self.num_frames += 1
+
+    def close(self):
+        """
+        Close the file.
+        """
+        self._file.close()
@@ -54,7 +54,36 @@ class FunctionalForm(object, metaclass=abc.ABCMeta):
     Parent class of any functional form used in Boltzmann Inversion to convert variance to a force constant.
 
     New functional forms must define a static __call__ method.
+
+    Functional forms which set uses_moments may be inverted from a RunningMoments accumulator
+    rather than requiring all measured values to be stored.
     """
+    uses_moments = False
+
+    @staticmethod
+    def eqm_from_moments(moments, temp):
+        """
+        Calculate equilibrium value from accumulated moments.
+        May be overridden by functional forms.
+
+        :param RunningMoments moments: Accumulated moments of measured internal coordinate values
+        :param temp: Temperature of simulation
+        :return: Calculated equilibrium value
+        """
+        return moments.mean
+
+    @staticmethod
+    def fconst_from_moments(moments, temp):
+        """
+        Calculate force constant from accumulated moments.
+        Must be defined by functional forms which set uses_moments.
+
+        :param RunningMoments moments: Accumulated moments of measured internal coordinate values
+        :param temp: Temperature of simulation
+        :return: Calculated force constant
+        """
+        raise NotImplementedError
+
     @staticmethod
     def eqm(values, temp):
         """
@@ -104,6 +133,7 @@ class FunctionalForm(object, metaclass=abc.ABCMeta):
 
 class Harmonic(FunctionalForm):
     gromacs_type_ids = (1, 1, 1)  # Consider whether to use improper (type 2) instead, it is actually harmonic
+    uses_moments = True
 
     @staticmethod
     def fconst(values, temp):
@@ -111,9 +141,15 @@ class Harmonic(FunctionalForm):
         var = np.nanvar(values)
         return rt / var
 
+    @staticmethod
+    def fconst_from_moments(moments, temp):
+        rt = 8.314 * temp / 1000.
+        return rt / moments.var
+
 
 class CosHarmonic(FunctionalForm):
     gromacs_type_ids = (None, 2, None)
+    uses_moments = True
 
     @staticmethod
     def fconst(values, temp):
@@ -122,26 +158,46 @@ class CosHarmonic(FunctionalForm):
         var = np.nanvar(values)
         return rt / (math.sin(mean)**2 * var)
 
+    @staticmethod
+    def fconst_from_moments(moments, temp):
+        rt = 8.314 * temp / 1000.
+        return rt / (math.sin(moments.mean)**2 * moments.var)
+
 
 class MartiniDefaultLength(FunctionalForm):
     gromacs_type_ids = (1, None, None)
+    uses_moments = True
 
     @staticmethod
     def fconst(values, temp):
         return 1250.
 
+    @staticmethod
+    def fconst_from_moments(moments, temp):
+        return 1250.
+
 
 class MartiniDefaultAngle(FunctionalForm):
     gromacs_type_ids = (None, 2, None)
+    uses_moments = True
 
     @staticmethod
     def fconst(values, temp):
         return 25.
 
+    @staticmethod
+    def fconst_from_moments(moments, temp):
+        return 25.
+
 
 class MartiniDefaultDihedral(FunctionalForm):
     gromacs_type_ids = (None, None, 1)
+    uses_moments = True
 
     @staticmethod
     def fconst(values, temp):
         return 50.
+
+    @staticmethod
+    def fconst_from_moments(moments, temp):
+        return 50.
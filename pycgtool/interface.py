@@ -2,8 +2,6 @@
 This module contains classes for interaction at the terminal.
 """
 import collections
-import curses
-import curses.textpad
 import time
 
 
@@ -114,6 +112,8 @@ class Options:
         """
         Read options in interactive terminal mode using curses.
         """
+        # Curses is only needed for the interactive menu, so is not imported unless used
+        import curses
         curses.wrapper(self._inter)
 
     def _inter(self, stdscr):
@@ -122,6 +122,9 @@ class Options:
 
         :param stdscr: Curses window to use as interface
         """
+        import curses
+        import curses.textpad
+
         stdscr.clear()
         if self.args is not None:
             stdscr.addstr(1, 1, "Using GRO: {0}".format(self.args.gro))
@@ -0,0 +1,289 @@
+"""
+This module contains the registry of numerical kernels used to process each frame.
+
+Each kernel may have several implementations, using different numerical backends:
+
+- numpy - vectorised NumPy, always available
+- numba - compiled loops using Numba
+- numba-parallel - compiled loops using Numba, run in parallel over multiple threads
+
+The backend is chosen at runtime.  By default Numba is used if it is installed, otherwise NumPy.
+If a kernel has no implementation for the chosen backend, the next fastest available is used.
+"""
+
+import collections
+import importlib.util
+import math
+
+import numpy as np
+
+from .util import lazy_jit, prange
+
+# Backends in order of preference when falling back from an unavailable backend
+backends = ("numba-parallel", "numba", "numpy")
+
+
+class KernelRegistry:
+    """
+    Hold the implementations of each kernel and select between them using the current backend.
+    """
+    def __init__(self):
+        self._kernels = collections.defaultdict(dict)
+        self._backend = None
+
+    def register(self, name, backend):
+        """
+        Decorator to register a function as an implementation of a kernel.
+
+        :param name: Name of kernel
+        :param backend: Backend used by this implementation
+        :return: Decorator, which returns the function unchanged
+        """
+        if backend not in backends:
+            raise ValueError("Kernel backend '{0}' is not one of {1}".format(backend, ", ".join(backends)))
+
+        def wrap(func):
+            self._kernels[name][backend] = func
+            return func
+        return wrap
+
+    @property
+    def backend(self):
+        """
+        Name of the backend currently used to select kernels.
+        """
+        if self._backend is None:
+            self._backend = "numba" if importlib.util.find_spec("numba") is not None else "numpy"
+        return self._backend
+
+    def set_backend(self, backend):
+        """
+        Set the backend used to select kernels.
+
+        :param backend: Name of backend, or "auto" or None to choose automatically
+        """
+        if backend == "auto":
+            backend = None
+        if backend is not None and backend not in backends:
+            raise ValueError("Kernel backend '{0}' is not one of {1}".format(backend, ", ".join(backends)))
+        if backend is not None and backend != "numpy" and importlib.util.find_spec("numba") is None:
+            raise ImportError("Kernel backend '{0}' requires the module Numba".format(backend))
+        self._backend = backend
+
+    def get(self, name):
+        """
+        Return the implementation of a kernel for the current backend.
+
+        :param name: Name of kernel
+        :return: Kernel function
+        """
+        implementations = self._kernels[name]
+        for backend in backends[backends.index(self.backend):]:
+            try:
+                return implementations[backend]
+            except KeyError:
+                pass
+        raise KeyError("Kernel '{0}' has no implementation for backend '{1}'".format(name, self.backend))
+
+
+registry = KernelRegistry()
+register = registry.register
+get_kernel = registry.get
+set_backend = registry.set_backend
+
+
+def _raise_zero_length(values):
+    """
+    Raise ZeroDivisionError if a compiled angle kernel found a zero length bond, marked by NaN.
+
+    :param values: Array of calculated angles
+    :raises ZeroDivisionError: Second arg is the index of the first invalid row, as for the NumPy kernels
+    """
+    invalid = np.flatnonzero(np.isnan(values))
+    if len(invalid):
+        raise ZeroDivisionError("One or more bonds in angle calculation has length zero", invalid[0])
+
+
+def _kernel_args(coords, table, box):
+    """
+    Convert arguments to the types expected by the compiled bond kernels.
+    """
+    return (np.ascontiguousarray(coords, dtype=np.float32), np.ascontiguousarray(table, dtype=np.intp),
+            np.ascontiguousarray(box, dtype=np.float32))
+
+
+_bond_signature = "float64[::1](float32[:, ::1], intp[:, ::1], float32[::1])"
+
+
+@lazy_jit
+def _min_image(coords, i, j, box):
+    """
+    Return the minimum image vector from atom i to atom j, ignoring periodicity if any box vector is zero.
+    """
+    d0 = np.float64(coords[j, 0]) - coords[i, 0]
+    d1 = np.float64(coords[j, 1]) - coords[i, 1]
+    d2 = np.float64(coords[j, 2]) - coords[i, 2]
+    if box[0] * box[1] * box[2] != 0:
+        d0 -= box[0] * np.rint(d0 / box[0])
+        d1 -= box[1] * np.rint(d1 / box[1])
+        d2 -= box[2] * np.rint(d2 / box[2])
+    return d0, d1, d2
+
+
+@lazy_jit
+def _angle_between(a0, a1, a2, b0, b1, b2):
+    """
+    Return the angle between two vectors, or NaN if either has length zero.
+    """
+    mag = math.sqrt(a0 * a0 + a1 * a1 + a2 * a2) * math.sqrt(b0 * b0 + b1 * b1 + b2 * b2)
+    if mag == 0:
+        return np.nan
+    dot = (a0 * b0 + a1 * b1 + a2 * b2) / mag
+    return math.acos(max(-1., min(1., dot)))
+
+
+def _lengths_loop(coords, table, box):
+    result = np.empty(table.shape[0])
+    for row in prange(table.shape[0]):
+        d0, d1, d2 = _min_image(coords, table[row, 0], table[row, 1], box)
+        result[row] = math.sqrt(d0 * d0 + d1 * d1 + d2 * d2)
+    return result
+
+
+def _angles_loop(coords, table, box):
+    result = np.empty(table.shape[0])
+    for row in prange(table.shape[0]):
+        a0, a1, a2 = _min_image(coords, table[row, 0], table[row, 1], box)
+        b0, b1, b2 = _min_image(coords, table[row, 1], table[row, 2], box)
+        result[row] = math.pi - _angle_between(a0, a1, a2, b0, b1, b2)
+    return result
+
+
+def _dihedrals_loop(coords, table, box):
+    result = np.empty(table.shape[0])
+    for row in prange(table.shape[0]):
+        a0, a1, a2 = _min_image(coords, table[row, 0], table[row, 1], box)
+        b0, b1, b2 = _min_image(coords, table[row, 1], table[row, 2], box)
+        c0, c1, c2 = _min_image(coords, table[row, 2], table[row, 3], box)
+
+        # Normals to the two planes
+        m0, m1, m2 = a1 * b2 - a2 * b1, a2 * b0 - a0 * b2, a0 * b1 - a1 * b0
+        n0, n1, n2 = b1 * c2 - b2 * c1, b2 * c0 - b0 * c2, b0 * c1 - b1 * c0
+
+        ang = _angle_between(m0, m1, m2, n0, n1, n2)
+        sign = (m1 * n2 - m2 * n1) * b0 + (m2 * n0 - m0 * n2) * b1 + (m0 * n1 - m1 * n0) * b2
+        result[row] = math.copysign(ang, sign)
+    return result
+
+
+@lazy_jit
+def _weighted_centre(coords, box, ref, offset, atom_index, weights, start, stop):
+    """
+    Return the weighted centre of the atoms offset + atom_index[start:stop], unwrapped around atom ref.
+    """
+    # Accumulate in single precision to give the same result as the NumPy kernel
+    s0, s1, s2 = np.float32(0), np.float32(0), np.float32(0)
+    for i in range(start, stop):
+        j = offset + atom_index[i]
+        d0 = coords[j, 0] - coords[ref, 0]
+        d1 = coords[j, 1] - coords[ref, 1]
+        d2 = coords[j, 2] - coords[ref, 2]
+        if box[0] * box[1] * box[2] != 0:
+            d0 -= box[0] * np.rint(d0 / box[0])
+            d1 -= box[1] * np.rint(d1 / box[1])
+            d2 -= box[2] * np.rint(d2 / box[2])
+        s0 += weights[i] * d0
+        s1 += weights[i] * d1
+        s2 += weights[i] * d2
+    return coords[ref, 0] + s0, coords[ref, 1] + s1, coords[ref, 2] + s2
+
+
+def _coords_weight_loop(coords, box, ref_index, atom_index, bead_start, weights):
+    nbeads = ref_index.shape[0]
+    result = np.empty((nbeads, 3), dtype=np.float32)
+    for bead in prange(nbeads):
+        stop = bead_start[bead + 1] if bead + 1 < nbeads else atom_index.shape[0]
+        result[bead, 0], result[bead, 1], result[bead, 2] = _weighted_centre(
+            coords, box, ref_index[bead], 0, atom_index, weights, bead_start[bead], stop)
+    return result
+
+
+def _coords_weight_strided_loop(coords, box, start, nres, natoms, ref_index, atom_index, bead_start, weights):
+    nbeads = ref_index.shape[0]
+    result = np.empty((nres * nbeads, 3), dtype=np.float32)
+    for res in prange(nres):
+        offset = start + res * natoms
+        for bead in range(nbeads):
+            stop = bead_start[bead + 1] if bead + 1 < nbeads else atom_index.shape[0]
+            row = res * nbeads + bead
+            result[row, 0], result[row, 1], result[row, 2] = _weighted_centre(
+                coords, box, offset + ref_index[bead], offset, atom_index, weights, bead_start[bead], stop)
+    return result
+
+
+_coords_weight_signature = ("float32[:, ::1](float32[:, ::1], float32[::1], intp[::1], intp[::1], intp[::1], "
+                            "float32[::1])")
+_coords_weight_strided_signature = ("float32[:, ::1](float32[:, ::1], float32[::1], intp, intp, intp, intp[::1], "
+                                    "intp[::1], intp[::1], float32[::1])")
+
+_compiled = {}
+for _backend, _options in (("numba", {}), ("numba-parallel", {"parallel": True})):
+    _compiled[_backend] = {
+        "bond_lengths": lazy_jit(_bond_signature, **_options)(_lengths_loop),
+        "bond_angles": lazy_jit(_bond_signature, **_options)(_angles_loop),
+        "bond_dihedrals": lazy_jit(_bond_signature, **_options)(_dihedrals_loop),
+        "coords_weight": lazy_jit(_coords_weight_signature, **_options)(_coords_weight_loop),
+        "coords_weight_strided": lazy_jit(_coords_weight_strided_signature, **_options)(_coords_weight_strided_loop),
+    }
+
+
+def lazy_kernels(backend=None):
+    """
+    Return the lazily compiled kernels used by a backend, so that they may be compiled in advance.
+
+    :param backend: Name of backend, or None for the current backend
+    :return: List of LazyJit kernels, empty for backends which are not compiled
+    """
+    if backend is None:
+        backend = registry.backend
+    return list(_compiled.get(backend, {}).values())
+
+
+def _register_compiled(backend, kernels):
+    """
+    Register Python wrappers around compiled kernels which convert arguments and report errors.
+    """
+    @register("bond_lengths", backend)
+    def calc_lengths(coords, table, box):
+        return kernels["bond_lengths"](*_kernel_args(coords, table, box))
+
+    @register("bond_angles", backend)
+    def calc_angles(coords, table, box):
+        values = kernels["bond_angles"](*_kernel_args(coords, table, box))
+        _raise_zero_length(values)
+        return values
+
+    @register("bond_dihedrals", backend)
+    def calc_dihedrals(coords, table, box):
+        values = kernels["bond_dihedrals"](*_kernel_args(coords, table, box))
+        _raise_zero_length(values)
+        return values
+
+    @register("coords_weight", backend)
+    def calc_coords_weight(coords, box, ref_index, atom_index, bead_index, bead_start, weights):
+        return kernels["coords_weight"](np.ascontiguousarray(coords, dtype=np.float32),
+                                         np.ascontiguousarray(box, dtype=np.float32),
+                                         ref_index, atom_index, bead_start,
+                                         np.ascontiguousarray(weights, dtype=np.float32).reshape(-1))
+
+    @register("coords_weight_strided", backend)
+    def calc_coords_weight_strided(coords, box, start, nres, natoms, ref_index, atom_index, bead_index,
+                                   bead_start, weights):
+        return kernels["coords_weight_strided"](np.ascontiguousarray(coords, dtype=np.float32),
+                                                 np.ascontiguousarray(box, dtype=np.float32),
+                                                 start, nres, natoms, ref_index, atom_index, bead_start,
+                                                 np.ascontiguousarray(weights, dtype=np.float32).reshape(-1))
+
+
+for _backend, _kernels in _compiled.items():
+    _register_compiled(_backend, _kernels)
@@ -6,19 +6,15 @@ Each list corresponds to a single molecule.
 """
 
 import numpy as np
+import collections
 import logging
 import json
 import os
 
-from .frame import Atom, Residue, Frame
+from .frame import Atom, Residue, ResidueTemplate, Frame
 from .parsers.cfg import CFG
-from .util import dir_up
-
-try:
-    import numba
-except ImportError:
-    from .util import NumbaDummy
-    numba = NumbaDummy()
+from .util import dir_up, dist_with_pbc_many
+from .kernels import register, get_kernel
 
 logger = logging.getLogger(__name__)
 
@@ -75,6 +71,9 @@ class Mapping:
 
     Contains a dictionary of lists of BeadMaps.  Each list corresponds to a single molecule.
     """
+    # Minimum number of consecutive identical residues to map as a single block
+    min_run_length = 8
+
     def __init__(self, filename, options, itp=None):
         """
         Read in the AA->CG mapping from a file.
@@ -86,6 +85,19 @@ class Mapping:
         self._map_center = options.map_center
         self._masses_are_set = False
 
+        # Index arrays used to map a whole frame at once - created by Mapping._compile
+        self._ref_index = None
+        self._atom_index = None
+        self._bead_index = None
+        self._bead_start = None
+        self._weights = None
+        # Position in the CG frame of each bead mapped by the index arrays above, or a slice if these are all beads
+        self._general_beads = None
+        # Runs of identical residues mapped as a block - created by Mapping._compile
+        self._runs = None
+        # Atomistic Frame for which the tables above were created
+        self._compiled_frame = None
+
         with CFG(filename) as cfg:
             self._manual_charges = {}
             for mol_name, mol_section in cfg.items():
@@ -190,32 +202,131 @@ class Mapping:
         cgframe.name = name
 
         missing_mappings = set()
-        cg_bead_num = 1
+        templates = {}
 
         for aares in aa_residues:
             try:
-                molmap = self._mappings[aares.name]
+                template = templates[aares.name]
             except KeyError:
-                if aares.name not in missing_mappings:
-                    missing_mappings.add(aares.name)
-                    logger.warning("A mapping has not been provided for '{0}' residues, they will not be mapped.".format(aares.name))
-                continue
+                try:
+                    molmap = self._mappings[aares.name]
+                except KeyError:
+                    if aares.name not in missing_mappings:
+                        missing_mappings.add(aares.name)
+                        logger.warning("A mapping has not been provided for '{0}' residues, they will not be mapped.".format(aares.name))
+                    continue
+
+                # All CG residues of a molecule share a single template
+                template = ResidueTemplate(aares.name, (Atom(bmap.name, i, type=bmap.type, charge=bmap.charge, mass=bmap.mass)
+                                                        for i, bmap in enumerate(molmap)))
+                templates[aares.name] = template
+
+            cgframe.add_residue(Residue(num=aares.num, template=template))
+            cgframe.natoms += len(template)
 
-            cgres = Residue(name=aares.name, num=aares.num)
-            cgres.atoms = [Atom(bmap.name, bmap.num, type=bmap.type, charge=bmap.charge, mass=bmap.mass, coords=np.zeros(3)) for bmap in molmap]
+        cgframe.pack_coords()
+        return cgframe
 
-            for i, (bead, bmap) in enumerate(zip(cgres, molmap)):
-                cgres.name_to_num[bead.name] = i
-                bead.charge = bmap.charge
-                bead.mass = bmap.mass
-                bead.num = cg_bead_num
+    @staticmethod
+    def _add_residue_beads(aares, molmap, offset, tables):
+        """
+        Append the atom indices and weights required to map the beads of a single residue.
 
-                cg_bead_num += 1
+        :param aares: Atomistic residue
+        :param molmap: List of BeadMaps for this residue
+        :param offset: Index of the first atom of this residue
+        :param tables: Dictionary of lists to which to append indices and weights
+        """
+        for bmap in molmap:
+            tables["bead_start"].append(len(tables["atom_index"]))
+            for i, atom in enumerate(bmap):
+                try:
+                    tables["atom_index"].append(offset + aares.name_to_num[atom])
+                except KeyError as e:
+                    raise TypeError("Atom {0} does not exist in residue {1}".format(atom, aares.name)) from e
+                if i == 0:
+                    tables["ref_index"].append(tables["atom_index"][-1])
+                tables["bead_index"].append(len(tables["ref_index"]) - 1)
+            tables["weights"].append(bmap.weights)
+
+    @staticmethod
+    def _table_arrays(tables):
+        """
+        Convert lists of indices and weights into the arrays used by the mapping kernels.
 
-            cgframe.add_residue(cgres)
-            cgframe.natoms += len(cgres)
+        :param tables: Dictionary of lists created by Mapping._add_residue_beads
+        :return: Tuple of ref_index, atom_index, bead_index, bead_start, weights arrays
+        """
+        if tables["weights"]:
+            weights = np.concatenate(tables["weights"]).astype(np.float32)
+        else:
+            weights = np.zeros((0, 1), dtype=np.float32)
+        return (np.array(tables["ref_index"], dtype=np.intp),
+                np.array(tables["atom_index"], dtype=np.intp),
+                np.array(tables["bead_index"], dtype=np.intp),
+                np.array(tables["bead_start"], dtype=np.intp),
+                weights)
+
+    def _compile(self, frame):
+        """
+        Precompute the atom indices and weights required to map every bead from a Frame.
 
-        return cgframe
+        Each bead is described by the index of its reference atom and a contiguous block of
+        (atom index, weight) entries, so that a whole frame can be mapped with a few array operations.
+
+        Consecutive residues with the same name and atom order form runs, which are mapped as a single
+        block of shape (nres, natoms, 3) using indices and weights for one residue.  Residues in runs
+        shorter than min_run_length are mapped individually.
+
+        :param frame: Atomistic Frame to be mapped - only residues with a mapping are visited
+        """
+        residues = frame.residues
+        starts = frame.residue_starts
+
+        # Group residues into runs of [key, first position, stop position]
+        groups = []
+        for i in frame.residue_positions(self._mappings).tolist():
+            res = residues[i]
+            key = (res.name, res.atom_names)
+            if groups and groups[-1][2] == i and groups[-1][0] == key:
+                groups[-1][2] += 1
+            else:
+                groups.append([key, i, i + 1])
+
+        general = collections.defaultdict(list)
+        general_beads = []
+        residue_tables = {}
+        self._runs = []
+
+        bead_offset = 0
+        for key, first, stop in groups:
+            molmap = self._mappings[key[0]]
+            nres = stop - first
+
+            if nres >= self.min_run_length:
+                try:
+                    tables = residue_tables[key]
+                except KeyError:
+                    tables = collections.defaultdict(list)
+                    self._add_residue_beads(residues[first], molmap, 0, tables)
+                    tables = residue_tables[key] = self._table_arrays(tables)
+
+                self._runs.append((int(starts[first]), nres, len(residues[first]), bead_offset, tables))
+                bead_offset += nres * len(molmap)
+                continue
+
+            for i in range(first, stop):
+                self._add_residue_beads(residues[i], molmap, int(starts[i]), general)
+                general_beads.extend(range(bead_offset, bead_offset + len(molmap)))
+                bead_offset += len(molmap)
+
+        if len(general_beads) == bead_offset:
+            self._general_beads = slice(None)
+        else:
+            self._general_beads = np.array(general_beads, dtype=np.intp)
+        (self._ref_index, self._atom_index, self._bead_index,
+         self._bead_start, self._weights) = self._table_arrays(general)
+        self._compiled_frame = frame
 
     def apply(self, frame, cgframe=None):
         """
@@ -228,58 +339,90 @@ class Mapping:
         if cgframe is None:
             # Frame needs initialising
             cgframe = self._cg_frame_setup(frame.yield_resname_in(self._mappings), frame.name)
+        if frame is not self._compiled_frame:
+            self._compile(frame)
 
         cgframe.time = frame.time
         cgframe.number = frame.number
         cgframe.box = frame.box
 
-        coord_func = calc_coords_weight if frame.box[0] * frame.box[1] * frame.box[2] else calc_coords_weight_nobox
+        if len(self._ref_index):
+            cgframe.coords[self._general_beads] = get_kernel("coords_weight")(frame.coords, cgframe.box,
+                                                                              self._ref_index, self._atom_index,
+                                                                              self._bead_index, self._bead_start,
+                                                                              self._weights)
 
-        for aares, cgres in zip(frame.yield_resname_in(self._mappings), cgframe):
-            molmap = self._mappings[aares.name]
-
-            for i, (bead, bmap) in enumerate(zip(cgres, molmap)):
-                ref_coords = aares[bmap[0]].coords
-                if len(bmap) == 1:
-                    bead.coords = ref_coords
-                    continue
-
-                coords = np.asarray([aares[atom].coords for atom in bmap], dtype=np.float32)
-                bead.coords = coord_func(ref_coords, coords, cgframe.box, bmap.weights)
+        calc_strided = get_kernel("coords_weight_strided")
+        for start, nres, natoms, bead_offset, tables in self._runs:
+            nbeads = nres * len(tables[0])
+            cgframe.coords[bead_offset:bead_offset + nbeads] = calc_strided(frame.coords, cgframe.box,
+                                                                            start, nres, natoms, *tables)
 
         return cgframe
 
 
-@numba.jit
-def calc_coords_weight(ref_coords, coords, box, weights):
+@register("coords_weight", "numpy")
+def calc_coords_weight(coords, box, ref_index, atom_index, bead_index, bead_start, weights):
     """
-    Calculate the coordinates of a single CG bead from weighted component atom coordinates.
-
-    :param ref_coords: Coordinates of reference atom, usually first atom in bead
-    :param coords: Array of coordinates of component atoms
-    :param box: PBC box vectors
-    :param weights: Array of atom weights, must sum to 1
-    :return: Coordinates of CG bead
+    Calculate the coordinates of all CG beads from weighted component atom coordinates.
+
+    Component atoms are unwrapped by minimum image relative to the reference atom of their bead.
+
+    :param coords: Array of coordinates of all atoms in the atomistic Frame
+    :param box: PBC box vectors, periodicity is ignored if any are zero
+    :param ref_index: Index of the reference atom, usually first atom, for each bead
+    :param atom_index: Index of each component atom, grouped contiguously by bead
+    :param bead_index: Bead to which each component atom belongs
+    :param bead_start: Offset of the first component atom of each bead
+    :param weights: Array of atom weights, must sum to 1 within each bead
+    :return: Coordinates of CG beads
     """
-    vectors = coords - ref_coords
-    vectors -= box * np.rint(vectors / box)
-    result = np.sum(weights * vectors, axis=0)
+    ref_coords = coords[ref_index]
+    vectors = dist_with_pbc_many(ref_coords[bead_index], coords[atom_index], box)
+    vectors *= weights
+
+    result = np.add.reduceat(vectors, bead_start, axis=0)
     result += ref_coords
     return result
 
 
-@numba.jit
-def calc_coords_weight_nobox(ref_coords, coords, box, weights):
+@register("coords_weight_strided", "numpy")
+def calc_coords_weight_strided(coords, box, start, nres, natoms, ref_index, atom_index, bead_index, bead_start,
+                               weights):
     """
-    Calculate the coordinates of a single CG bead from weighted component atom coordinates.
-
-    :param ref_coords: Coordinates of reference atom, usually first atom in bead
-    :param coords: Array of coordinates of component atoms
-    :param box: PBC box vectors
-    :param weights: Array of atom weights, must sum to 1
-    :return: Coordinates of CG bead
+    Calculate the coordinates of CG beads from a run of identical consecutive residues.
+
+    The atoms of the run are viewed as an array of shape (nres, natoms, 3) and all residues are
+    mapped together, using indices and weights for a single residue.
+
+    :param coords: Array of coordinates of all atoms in the atomistic Frame
+    :param box: PBC box vectors, periodicity is ignored if any are zero
+    :param start: Index of the first atom of the run
+    :param nres: Number of residues in the run
+    :param natoms: Number of atoms in each residue
+    :param ref_index: Index within the residue of the reference atom for each bead
+    :param atom_index: Index within the residue of each component atom, grouped contiguously by bead
+    :param bead_index: Bead to which each component atom belongs
+    :param bead_start: Offset of the first component atom of each bead
+    :param weights: Array of atom weights, must sum to 1 within each bead
+    :return: Coordinates of CG beads, residue by residue
     """
-    vectors = coords - ref_coords
-    result = np.sum(weights * vectors, axis=0)
+    block = coords[start:start + nres * natoms].reshape(nres, natoms, 3)
+    ref_coords = block[:, ref_index]
+    if len(atom_index) != natoms or np.any(atom_index != np.arange(natoms)):
+        # Atoms are not each used once in order, so must be gathered
+        block = block[:, atom_index]
+    vectors = dist_with_pbc_many(ref_coords[:, bead_index], block, box)
+    vectors *= weights
+
+    # Sum component atoms in order, one at a time for all residues - reducing along the second axis
+    # with np.add.reduceat is many times slower
+    result = np.empty_like(ref_coords)
+    bead_stop = np.append(bead_start[1:], len(atom_index))
+    for bead, (first, stop) in enumerate(zip(bead_start.tolist(), bead_stop.tolist())):
+        total = result[:, bead]
+        total[:] = vectors[:, first]
+        for i in range(first + 1, stop):
+            total += vectors[:, i]
     result += ref_coords
-    return result
+    return result.reshape(-1, 3)
@@ -1,3 +1,4 @@
 from .cfg import CFG
+from .gro import GRO
 
-ITP = CFG
\ No newline at end of file
+ITP = CFG
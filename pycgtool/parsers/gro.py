@@ -0,0 +1,119 @@
+"""
+Module containing classes used to parse GROMACS GRO coordinate files.
+
+The atom records are parsed in bulk as fixed width columns, rather than one line at a time.
+"""
+
+import numpy as np
+
+
+class GRO:
+    """
+    Class representing a GROMACS GRO file.
+
+    Atom data is held in arrays with one entry per atom; residues are described by the index of their first atom.
+    """
+    __slots__ = ["filename", "name", "natoms", "resnums", "resnames", "atomnames", "coords", "box",
+                 "residue_starts"]
+
+    def __init__(self, filename):
+        """
+        Parse a GRO file.
+
+        :param filename: GRO file to read
+        """
+        self.filename = filename
+
+        with open(filename, "rb") as gro:
+            self.name = gro.readline().decode().strip()
+            try:
+                self.natoms = int(gro.readline())
+            except ValueError as e:
+                raise ValueError("File '{0}' is not a valid GRO file".format(filename)) from e
+
+            records = self._read_records(gro, self.natoms)
+            box_line = gro.readline().split()
+
+        self.box = np.array([float(x) for x in box_line[0:3]], dtype=np.float32)
+        self.coords = self._parse_coords(records)
+        self.resnums = self._column(records, 0, 5).astype(np.int64)
+        self.atomnames = self._text_column(records, 10, 15)
+
+        # A residue starts wherever the residue number changes - GROMACS wraps residue numbers
+        # after 99999, so they are not unique in large systems and must not be used as keys
+        self.residue_starts = np.flatnonzero(np.diff(self.resnums)) + 1
+        if self.natoms:
+            self.residue_starts = np.concatenate(([0], self.residue_starts))
+        self.resnames = self._text_column(records[self.residue_starts], 5, 10)
+
+    def __len__(self):
+        return len(self.residue_starts)
+
+    @staticmethod
+    def _read_records(gro, natoms):
+        """
+        Read atom records into a 2d array of characters, one row per atom.
+
+        If all records are the same length, as written by GROMACS, they are read in a single block.
+
+        :param gro: GRO file object, positioned at the first atom record
+        :param natoms: Number of atom records to read
+        :return: Numpy array of uint8 of shape (natoms, record length)
+        """
+        start = gro.tell()
+        first = gro.readline()
+        width = len(first)
+        gro.seek(start)
+
+        block = gro.read(width * natoms)
+        records = np.frombuffer(block, dtype=np.uint8)
+        if len(block) == width * natoms:
+            records = records.reshape(natoms, width)
+            if np.all(records[:, -1] == ord("\n")):
+                return records
+
+        # Records have different lengths - read them one at a time
+        gro.seek(start)
+        lines = [gro.readline().rstrip(b"\r\n") for _ in range(natoms)]
+        if natoms and not lines[-1]:
+            raise ValueError("GRO file '{0}' contains fewer atoms than declared".format(gro.name))
+        width = max(44, max((len(line) for line in lines), default=0))
+        records = np.array(lines, dtype="S{0}".format(width))
+        return records.view(np.uint8).reshape(natoms, width)
+
+    @staticmethod
+    def _column(records, start, stop):
+        """
+        Return a fixed width column of the atom records as an array of byte strings.
+        """
+        return np.ascontiguousarray(records[:, start:stop]).view("S{0}".format(stop - start)).ravel()
+
+    @classmethod
+    def _text_column(cls, records, start, stop):
+        """
+        Return a fixed width column of the atom records as an array of stripped strings.
+        """
+        return np.char.decode(np.char.strip(cls._column(records, start, stop)))
+
+    @classmethod
+    def _parse_coords(cls, records):
+        """
+        Parse atom coordinates from their columns.
+
+        The width of each coordinate is the distance between decimal points, so files written
+        with greater precision than the default of three decimal places are also supported.
+
+        :param records: Array of atom records
+        :return: Numpy array of coordinates of shape (natoms, 3)
+        """
+        width = 8
+        if len(records):
+            points = np.flatnonzero(records[0, 20:] == ord("."))
+            if len(points) >= 2:
+                width = int(points[1] - points[0])
+
+        coords = np.empty((len(records), 3), dtype=np.float32)
+        for i in range(3):
+            start = 20 + i * width
+            coords[:, i] = cls._column(records, start, start + width).astype(np.float32)
+        return coords
@@ -5,11 +5,27 @@ from .mapping import Mapping
 from .bondset import BondSet
 from .forcefield import ForceField
 from .interface import Progress
+from .kernels import backends, lazy_kernels
+from .util import Timer, compile_kernels
 
 logger = logging.getLogger(__name__)
 
 
-def main(args, config):
+def _frame_window(args):
+    """
+    Collect the selection of trajectory frames to read from program arguments.
+
+    :param args: Program arguments
+    :return: Dictionary of keyword arguments to Frame
+    """
+    return {"frame_start": args.begin,
+            "frame_end": None if args.end == -1 else args.end,
+            "stride": args.stride,
+            "time_start": args.begin_time,
+            "time_end": args.end_time}
+
+
+def main(args, config, timer=None):
     """
     Main function of the program PyCGTOOL.
 
@@ -17,28 +33,45 @@ def main(args, config):
 
     :param args: Arguments from argparse
     :param config: Configuration dictionary
+    :param timer: Timer with which to record time taken by each stage
     """
-    frame = Frame(gro=args.gro, xtc=args.xtc, itp=args.itp, frame_start=args.begin)
+    if timer is None:
+        timer = Timer()
+    if args.jit_background:
+        compile_kernels(lazy_kernels(), background=True)
+    selection = None
 
     if args.bnd:
         logger.info("Bond measurements will be made")
         bonds = BondSet(args.bnd, config)
+        # Residues of any name may be linked to by '+' or '-', so all must be read
+        if not bonds.links_residues:
+            selection = set(bonds)
     else:
         logger.info("Bond measurements will not be made")
 
     if args.map:
         logger.info("Mapping will be performed")
         mapping = Mapping(args.map, config, itp=args.itp)
+        # Bonds are measured on the CG frame, so only mapped residues need to be read
+        selection = set(mapping)
+    else:
+        logger.info("Mapping will not be performed")
+
+    frame = Frame(gro=args.gro, xtc=args.xtc, itp=args.itp, prefetch=args.prefetch,
+                  selection=selection, cache=args.cache, **_frame_window(args))
+
+    if args.map:
         cgframe = mapping.apply(frame)
         cgframe.output(config.output_name + ".gro", format=config.output)
     else:
-        logger.info("Mapping will not be performed")
         cgframe = frame
 
     # Only measure bonds from GRO frame if no XTC is provided
     # Allows the user to get a topology from a single snapshot
     if args.bnd and args.xtc is None:
         bonds.apply(cgframe)
+    timer.lap("Read input")
 
     # Main loop - perform mapping and measurement on every frame in XTC
     def main_loop():
@@ -55,9 +88,13 @@ def main(args, config):
             bonds.apply(cgframe)
         return True
 
-    numframes = frame.numframes - args.begin if args.end == -1 else args.end - args.begin
+    numframes = frame.numframes_selected
     logger.info("Beginning analysis of {0} frames".format(numframes))
     Progress(numframes, dowhile=main_loop, quiet=args.quiet).run()
+    if args.map:
+        cgframe.close_xtc()
+    frame.close()
+    timer.lap("Process frames")
 
     if args.bnd:
         if args.map:
@@ -73,17 +110,25 @@ def main(args, config):
         if config.dump_measurements:
             logger.info("Dumping bond measurements to file")
             bonds.dump_values(config.dump_n_values)
+    timer.lap("Write output")
 
 
-def map_only(args, config):
+def map_only(args, config, timer=None):
     """
     Perform AA->CG mapping and output coordinate file.
 
     :param args: Program arguments
     :param config: Object containing run options
+    :param timer: Timer with which to record time taken by each stage
     """
-    frame = Frame(gro=args.gro, xtc=args.xtc)
+    if timer is None:
+        timer = Timer()
+    if args.jit_background:
+        compile_kernels(lazy_kernels(), background=True)
     mapping = Mapping(args.map, config)
+    frame = Frame(gro=args.gro, xtc=args.xtc, prefetch=args.prefetch,
+                  selection=set(mapping), cache=args.cache, **_frame_window(args))
+    timer.lap("Read input")
     cgframe = mapping.apply(frame)
     cgframe.output(config.output_name + ".gro", format=config.output)
 
@@ -97,7 +142,18 @@ def map_only(args, config):
             cgframe.write_xtc(config.output_name + ".xtc")
             return True
 
-        numframes = frame.numframes - args.begin if args.end == -1 else args.end - args.begin
+        numframes = frame.numframes_selected
         logger.info("Beginning analysis of {0} frames".format(numframes))
         its = Progress(numframes, dowhile=main_loop, quiet=args.quiet).run()
+        cgframe.close_xtc()
+    frame.close()
+    timer.lap("Process frames")
 
+
+def warmup():
+    """
+    Compile the numba kernels used by each backend so that they are loaded from numba's cache by later runs.
+
+    :return: Number of kernels compiled by numba, zero if numba is not installed
+    """
+    return compile_kernels(kernel for backend in backends for kernel in lazy_kernels(backend))
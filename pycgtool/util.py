@@ -3,6 +3,11 @@ This module contains some general purpose utility functions used in PyCGTOOL.
 """
 
 import os
+import time
+import operator
+import types
+import functools
+import threading
 import itertools
 import random
 import math
@@ -17,41 +22,147 @@ import numpy as np
 logger = logging.getLogger(__name__)
 
 
-class NumbaDummy:
+# Loops over prange are run in parallel by functions compiled with lazy_jit(parallel=True)
+prange = range
+
+
+class LazyJit:
     """
-    Dummy Numba module
+    Function which is compiled with numba.jit the first time it is called.
+
+    Numba is not imported until a compiled function is needed, so that it does not slow down program startup.
+    If numba is not installed, or compilation fails, the original Python function is used.
+    It is also used, with a warning, for arguments which do not match the compiled signature.
+    Compiled functions are cached on disk by numba, so later processes only need to load them.
     """
-    def __getattr__(self, item):
-        if item == "jit":
-            return NumbaDummy.jit
-        return self
+    # All lazily compiled functions, so that they may be compiled in advance by compile_kernels
+    instances = []
+    # Held while compiling - compilation may be happening on a background thread
+    _compile_lock = threading.RLock()
+    # Start of the message of the TypeError raised by numba when arguments match no compiled signature
+    _dispatch_error = "No matching definition for argument type(s)"
 
-    def __getitem__(self, item):
-        return self
+    def __init__(self, func, *jit_args, **jit_kwargs):
+        """
+        Wrap a function to be compiled when first called.
 
-    def __call__(self, *args, **kwargs):
-        return None
+        :param func: Function to compile
+        :param jit_args: Positional arguments to numba.jit, e.g. a signature
+        :param jit_kwargs: Keyword arguments to numba.jit, on-disk caching is enabled unless cache=False is given
+        """
+        functools.update_wrapper(self, func)
+        self.py_func = func
+        self._jit_args = jit_args
+        self._jit_kwargs = dict(jit_kwargs)
+        self._jit_kwargs.setdefault("cache", True)
+        self._compiled = None
+        # Numba errors raised when calling the compiled function - set on compilation
+        self._errors = ()
+        self._warned_dispatch = False
+        LazyJit.instances.append(self)
 
-    @staticmethod
-    def jit(*args, **kwargs):
+    def __call__(self, *args, **kwargs):
+        try:
+            return self.compiled(*args, **kwargs)
+        except self._errors as e:
+            # Functions compiled without a signature are not typed until first called
+            logger.warning("Numba compilation of {0} failed, using Python version: {1}".format(self.__name__, e))
+            self._compiled = self.py_func
+            return self.py_func(*args, **kwargs)
+        except TypeError as e:
+            # Arguments do not match the compiled signature, e.g. float64 arrays
+            if self._compiled is self.py_func or not str(e).startswith(self._dispatch_error):
+                raise
+            if not self._warned_dispatch:
+                logger.warning("Arguments to {0} do not match its compiled signature, "
+                               "using Python version: {1}".format(self.__name__, e))
+                self._warned_dispatch = True
+            return self.py_func(*args, **kwargs)
+
+    @property
+    def compiled(self):
         """
-        Dummy version of numba.jit decorator, does nothing
+        Return the compiled function, compiling it if necessary.
         """
-        if len(args) == 1 and callable(args[0]):
-            return args[0]
-        else:
-            def wrap(func):
-                return func
-            return wrap
+        if self._compiled is None:
+            with LazyJit._compile_lock:
+                if self._compiled is None:
+                    self._compiled = self._compile()
+        return self._compiled
 
-try:
-    import numba
-except ImportError:
-    # If numba isn't installed, create dummy so we don't get NameErrors
-    numba = NumbaDummy()
+    def _compile(self):
+        try:
+            import numba
+        except ImportError:
+            return self.py_func
+
+        # Other lazily compiled functions called from this one must be replaced by their compiled versions
+        func = self.py_func
+        func_globals = func.__globals__
+        names = func.__code__.co_names
+        parallel = self._jit_kwargs.get("parallel", False)
+        if parallel or any(isinstance(func_globals.get(name), LazyJit) for name in names):
+            func_globals = dict(func_globals)
+            for name in names:
+                if isinstance(func_globals.get(name), LazyJit):
+                    func_globals[name] = func_globals[name].compiled
+            if parallel:
+                func_globals["prange"] = numba.prange
+            func = types.FunctionType(func.__code__, func_globals, func.__name__, func.__defaults__, func.__closure__)
+            if parallel:
+                # Serial and parallel versions of the same function must be cached separately
+                func.__qualname__ = self.py_func.__qualname__ + "_parallel"
+
+        self._errors = numba.core.errors.NumbaError
+        try:
+            return numba.jit(*self._jit_args, **self._jit_kwargs)(func)
+        except Exception as e:
+            logger.warning("Numba compilation of {0} failed, using Python version: {1}".format(func.__name__, e))
+            return self.py_func
 
 
-@numba.jit(numba.float32[3](numba.float32[3], numba.float32[3]))
+def lazy_jit(*args, **kwargs):
+    """
+    Decorator to compile a function with numba.jit when it is first called - see LazyJit.
+
+    May be used with or without arguments, which are passed to numba.jit.
+    """
+    if len(args) == 1 and callable(args[0]) and not kwargs:
+        return LazyJit(args[0])
+
+    def wrap(func):
+        return LazyJit(func, *args, **kwargs)
+    return wrap
+
+
+def compile_kernels(kernels=None, background=False):
+    """
+    Compile functions decorated with lazy_jit, loading them from numba's on-disk cache if possible.
+
+    :param kernels: Functions to compile, all functions decorated with lazy_jit if None
+    :param background: Compile on a background thread and return immediately
+    :return: Thread performing compilation if background is True, else number of functions compiled by numba
+    """
+    def compile_all(kernels):
+        return sum(kernel.compiled is not kernel.py_func for kernel in kernels)
+
+    if kernels is None:
+        kernels = LazyJit.instances
+    kernels = list(kernels)
+
+    if background:
+        # Loading numba's parallel threading layer from a background thread can hang at interpreter exit,
+        # so parallel functions are left to be compiled on first use
+        kernels = [kernel for kernel in kernels if not kernel._jit_kwargs.get("parallel", False)]
+        thread = threading.Thread(target=compile_all, args=(kernels,), daemon=True)
+        thread.start()
+        return thread
+    return compile_all(kernels)
+
+
+# Functions of single vectors are not used when processing frames, which is done by the batched functions below
+# and by the kernels module, so they are compiled on first call rather than in advance by warmup
+@lazy_jit("float32[:](float32[:], float32[:])")
 def vector_cross(u, v):
     """
     Return vector cross product of two 3d vectors as numpy array.
@@ -67,7 +178,7 @@ def vector_cross(u, v):
     return res
 
 
-@numba.jit(numba.float32(numba.float32[3], numba.float32[3]))
+@lazy_jit("float32(float32[:], float32[:])")
 def vector_dot(u, v):
     """
     Return vector dot product of two 3d vectors.
@@ -79,12 +190,12 @@ def vector_dot(u, v):
     return u[0]*v[0] + u[1]*v[1] + u[2]*v[2]
 
 
-@numba.jit(numba.float32(numba.float32[3]))
+@lazy_jit("float32(float32[:])")
 def vector_len(v):
     return math.sqrt(v[0]*v[0] + v[1]*v[1] + v[2]*v[2])
 
 
-@numba.jit(numba.float32(numba.float32[3], numba.float32[3]))
+@lazy_jit("float32(float32[:], float32[:])")
 def vector_angle(a, b):
     """
     Calculate the angle between two vectors.
@@ -102,8 +213,8 @@ def vector_angle(a, b):
     return ang
 
 
-@numba.jit
-def vector_angle_signed(a, b, ref=np.array([0., 0., 1.])):
+@lazy_jit("float32(float32[:], float32[:], float32[:])")
+def vector_angle_signed(a, b, ref=np.array([0., 0., 1.], dtype=np.float32)):
     """
     Calculate the signed angle between two vectors.
 
@@ -117,6 +228,71 @@ def vector_angle_signed(a, b, ref=np.array([0., 0., 1.])):
     return ang * signum
 
 
+def vector_cross_many(u, v):
+    """
+    Return vector cross products of each pair of 3d vectors in two arrays.
+
+    :param u: Array of first vectors, shape (n, 3)
+    :param v: Array of second vectors, shape (n, 3)
+    :return: Array of cross products, shape (n, 3)
+    """
+    return np.cross(u, v)
+
+
+def vector_dot_many(u, v):
+    """
+    Return vector dot products of each pair of 3d vectors in two arrays.
+
+    :param u: Array of first vectors, shape (n, 3)
+    :param v: Array of second vectors, shape (n, 3)
+    :return: Array of dot products, shape (n,)
+    """
+    return np.sum(u * v, axis=-1)
+
+
+def vector_len_many(v, dtype=None):
+    """
+    Return lengths of each 3d vector in an array.
+
+    :param v: Array of vectors, shape (n, 3)
+    :param dtype: Numpy dtype in which to calculate the square root, defaults to that of v
+    :return: Array of lengths, shape (n,)
+    """
+    return np.sqrt(np.sum(v * v, axis=-1), dtype=dtype)
+
+
+def vector_angle_many(a, b):
+    """
+    Calculate the angles between each pair of vectors in two arrays.
+
+    :param a: Array of first vectors, shape (n, 3)
+    :param b: Array of second vectors, shape (n, 3)
+    :return: Array of angles in radians, shape (n,)
+    :raises ZeroDivisionError: If any vector has length zero, second arg is the index of the first such pair
+    """
+    mag = vector_len_many(a, dtype=np.float64) * vector_len_many(b, dtype=np.float64)
+    zero = np.flatnonzero(mag == 0)
+    if len(zero):
+        raise ZeroDivisionError("One or more bonds in angle calculation has length zero", zero[0])
+    dot = vector_dot_many(a, b) / mag
+    return np.arccos(np.clip(dot, -1, 1))
+
+
+def vector_angle_signed_many(a, b, ref=np.array([0., 0., 1.], dtype=np.float32)):
+    """
+    Calculate the signed angles between each pair of vectors in two arrays.
+
+    :param a: Array of first vectors, shape (n, 3)
+    :param b: Array of second vectors, shape (n, 3)
+    :param ref: Reference vector, or array of one per pair, will use global z-axis if not provided
+    :return: Array of signed angles in radians, shape (n,)
+    :raises ZeroDivisionError: If any vector has length zero, second arg is the index of the first such pair
+    """
+    ang = vector_angle_many(a, b)
+    signum = np.copysign(1, vector_dot_many(vector_cross_many(a, b), ref))
+    return ang * signum
+
+
 def tuple_equivalent(tuple1, tuple2):
     """
     Check if two node tuples are equivalent. Assumes undirected edges.
@@ -133,7 +309,8 @@ def tuple_equivalent(tuple1, tuple2):
         return False
 
 
-@numba.jit
+@lazy_jit(["float32[:](float32[:], float32[:], float32[:])",
+           "float64[:](float64[:], float64[:], float64[:])"])
 def dist_with_pbc(pos1, pos2, box):
     """
     Calculate the distance between two points accounting for periodicity.
@@ -149,6 +326,29 @@ def dist_with_pbc(pos1, pos2, box):
     return d
 
 
+def dist_with_pbc_many(pos1, pos2, box):
+    """
+    Calculate the minimum image vectors between each pair of points in two arrays.
+
+    Boxes must broadcast to the shape of the positions, so a single box, one per pair of points, or one per
+    frame of shape (nframes, 1, 3) for positions of shape (nframes, n, 3) may be given.  Periodicity is ignored for any box with a zero vector.
+
+    :param pos1: Array of first positions, shape (..., 3)
+    :param pos2: Array of second positions, shape (..., 3)
+    :param box: Cubic box vectors, shape (..., 3)
+    :return: Array of vectors between points, shape (..., 3)
+    """
+    d = pos2 - pos1
+    box = np.asarray(box)
+    periodic = np.all(box != 0, axis=-1, keepdims=True)
+    if periodic.all():
+        d -= box * np.rint(d / box)
+    elif periodic.any():
+        box = np.where(periodic, box, 1)
+        d -= np.where(periodic, box * np.rint(d / box), 0)
+    return d
+
+
 def extend_graph_chain(extend, pairs):
     """
     Take list of tuples representing chained links in an undirected graph and extend the chain length.
@@ -210,6 +410,153 @@ def stat_moments(vals, ignore_nan=True):
         return 0., 0.
 
 
+class GrowableArray:
+    """
+    One dimensional numpy array which may be efficiently appended to.
+
+    Storage is preallocated and grows geometrically as values are added, so appending a batch of values
+    is amortised O(1) per value without the overhead of boxing each value as a Python float.
+    """
+    __slots__ = ["_data", "_len"]
+
+    def __init__(self, dtype=np.float64, capacity=64):
+        """
+        Create an empty array.
+
+        :param dtype: Numpy dtype of stored values
+        :param int capacity: Number of values for which to preallocate storage
+        """
+        self._data = np.empty(capacity, dtype=dtype)
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return iter(self.array)
+
+    def __getitem__(self, item):
+        return self.array[item]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(self.array, dtype=dtype)
+
+    def __repr__(self):
+        return "GrowableArray({0})".format(self.array)
+
+    @property
+    def array(self):
+        """
+        Numpy view of the values stored so far.
+        """
+        return self._data[:self._len]
+
+    @property
+    def dtype(self):
+        return self._data.dtype
+
+    def _reserve(self, n):
+        """
+        Ensure that there is space to store n values in total, reallocating if required.
+
+        :param int n: Total number of values to store
+        """
+        if n > len(self._data):
+            capacity = max(n, 2 * len(self._data))
+            data = np.empty(capacity, dtype=self._data.dtype)
+            data[:self._len] = self._data[:self._len]
+            self._data = data
+
+    def append(self, val):
+        """
+        Add a single value to the end of the array.
+
+        :param val: Value to add
+        """
+        self._reserve(self._len + 1)
+        self._data[self._len] = val
+        self._len += 1
+
+    def extend(self, vals):
+        """
+        Add a batch of values to the end of the array.
+
+        :param vals: Iterable of values to add
+        """
+        vals = np.asarray(vals)
+        self._reserve(self._len + len(vals))
+        self._data[self._len:self._len + len(vals)] = vals
+        self._len += len(vals)
+
+
+class RunningMoments:
+    """
+    Accumulate the count, mean and variance of a stream of values using constant memory.
+
+    Batches of values are merged using the pairwise algorithm of Chan et al.  Non-finite values are ignored.
+
+    If periodic, values are angles in radians and are measured relative to a reference angle fixed by the
+    first batch, wrapped into the range +-pi.  This gives the same result as the plain moments for
+    distributions which do not cross the reference +-pi, but handles distributions spanning the
+    +-pi boundary correctly.
+    """
+    __slots__ = ["count", "_mean", "_m2", "_periodic", "_ref"]
+
+    def __init__(self, periodic=False):
+        """
+        Create an empty accumulator.
+
+        :param periodic: Are values angles in radians with period 2pi?
+        """
+        self.count = 0
+        self._mean = 0.
+        self._m2 = 0.
+        self._periodic = periodic
+        self._ref = None
+
+    def update(self, vals):
+        """
+        Add a batch of values to the accumulator.
+
+        :param vals: Iterable of values to add
+        """
+        vals = np.asarray(vals, dtype=np.float64)
+        vals = vals[np.isfinite(vals)]
+        if not len(vals):
+            return
+
+        if self._periodic:
+            if self._ref is None:
+                self._ref = math.atan2(np.mean(np.sin(vals)), np.mean(np.cos(vals)))
+            vals = np.mod(vals - self._ref + math.pi, 2 * math.pi) - math.pi
+
+        count = len(vals)
+        mean = np.mean(vals)
+        m2 = np.sum((vals - mean) ** 2)
+
+        total = self.count + count
+        delta = mean - self._mean
+        self._mean += delta * count / total
+        self._m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+
+    @property
+    def mean(self):
+        """
+        Mean of values seen so far.  For periodic values this is wrapped into the range +-pi.
+        """
+        if self._periodic and self._ref is not None:
+            return (self._mean + self._ref + math.pi) % (2 * math.pi) - math.pi
+        return self._mean
+
+    @property
+    def var(self):
+        """
+        Population variance of values seen so far.
+        """
+        return np.float64(self._m2 / self.count) if self.count else np.float64(0.)
+
+
 def transpose_and_sample(sequence, n=None):
     """
     Transpose a sequence of lists and sample to provide target number of rows.
@@ -457,6 +804,30 @@ class FixedFormatUnpacker(object):
                           self.FormatStyle.Fortran: self._parse_fortran_format}
         clean_format_string = self._clean_format_string(format_string)
         self._format_items = format_parsers[format_style](clean_format_string)
+        self._compile()
+
+    def _compile(self):
+        """
+        Precompute the column slices and conversions, so that each line is unpacked without walking the format.
+        """
+        self._width = sum(item.width for item in self._format_items)
+        self._fields = []
+        start = 0
+        for item in self._format_items:
+            if item.type is not None:
+                self._fields.append((start, start + item.width, item.type))
+            start += item.width
+
+        self._types = [field_type for _, _, field_type in self._fields]
+        slices = [slice(start, stop) for start, stop, _ in self._fields]
+        if not slices:
+            # itemgetter requires at least one item
+            self._getter = lambda string: ()
+        elif len(slices) == 1:
+            # itemgetter with a single item does not return a tuple
+            self._getter = lambda string, field=slices[0]: (string[field],)
+        else:
+            self._getter = operator.itemgetter(*slices)
 
     @staticmethod
     def _clean_format_string(format_string):
@@ -496,15 +867,78 @@ class FixedFormatUnpacker(object):
         return items
 
     def unpack(self, string):
-        items = []
-        start = 0
-        for format_item in self._format_items:
-            string_part = string[start:start+format_item.width]
-            start += format_item.width
-            if format_item.type is not None:
-                items.append(format_item.type(string_part.strip()))
-        return items
+        """
+        Unpack a single line.
+
+        :param string: Line to unpack
+        :return: List of values, one for each item in the format which is not skipped
+        """
+        return [field_type(part.strip()) for field_type, part in zip(self._types, self._getter(string))]
+
+    def unpack_many(self, lines):
+        """
+        Unpack many lines at once into columns.
+
+        Lines are copied into a single array of fixed width strings, from which each column is converted in bulk.
+
+        :param lines: Iterable of lines to unpack, str or bytes
+        :return: List of numpy arrays, one for each item in the format which is not skipped
+        """
+        lines = list(lines)
+        # Lines longer than the format are truncated when copied into the array
+        kind = "S" if lines and isinstance(lines[0], bytes) else "U"
+        records = np.array(lines, dtype="{0}{1}".format(kind, self._width))
+        chars = records.view(kind + "1").reshape(len(records), self._width)
+
+        columns = []
+        for start, stop, field_type in self._fields:
+            column = np.ascontiguousarray(chars[:, start:stop]).view("{0}{1}".format(kind, stop - start)).ravel()
+            if field_type is not str:
+                columns.append(column.astype(field_type))
+            elif kind == "S":
+                columns.append(np.char.decode(np.char.strip(column)))
+            else:
+                columns.append(np.char.strip(column))
+        return columns
 
 
 def tqdm_dummy(iterable, **kwargs):
     return iterable
+
+
+class Timer:
+    """
+    Record the time taken by successive stages of a program.
+    """
+    def __init__(self, start=None):
+        """
+        Create Timer starting from a given time.
+
+        :param start: Value of time.perf_counter at which the first stage began, default now
+        """
+        self._start = time.perf_counter() if start is None else start
+        self._last = self._start
+        self.stages = []
+
+    def lap(self, name):
+        """
+        Mark the end of a stage.
+
+        :param name: Name of stage which has just finished
+        :return: Time taken by stage in seconds
+        """
+        now = time.perf_counter()
+        self.stages.append((name, now - self._last))
+        self._last = now
+        return self.stages[-1][1]
+
+    def report(self):
+        """
+        Return a table of the time taken by each stage.
+
+        :return: Report as a string
+        """
+        width = max([len(name) for name, _ in self.stages] + [5])
+        lines = ["{0:<{width}} {1:8.3f} s".format(name, taken, width=width) for name, taken in self.stages]
+        lines.append("{0:<{width}} {1:8.3f} s".format("Total", self._last - self._start, width=width))
+        return "\n".join(lines)
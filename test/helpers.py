@@ -0,0 +1,19 @@
+"""
+Functions shared between test modules.
+"""
+
+import glob
+import os
+
+from pycgtool.framereader import frame_offsets_filename
+
+
+def remove_frame_offsets():
+    """
+    Remove frame offset indices written next to the test trajectories.
+    """
+    for xtc in glob.glob("test/data/*.xtc"):
+        try:
+            os.remove(frame_offsets_filename(xtc))
+        except OSError:
+            pass
@@ -1,13 +1,19 @@
 import unittest
+import os
 
 import logging
 import math
+import tempfile
 
-from pycgtool.bondset import BondSet
+import numpy as np
+
+from pycgtool.bondset import BondSet, calc_lengths, calc_angles, calc_dihedrals
 from pycgtool.frame import Frame
 from pycgtool.mapping import Mapping
 from pycgtool.util import cmp_whitespace_float
 
+from .helpers import remove_frame_offsets
+
 try:
     import mdtraj
     mdtraj_present = True
@@ -71,6 +77,26 @@ class BondSetTest(unittest.TestCase):
         self.assertAlmostEqual(expected, measure["ALLA"][12].values[0],
                                delta=abs(expected) / 500)
 
+    def test_calc_bonds_batched(self):
+        coords = np.array([[0., 0., 0.],
+                           [1., 0., 0.],
+                           [1., 1., 0.],
+                           [1., 1., 1.],
+                           [1., 1., -1.]], dtype=np.float32)
+        box = np.zeros(3, dtype=np.float32)
+
+        np.testing.assert_allclose([1., 1.], calc_lengths(coords, np.array([[0, 1], [1, 2]]), box))
+        np.testing.assert_allclose([math.pi / 2], calc_angles(coords, np.array([[0, 1, 2]]), box))
+        np.testing.assert_allclose([math.pi / 2, -math.pi / 2],
+                                   calc_dihedrals(coords, np.array([[0, 1, 2, 3], [0, 1, 2, 4]]), box))
+
+        # Periodic images are used when a box is provided
+        box = np.array([1.5, 1.5, 1.5], dtype=np.float32)
+        np.testing.assert_allclose([0.5], calc_lengths(coords, np.array([[2, 4]]), box))
+
+        with self.assertRaises(ZeroDivisionError):
+            calc_angles(coords, np.array([[0, 1, 2], [0, 0, 2]]), np.zeros(3, dtype=np.float32))
+
     def test_bondset_remove_triangles(self):
         bondset = BondSet("test/data/triangle.bnd", DummyOptions)
         angles = bondset.get_bond_angles("TRI", exclude_triangle=False)
@@ -103,6 +129,23 @@ class BondSetTest(unittest.TestCase):
         measure.boltzmann_invert()
         self.support_check_mean_fc(measure["ALLA"], 1)
 
+    def test_bondset_boltzmann_invert_without_values(self):
+        class NoDumpOptions(DummyOptions):
+            dump_measurements = False
+
+        measure = BondSet("test/data/sugar.bnd", NoDumpOptions)
+        frame = Frame("test/data/sugar.gro", xtc="test/data/sugar.xtc")
+        mapping = Mapping("test/data/sugar.map", DummyOptions)
+
+        cgframe = mapping.apply(frame)
+        while frame.next_frame():
+            cgframe = mapping.apply(frame, cgframe=cgframe)
+            measure.apply(cgframe)
+
+        self.assertEqual(0, len(measure["ALLA"][0].values))
+        measure.boltzmann_invert()
+        self.support_check_mean_fc(measure["ALLA"], 1)
+
     def test_bondset_boltzmann_invert_default_fc(self):
         class DefaultOptions(DummyOptions):
             default_fc = True
@@ -169,6 +212,28 @@ class BondSetTest(unittest.TestCase):
         self.assertAlmostEqual(0.107, bondset["ETH"][1].eqm,
                                delta=0.107 / 500)
 
+    def test_bondset_polymer_selection_gap(self):
+        bondset = BondSet("test/data/polyethene.bnd", DummyOptions)
+        self.assertTrue(bondset.links_residues)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Unselected residue in the middle of the chain must not be bridged by links
+            gro = os.path.join(tmpdir, "polyethene.gro")
+            with open("test/data/polyethene.gro") as f:
+                lines = f.readlines()
+            for i in (6, 7):
+                lines[i] = lines[i].replace("ETH", "GAP")
+            with open(gro, "w") as f:
+                f.writelines(lines)
+
+            frame = Frame(gro, selection={"ETH"})
+        bondset.apply(frame)
+        self.assertEqual(4, len(bondset["ETH"][0].values))
+        self.assertEqual(2, len(bondset["ETH"][1].values))
+        self.assertEqual(2, len(bondset["ETH"][2].values))
+        self.assertEqual(2, len(bondset["ETH"][3].values))
+        for value in bondset["ETH"][1].values:
+            self.assertAlmostEqual(0.107, value, delta=0.002)
+
     def test_bondset_pbc(self):
         bondset = BondSet("test/data/polyethene.bnd", DummyOptions)
         frame = Frame("test/data/pbcpolyethene.gro")
@@ -199,3 +264,7 @@ class BondSetTest(unittest.TestCase):
     def test_duplicate_atoms_in_bond(self):
         with self.assertRaises(ValueError):
             bondset = BondSet("test/data/duplicate_atoms.bnd", DummyOptions)
+
+
+def tearDownModule():
+    remove_frame_offsets()
@@ -1,13 +1,23 @@
 import unittest
+import unittest.mock
 import filecmp
 import os
 import logging
+import shutil
+import subprocess
+import sys
+import tempfile
 
 import numpy as np
 
-from pycgtool.frame import Atom, Residue, Frame
+from pycgtool.frame import Atom, Residue, ResidueTemplate, Frame
 from pycgtool.framereader import FrameReaderSimpleTraj, FrameReaderMDAnalysis, FrameReaderMDTraj
-from pycgtool.framereader import FrameReader, get_frame_reader, UnsupportedFormatException
+from pycgtool.framereader import FrameReader, FrameReaderPrefetch, get_frame_reader, UnsupportedFormatException
+from pycgtool.framereader import FrameReaderConcat, FrameReaderCached, select_frame_reader
+from pycgtool.framereader import load_frame_offsets, frame_offsets_filename
+from pycgtool.framewriter import FrameWriterXTC, FrameWriterGRO
+
+from .helpers import remove_frame_offsets
 
 try:
     import mdtraj
@@ -53,8 +63,61 @@ class ResidueTest(unittest.TestCase):
         self.assertEqual(atom, residue.atoms[0])
         self.assertTrue(atom is residue.atoms[0])
 
+    def test_residue_template(self):
+        template = ResidueTemplate("SOL", [Atom("OW", 0, type="OW"), Atom("HW1", 1), Atom("HW2", 2)])
+        residue = Residue(num=1, template=template)
+        residue.coords = np.arange(9, dtype=np.float32).reshape(3, 3)
+        self.assertEqual("SOL", residue.name)
+        self.assertEqual(3, len(residue))
+        self.assertEqual(("OW", "HW1", "HW2"), residue.atom_names)
+        self.assertEqual("OW", residue["OW"].type)
+        np.testing.assert_array_equal([3, 4, 5], residue["HW1"].coords)
+        np.testing.assert_array_equal([6, 7, 8], residue[2].coords)
+
+    def test_residue_template_read_only(self):
+        template = ResidueTemplate("SOL", [Atom("OW", 0, mass=16), Atom("HW1", 1), Atom("HW2", 2)])
+        residue = Residue(num=1, template=template)
+        residue.coords = np.zeros((3, 3), dtype=np.float32)
+        with self.assertRaises(AttributeError):
+            residue["OW"].mass = 15
+        with self.assertRaises(AttributeError):
+            residue.atoms[1].coords = np.ones(3)
+        self.assertEqual(16, residue["OW"].mass)
+
+        residue["HW1"].coords[:] = 1
+        np.testing.assert_array_equal([1, 1, 1], residue.coords[1])
+
+    def test_residue_template_add_atom(self):
+        template = ResidueTemplate("SOL", [Atom("OW", 0)])
+        residue = Residue(template=template)
+        residue.add_atom(Atom("HW1", 1))
+        self.assertIsNone(residue.template)
+        self.assertEqual(("OW", "HW1"), residue.atom_names)
+        self.assertEqual(1, len(template))
+
+        residue["OW"].mass = 16
+        self.assertEqual(16, residue["OW"].mass)
+        self.assertIsNone(template.atoms[0].mass)
+
 
 class FrameTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+
+    def copy_to_tmpdir(self, filename, name):
+        """
+        Copy a test file into this test's temporary directory.
+
+        :param filename: File to copy
+        :param name: Name of the copy
+        :return: Path of the copy
+        """
+        path = os.path.join(self.tmpdir, name)
+        shutil.copy(filename, path)
+        return path
+
     def helper_read_xtc(self, frame, first_only=False, skip_names=False):
         self.assertEqual(663, frame.natoms)
         self.assertEqual(221, len(frame.residues))
@@ -90,6 +153,22 @@ class FrameTest(unittest.TestCase):
         self.assertEqual(residue, frame.residues[0])
         self.assertTrue(residue is frame.residues[0])
 
+    def test_frame_add_residue_repack(self):
+        frame = Frame()
+        for i in range(2):
+            residue = Residue(name="SOL", num=i)
+            residue.add_atom(Atom(name="OW", num=0, coords=np.full(3, i, dtype=np.float32)))
+            frame.add_residue(residue)
+        # Coordinates are packed on first use, without calling pack_coords
+        np.testing.assert_array_equal([[0, 0, 0], [1, 1, 1]], frame.coords)
+        self.assertTrue(np.shares_memory(frame.coords, frame[1]["OW"].coords))
+
+        residue = Residue(name="SOL", num=2)
+        residue.add_atom(Atom(name="OW", num=0, coords=np.full(3, 2, dtype=np.float32)))
+        frame.add_residue(residue)
+        np.testing.assert_array_equal([0, 1, 2], frame.residue_starts)
+        np.testing.assert_array_equal([[0, 0, 0], [1, 1, 1], [2, 2, 2]], frame.coords)
+
     def test_frame_simpletraj_read_gro(self):
         frame = Frame("test/data/water.gro", xtc_reader="simpletraj")
 
@@ -128,6 +207,57 @@ class FrameTest(unittest.TestCase):
         with self.assertRaises(UnsupportedFormatException):
             reader = get_frame_reader("test/data/dppc.map")
 
+    def test_frame_select_reader(self):
+        self.assertEqual("simpletraj", select_frame_reader("test/data/water.gro"))
+        self.assertEqual("simpletraj", select_frame_reader("test/data/water.gro", "test/data/water.xtc"))
+        self.assertIn(select_frame_reader("test/data/water.gro", "test/data/water.xtc", probe=True),
+                      ("simpletraj", "mdanalysis"))
+        if mdanalysis_present:
+            # MDTraj is not chosen automatically as it renames residues
+            self.assertEqual("mdanalysis", select_frame_reader("test/data/water.pdb"))
+
+        with self.assertRaises(UnsupportedFormatException):
+            select_frame_reader("test/data/water.gro", "test/data/water.map")
+
+    def test_frame_reader_extensions(self):
+        # Readers which seek within NetCDF trajectories accept all of its extensions
+        for ext in (".nc", ".ncdf", ".netcdf"):
+            self.assertTrue(FrameReaderSimpleTraj.supports(".gro", ext))
+            self.assertTrue(FrameReaderMDTraj.supports(".gro", ext))
+
+        xtc = self.copy_to_tmpdir("test/data/water.xtc", "WATER.XTC")
+        readers = ["simpletraj"]
+        if mdtraj_present:
+            readers.append("mdtraj")
+        if mdanalysis_present:
+            readers.append("mdanalysis")
+        for reader in readers:
+            logging.disable(logging.WARNING)
+            frame = Frame(gro="test/data/water.gro", xtc=xtc, xtc_reader=reader)
+            logging.disable(logging.NOTSET)
+            self.helper_read_xtc(frame, skip_names=True)
+
+    def test_frame_select_reader_fastest(self):
+        frame = Frame("test/data/water.gro", xtc="test/data/water.xtc", xtc_reader="fastest")
+        self.assertIsInstance(frame._trajreader, (FrameReaderSimpleTraj, FrameReaderMDAnalysis))
+        self.helper_read_xtc(frame)
+
+    @unittest.skipIf(not mdanalysis_present, "MDAnalysis not present")
+    def test_frame_select_reader_fastest_failure(self):
+        xtc = self.copy_to_tmpdir("test/data/water.xtc", "water.xtc")
+        with unittest.mock.patch.dict("pycgtool.framereader._reader_throughput_cache", clear=True), \
+                unittest.mock.patch.object(FrameReaderSimpleTraj, "_read_frame_number", side_effect=OSError):
+            self.assertEqual("mdanalysis", select_frame_reader("test/data/water.gro", xtc, probe=True))
+
+    def test_frame_select_reader_header(self):
+        xtc = self.copy_to_tmpdir("test/data/water.gro", "water.xtc")
+        with self.assertRaises(UnsupportedFormatException):
+            get_frame_reader("test/data/water.gro", xtc)
+
+    def test_frame_select_reader_invalid_name(self):
+        with self.assertRaises(KeyError):
+            get_frame_reader("test/data/water.gro", name="invalid")
+
     @unittest.skipIf(not mdanalysis_present, "MDAnalysis not present")
     def test_frame_mdanalysis_read_pdb(self):
         reader = FrameReaderMDAnalysis("test/data/water.pdb")
@@ -141,6 +271,68 @@ class FrameTest(unittest.TestCase):
         self.assertTrue(filecmp.cmp("test/data/water.gro", "water-out.gro"))
         os.remove("water-out.gro")
 
+    def test_frame_writer_gro_frames(self):
+        frame = Frame(gro="test/data/water.gro", xtc="test/data/water.xtc")
+        with FrameWriterGRO("water-out.gro") as writer:
+            while frame.next_frame():
+                writer.write(frame)
+        self.assertEqual(frame.numframes, writer.num_frames)
+
+        with open("water-out.gro") as f:
+            lines = f.readlines()
+        os.remove("water-out.gro")
+        self.assertEqual(frame.numframes * (frame.natoms + 3), len(lines))
+
+        # Last frame written
+        last = lines[-(frame.natoms + 3):]
+        self.assertEqual(frame.natoms, int(last[1]))
+        np.testing.assert_allclose(frame.coords[0], [float(x) for x in last[2][20:].split()], atol=1e-3)
+        np.testing.assert_allclose(frame.box, [float(x) for x in last[-1].split()], atol=1e-5)
+
+    def test_frame_output_unpacked(self):
+        frame = Frame()
+        frame.name = "Built"
+        for i in range(2):
+            residue = Residue(name="SOL", num=i + 1)
+            residue.add_atom(Atom(name="OW", num=0, coords=np.full(3, i, dtype=np.float32)))
+            frame.add_residue(residue)
+
+        gro = os.path.join(self.tmpdir, "built.gro")
+        frame.output(gro, format="gro")
+        # Residue added after the coordinates were packed for the first output
+        residue = Residue(name="SOL", num=3)
+        residue.add_atom(Atom(name="OW", num=0, coords=np.full(3, 2, dtype=np.float32)))
+        frame.add_residue(residue)
+        frame.output(gro, format="gro")
+        with open(gro) as f:
+            lines = f.readlines()
+
+        xtc = os.path.join(self.tmpdir, "built.xtc")
+        frame.write_xtc(xtc)
+        frame.close_xtc()
+        written = Frame(gro=gro, xtc=xtc)
+        self.assertEqual(1, written.numframes)
+
+        self.assertEqual("    3\n", lines[1])
+        self.assertEqual("    3SOL     OW    3   2.000   2.000   2.000\n", lines[4])
+
+    def test_frame_writer_gro_wrap(self):
+        frame = Frame()
+        frame.name = "Wrapped"
+        for num in (99999, 100000):
+            residue = Residue(name="SOL", num=num)
+            residue.add_atom(Atom(name="OW", num=0, coords=np.zeros(3)))
+            frame.add_residue(residue)
+        frame.natoms = 2
+        frame.pack_coords()
+
+        frame.output("wrap-out.gro", format="gro")
+        with open("wrap-out.gro") as f:
+            lines = f.readlines()
+        os.remove("wrap-out.gro")
+        self.assertEqual("99999SOL     OW    1   0.000   0.000   0.000\n", lines[2])
+        self.assertEqual("    0SOL     OW    2   0.000   0.000   0.000\n", lines[3])
+
     def test_frame_read_xtc_simpletraj_numframes(self):
         frame = Frame(gro="test/data/water.gro", xtc="test/data/water.xtc",
                       xtc_reader="simpletraj")
@@ -176,19 +368,265 @@ class FrameTest(unittest.TestCase):
         self.helper_read_xtc(frame)
 
     @unittest.skipIf(not mdtraj_present, "MDTraj or Scipy not present")
-    def test_frame_write_xtc_mdtraj(self):
-        try:
-            os.remove("water_test2.xtc")
-        except IOError:
-            pass
+    def test_frame_mdtraj_read_xtc_chunked(self):
+        class SmallChunkReader(FrameReaderMDTraj):
+            chunk_size = 4
 
+        logging.disable(logging.WARNING)
+        reader = SmallChunkReader("test/data/water.gro", "test/data/water.xtc")
+        logging.disable(logging.NOTSET)
+        frame = Frame.instance_from_reader(reader)
+        self.assertEqual(11, reader.num_frames)
+
+        times = []
+        while frame.next_frame():
+            times.append(frame.time)
+        np.testing.assert_allclose(np.arange(11), times)
+
+        # Seek backwards to a frame in an earlier chunk
+        self.assertTrue(reader.read_frame_number(5, frame))
+        self.assertEqual(5, frame.time)
+        self.assertFalse(reader.read_frame_number(11, frame))
+
+    @unittest.skipIf(not mdanalysis_present, "MDAnalysis not present")
+    def test_frame_mdanalysis_read_xtc_seek(self):
+        reader = FrameReaderMDAnalysis("test/data/water.gro", "test/data/water.xtc")
+        frame = Frame.instance_from_reader(reader)
+
+        times = []
+        while frame.next_frame():
+            times.append(frame.time)
+        np.testing.assert_allclose(np.arange(11), times)
+
+        self.assertTrue(reader.read_frame_number(3, frame))
+        self.assertEqual(3, frame.time)
+        self.assertTrue(reader.read_frame_number(4, frame))
+        self.assertEqual(4, frame.time)
+        self.assertFalse(reader.read_frame_number(11, frame))
+
+    @unittest.skipIf(not mdtraj_present, "MDTraj or Scipy not present")
+    def test_frame_write_xtc_mdtraj(self):
         logging.disable(logging.WARNING)
         frame = Frame(gro="test/data/water.gro", xtc="test/data/water.xtc",
                       xtc_reader="mdtraj")
         logging.disable(logging.NOTSET)
 
+        xtc = os.path.join(self.tmpdir, "water_test2.xtc")
         while frame.next_frame():
-            frame.write_xtc("water_test2.xtc")
+            frame.write_xtc(xtc)
+        frame.close_xtc()
+
+        written = Frame(gro="test/data/water.gro", xtc=xtc, xtc_reader="mdtraj")
+        reference = Frame(gro="test/data/water.gro", xtc="test/data/water.xtc", xtc_reader="mdtraj")
+        self.assertEqual(reference.numframes, written.numframes)
+        while reference.next_frame():
+            self.assertTrue(written.next_frame())
+            self.assertEqual(reference.time, written.time)
+            np.testing.assert_allclose(reference.coords, written.coords, atol=1e-3)
+            np.testing.assert_allclose(reference.box, written.box, atol=1e-3)
+
+    @unittest.skipIf(not mdtraj_present, "MDTraj or Scipy not present")
+    def test_frame_writer_xtc_blocks(self):
+        frame = Frame(gro="test/data/water.gro", xtc="test/data/water.xtc")
+        xtc = os.path.join(self.tmpdir, "water_test3.xtc")
+        writer = FrameWriterXTC(xtc, frame.natoms, block_size=3)
+        while frame.next_frame():
+            writer.write(frame)
+        writer.close()
+        writer.close()
+
+        written = Frame(gro="test/data/water.gro", xtc=xtc)
+        self.assertEqual(frame.numframes, written.numframes)
+        self.assertEqual(frame.numframes, writer.num_frames)
+
+    @unittest.skipIf(not mdtraj_present, "MDTraj or Scipy not present")
+    def test_frame_writer_xtc_error(self):
+        frame = Frame(gro="test/data/water.gro", xtc="test/data/water.xtc")
+        frame.next_frame()
+        # Only the first block fails, but no later blocks may be written after it
+        with unittest.mock.patch("mdtraj.formats.XTCTrajectoryFile") as xtc_file:
+            write = xtc_file.return_value.write
+            write.side_effect = [OSError("disk full")] + [None] * 10
+            writer = FrameWriterXTC(os.path.join(self.tmpdir, "water_test4.xtc"), frame.natoms, block_size=1)
+        writer.write(frame)
+        with self.assertRaises(OSError):
+            for _ in range(10):
+                writer.write(frame)
+            writer.close()
+        with self.assertRaises(OSError):
+            writer.write(frame)
+        with self.assertRaises(OSError):
+            writer.close()
+        with self.assertRaises(OSError):
+            writer.close()
+        self.assertEqual(1, write.call_count)
+
+    @unittest.skipIf(not mdtraj_present, "MDTraj not present")
+    def test_frame_write_xtc_at_exit(self):
+        xtc = os.path.join(self.tmpdir, "out.xtc")
+        # Frame is still alive when the interpreter exits, without calling close_xtc
+        script = "\n".join(["from pycgtool.frame import Frame",
+                             "frame = Frame(gro='test/data/water.gro', xtc='test/data/water.xtc')",
+                             "while frame.next_frame():",
+                             "    frame.write_xtc({0!r})".format(xtc)])
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.getcwd(),
+                                                                        os.environ.get("PYTHONPATH")])))
+        subprocess.check_call([sys.executable, "-c", script], env=env)
+
+        written = Frame(gro="test/data/water.gro", xtc=xtc)
+        self.assertEqual(11, written.numframes)
+
+    def test_frame_prefetch_window_end(self):
+        reader = FrameReaderSimpleTraj("test/data/water.gro", "test/data/water.xtc")
+        decoded = []
+        read_into = reader._read_into
+
+        def counted_read_into(number, coords):
+            decoded.append(number)
+            return read_into(number, coords)
+
+        reader._read_into = counted_read_into
+        prefetch = FrameReaderPrefetch(reader, depth=8)
+        frame = Frame.instance_from_reader(prefetch)
+        prefetch.set_window(0, 3)
+        self.assertEqual([0, 1, 2], self.helper_read_window(frame))
+        prefetch.close()
+        self.assertEqual([0, 1, 2], decoded)
+
+        time, coords, box = prefetch._read_frame_number(2)
+        self.assertAlmostEqual(2, time)
+        np.testing.assert_allclose(frame.coords, coords / prefetch._coords_divisor)
+
+    def test_frame_prefetch_read_xtc(self):
+        frame = Frame(gro="test/data/water.gro", xtc="test/data/water.xtc", prefetch=2)
+        self.assertIsInstance(frame._trajreader, FrameReaderPrefetch)
+        self.helper_read_xtc(frame)
+
+        reference = Frame(gro="test/data/water.gro", xtc="test/data/water.xtc")
+        while reference.next_frame():
+            self.assertTrue(frame._trajreader.read_frame_number(reference.number, frame))
+            np.testing.assert_array_equal(reference.coords, frame.coords)
+            np.testing.assert_array_equal(reference.box, frame.box)
+        self.assertFalse(frame._trajreader.read_frame_number(11, frame))
+
+        # Seeking restarts the background thread
+        self.assertTrue(frame._trajreader.read_frame_number(1, frame))
+        self.assertEqual(1, frame.time)
+        frame._trajreader.close()
+
+    def helper_read_window(self, frame):
+        times = []
+        numbers = []
+        while frame.next_frame():
+            times.append(frame.time)
+            numbers.append(frame.number)
+        np.testing.assert_allclose(numbers, times)  # Frames are 1ps apart
+        return numbers
+
+    def test_frame_read_xtc_stride(self):
+        frame = Frame(gro="test/data/water.gro", xtc="test/data/water.xtc", stride=3)
+        self.assertEqual(4, frame.numframes_selected)
+        self.assertEqual([0, 3, 6, 9], self.helper_read_window(frame))
+
+        frame = Frame(gro="test/data/water.gro", xtc="test/data/water.xtc", frame_start=1, frame_end=8, stride=2)
+        self.assertEqual(4, frame.numframes_selected)
+        self.assertEqual([1, 3, 5, 7], self.helper_read_window(frame))
+
+    def test_frame_read_xtc_time_window(self):
+        frame = Frame(gro="test/data/water.gro", xtc="test/data/water.xtc",
+                      time_start=2, time_end=7, stride=2)
+        self.assertEqual(3, frame.numframes_selected)
+        self.assertEqual([2, 4, 6], self.helper_read_window(frame))
+
+        frame = Frame(gro="test/data/water.gro", xtc="test/data/water.xtc", time_start=8.5, prefetch=2)
+        self.assertEqual(2, frame.numframes_selected)
+        self.assertEqual([9, 10], self.helper_read_window(frame))
+
+    @unittest.skipIf(not mdtraj_present, "MDTraj or Scipy not present")
+    def test_frame_read_xtc_time_window_uneven(self):
+        logging.disable(logging.WARNING)
+        readers = ["simpletraj", "mdtraj"]
+        if mdanalysis_present:
+            readers.append("mdanalysis")
+
+        for times, expected in (([0., 1., 5., 6., 20.], [2, 3]),
+                                ([3., 3., 3., 3., 3.], [])):
+            xtc = os.path.join(self.tmpdir, "uneven{0}.xtc".format(int(times[1])))
+            xyz = np.zeros((len(times), 663, 3), dtype=np.float32)
+            with mdtraj.formats.XTCTrajectoryFile(xtc, mode="w") as f:
+                f.write(xyz, time=np.array(times, dtype=np.float32),
+                        box=np.tile(np.eye(3, dtype=np.float32), (len(times), 1, 1)))
+
+            for reader in readers:
+                frame = Frame(gro="test/data/water.gro", xtc=xtc, xtc_reader=reader,
+                              time_start=4, time_end=6)
+                numbers = []
+                while frame.next_frame():
+                    numbers.append(frame.number)
+                self.assertEqual(expected, numbers)
+        logging.disable(logging.NOTSET)
+
+    @unittest.skipIf(not mdtraj_present, "MDTraj or Scipy not present")
+    def test_frame_mdtraj_read_xtc_stride(self):
+        logging.disable(logging.WARNING)
+        reader = FrameReaderMDTraj("test/data/water.gro", "test/data/water.xtc")
+        logging.disable(logging.NOTSET)
+        frame = Frame.instance_from_reader(reader)
+        reader.set_window(1, None, 3)
+        self.assertEqual(4, reader.num_frames_in_window())
+        self.assertEqual([1, 4, 7, 10], self.helper_read_window(frame))
+
+    @unittest.skipIf(not mdanalysis_present, "MDAnalysis not present")
+    def test_frame_mdanalysis_read_xtc_stride(self):
+        reader = FrameReaderMDAnalysis("test/data/water.gro", "test/data/water.xtc")
+        frame = Frame.instance_from_reader(reader)
+        reader.set_window(reader.frame_number_at_time(5), None, 2)
+        self.assertEqual([5, 7, 9], self.helper_read_window(frame))
+
+    def test_frame_coords_views(self):
+        frame = Frame(gro="test/data/water.gro", xtc="test/data/water.xtc")
+        self.assertEqual((663, 3), frame.coords.shape)
+        self.assertEqual(np.float32, frame.coords.dtype)
+
+        atom = frame.residues[1].atoms[2]
+        frame.next_frame()
+        self.assertTrue(np.shares_memory(frame.coords, atom.coords))
+        self.assertTrue(np.shares_memory(frame.coords, frame.residues[1].coords))
+        np.testing.assert_array_equal(frame.coords[5], atom.coords)
+        np.testing.assert_array_equal(frame.coords[3:6], frame.residues[1].coords)
+
+    def test_frame_residue_templates(self):
+        frame = Frame("test/data/water.gro")
+        self.assertEqual(1, len({id(res.template) for res in frame}))
+        self.assertTrue(frame[0].template is frame.residue_template("SOL", ["OW", "HW1", "HW2"]))
+
+        atom = frame[1]["OW"]
+        self.assertTrue(np.shares_memory(atom.coords, frame.coords))
+        np.testing.assert_array_equal(frame.coords[3], atom.coords)
+
+    def test_frame_itp_templates(self):
+        frame = Frame("test/data/two.gro", itp="test/data/two.itp")
+        self.assertEqual("C", frame[0]["C2"].type)
+        self.assertEqual(1, frame[0]["C2"].mass)
+        self.assertEqual("C", frame[0].template.atoms[1].type)
+
+    def test_frame_resname_index(self):
+        frame = Frame()
+        for i, (name, natoms) in enumerate([("A", 2), ("B", 1), ("A", 2), ("C", 3)]):
+            residue = Residue(name=name, num=i)
+            for j in range(natoms):
+                residue.add_atom(Atom(name=str(j), num=j))
+            frame.add_residue(residue)
+        frame.pack_coords()
+
+        np.testing.assert_array_equal([0, 2], frame.resname_index["A"])
+        np.testing.assert_array_equal([0, 2, 3, 5], frame.residue_starts)
+        np.testing.assert_array_equal([0, 2, 3], frame.residue_positions(["C", "A", "D"]))
+        self.assertEqual([0, 2, 3], [res.num for res in frame.yield_resname_in({"A", "C"})])
+
+        # Index is rebuilt when residues are added
+        frame.add_residue(Residue(name="B", num=4))
+        np.testing.assert_array_equal([1, 4], frame.resname_index["B"])
 
     def test_frame_instance_from_reader(self):
         reader = FrameReaderSimpleTraj("test/data/water.gro")
@@ -217,6 +655,252 @@ class FrameTest(unittest.TestCase):
         self.assertEqual(frame.number, 1)
         self.assertEqual(frame.time, 10)
 
+    def test_frame_read_selection(self):
+        full = Frame(gro="test/data/sugar-cg.gro")
+        frame = Frame(gro="test/data/sugar-cg.gro", selection={"ALLA"})
+        self.assertEqual(1, len(frame))
+        self.assertEqual(6, frame.natoms)
+        self.assertEqual((6, 3), frame.coords.shape)
+        np.testing.assert_array_equal(full.coords[:6], frame.coords)
+
+        frame = Frame(gro="test/data/sugar-cg.gro", selection={"SOL"})
+        self.assertEqual(1207, frame.natoms)
+        np.testing.assert_array_equal(full.coords[6:], frame.coords)
+
+    @unittest.skipIf(not mdtraj_present, "MDTraj not present")
+    def test_frame_mdtraj_read_selection(self):
+        frame = Frame.instance_from_reader(FrameReaderMDTraj("test/data/sugar-cg.gro"))
+        reader = FrameReaderMDTraj("test/data/sugar-cg.gro")
+        subset = Frame()
+        reader.initialise_frame(subset, selection={"ALLA"})
+        self.assertEqual(6, subset.natoms)
+
+        self.assertTrue(reader.read_frame_number(0, subset))
+        np.testing.assert_allclose(frame.coords[:6], subset.coords)
+
+    @unittest.skipIf(not mdanalysis_present, "MDAnalysis not present")
+    def test_frame_mdanalysis_read_selection(self):
+        frame = Frame.instance_from_reader(FrameReaderMDAnalysis("test/data/sugar-cg.gro"))
+        reader = FrameReaderMDAnalysis("test/data/sugar-cg.gro")
+        subset = Frame()
+        reader.initialise_frame(subset, selection={"SOL"})
+        self.assertEqual(1207, subset.natoms)
+
+        self.assertTrue(reader.read_frame_number(0, subset))
+        np.testing.assert_allclose(frame.coords[6:], subset.coords)
+
+    def test_frame_read_selection_all(self):
+        frame = Frame(gro="test/data/water.gro", xtc="test/data/water.xtc", selection={"SOL"})
+        self.assertIsNone(frame._trajreader._atom_index)
+        self.helper_read_xtc(frame)
+
+    def test_frame_read_selection_dummy(self):
+        class DummyReader(FrameReader):
+            _coords_divisor = 10
+
+            def _initialise_frame(self, frame):
+                for i, name in enumerate(["A", "B", "A"]):
+                    residue = Residue(name=name, num=i)
+                    residue.add_atom(Atom(name="X", num=0, coords=np.zeros(3)))
+                    residue.add_atom(Atom(name="Y", num=1, coords=np.zeros(3)))
+                    frame.residues.append(residue)
+                frame.natoms = self.num_atoms = 6
+
+            def _read_frame_number(self, number):
+                return number, np.arange(18, dtype=np.float32).reshape(6, 3), None
+
+        frame = Frame()
+        frame._trajreader = DummyReader(None)
+        frame._trajreader.initialise_frame(frame, selection={"A"})
+        self.assertEqual(2, len(frame))
+        self.assertEqual(4, frame.natoms)
+
+        frame.next_frame()
+        np.testing.assert_allclose(np.arange(18).reshape(6, 3)[[0, 1, 4, 5]] / 10, frame.coords)
+        np.testing.assert_allclose([1.2, 1.3, 1.4], frame.residues[1].atoms[0].coords)
+
+    def test_frame_offset_index(self):
+        xtc = self.copy_to_tmpdir("test/data/water.xtc", "water.xtc")
+        index = frame_offsets_filename(xtc)
+        self.assertFalse(os.path.isfile(index))
+
+        offsets = load_frame_offsets(xtc, lambda: [0, 10, 20])
+        self.assertTrue(os.path.isfile(index))
+        np.testing.assert_array_equal([0, 10, 20], offsets)
+
+        def fail():
+            raise AssertionError("Index was not used")
+        np.testing.assert_array_equal([0, 10, 20], load_frame_offsets(xtc, fail))
+
+        # Index is rebuilt if the trajectory changes
+        stat = os.stat(xtc)
+        os.utime(xtc, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        np.testing.assert_array_equal([0, 30], load_frame_offsets(xtc, lambda: [0, 30]))
+
+    def test_frame_offset_index_readers(self):
+        readers = [FrameReaderSimpleTraj]
+        if mdtraj_present:
+            readers.append(FrameReaderMDTraj)
+        if mdanalysis_present:
+            readers.append(FrameReaderMDAnalysis)
+
+        xtc = self.copy_to_tmpdir("test/data/water.xtc", "water.xtc")
+
+        FrameReaderSimpleTraj("test/data/water.gro", xtc)
+        with np.load(frame_offsets_filename(xtc)) as index:
+            offsets = index["offsets"]
+        self.assertEqual(11, len(offsets))
+
+        for reader in readers:
+            frame = Frame.instance_from_reader(reader("test/data/water.gro", xtc))
+            self.assertEqual(11, frame._trajreader.num_frames)
+            self.assertTrue(frame._trajreader.read_frame_number(7, frame))
+            self.assertAlmostEqual(7, frame.time)
+            self.assertFalse(frame._trajreader.read_frame_number(11, frame))
+
+    def test_frame_read_xtc_concat(self):
+        frame = Frame(gro="test/data/water.gro", xtc=["test/data/water.xtc", "test/data/water.xtc"])
+        self.assertIsInstance(frame._trajreader, FrameReaderConcat)
+        self.assertEqual(22, frame.numframes)
+        self.assertEqual(22, frame.numframes_selected)
+
+        reference = Frame(gro="test/data/water.gro", xtc="test/data/water.xtc")
+        reference.next_frame()
+
+        times = []
+        while frame.next_frame():
+            times.append(frame.time)
+            if frame.number == 10:
+                self.assertEqual(0, frame._trajreader._part)
+            if frame.number == 11:
+                self.assertEqual(1, frame._trajreader._part)
+                np.testing.assert_array_equal(reference.coords, frame.coords)
+        self.assertEqual(list(range(11)) * 2, times)
+
+    def test_frame_read_xtc_concat_lazy(self):
+        xtcs = [self.copy_to_tmpdir("test/data/water.xtc", "water{0}.xtc".format(i)) for i in range(3)]
+
+        opened = []
+        init = FrameReaderSimpleTraj.__init__
+
+        def counting_init(reader, topname, trajname=None, frame_start=0):
+            opened.append(trajname)
+            init(reader, topname, trajname, frame_start)
+
+        with unittest.mock.patch.object(FrameReaderSimpleTraj, "__init__", counting_init):
+            reader = get_frame_reader("test/data/water.gro", xtcs, name="simpletraj")
+            self.assertEqual(33, reader.num_frames)
+            self.assertEqual(xtcs[:1], opened)
+
+            frame = Frame.instance_from_reader(reader)
+            self.assertTrue(reader.read_frame_number(25, frame))
+            self.assertEqual([xtcs[0], xtcs[2]], opened)
+
+    def test_frame_read_xtc_concat_single(self):
+        frame = Frame(gro="test/data/water.gro", xtc=["test/data/water.xtc"])
+        self.assertNotIsInstance(frame._trajreader, FrameReaderConcat)
+        self.helper_read_xtc(frame)
+
+    def helper_read_concat_stride(self, name):
+        reader = get_frame_reader("test/data/water.gro", ["test/data/water.xtc"] * 3, name=name)
+        self.assertIsInstance(reader._reader, type(get_frame_reader("test/data/water.gro", name=name)))
+        frame = Frame.instance_from_reader(reader)
+        reader.set_window(2, 30, 4)
+
+        numbers = []
+        while frame.next_frame():
+            numbers.append(frame.number)
+            self.assertAlmostEqual(frame.number % 11, frame.time)
+        self.assertEqual(list(range(2, 30, 4)), numbers)
+
+    def test_frame_simpletraj_read_xtc_concat_stride(self):
+        self.helper_read_concat_stride("simpletraj")
+
+    @unittest.skipIf(not mdtraj_present, "MDTraj not present")
+    def test_frame_mdtraj_read_xtc_concat_stride(self):
+        self.helper_read_concat_stride("mdtraj")
+
+    @unittest.skipIf(not mdanalysis_present, "MDAnalysis not present")
+    def test_frame_mdanalysis_read_xtc_concat_stride(self):
+        self.helper_read_concat_stride("mdanalysis")
+
+    def helper_read_cached(self, cache):
+        xtc = self.copy_to_tmpdir("test/data/water.xtc", "water.xtc")
+
+        frame = Frame(gro="test/data/water.gro", xtc=xtc, cache=cache)
+        self.assertIsInstance(frame._trajreader, FrameReaderCached)
+        self.helper_read_xtc(frame)
+        while frame.next_frame():
+            pass
+        frame._trajreader.close()
+        self.assertTrue(os.path.isdir(FrameReaderCached.cache_dirname(xtc)))
+
+        # Second run reads only from the cache
+        frame = Frame(gro="test/data/water.gro", xtc=xtc, cache=cache)
+        frame._trajreader._reader = None
+        reference = Frame(gro="test/data/water.gro", xtc="test/data/water.xtc")
+        while reference.next_frame():
+            self.assertTrue(frame.next_frame())
+            self.assertEqual(reference.time, frame.time)
+            np.testing.assert_array_equal(reference.coords, frame.coords)
+            np.testing.assert_array_equal(reference.box, frame.box)
+        self.assertFalse(frame.next_frame())
+
+        # Cache is rebuilt if the trajectory changes
+        stat = os.stat(xtc)
+        os.utime(xtc, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        frame = Frame(gro="test/data/water.gro", xtc=xtc, cache=cache)
+        self.assertFalse(frame._trajreader._cache["filled"].any())
+        self.helper_read_xtc(frame)
+
+    def test_frame_read_xtc_cached_selected(self):
+        self.helper_read_cached("selected")
+
+    def test_frame_read_xtc_cached_all(self):
+        self.helper_read_cached("all")
+
+    def test_frame_read_xtc_cached_unwritable(self):
+        # First residue is not selected, so the selection must be applied
+        gro = os.path.join(self.tmpdir, "water.gro")
+        with open("test/data/water.gro") as f:
+            lines = f.readlines()
+        for i in range(2, 5):
+            lines[i] = lines[i][:5] + "ION  " + lines[i][10:]
+        with open(gro, "w") as f:
+            f.writelines(lines)
+        xtc = self.copy_to_tmpdir("test/data/water.xtc", "water.xtc")
+
+        reference = Frame(gro=gro, xtc=xtc, selection={"SOL"})
+        for cache in ("selected", "all"):
+            with unittest.mock.patch("numpy.lib.format.open_memmap", side_effect=OSError):
+                frame = Frame(gro=gro, xtc=xtc, selection={"SOL"}, cache=cache)
+            self.assertIsNone(frame._trajreader._cache)
+
+            reference.next_frame()
+            frame.next_frame()
+            self.assertEqual(660, frame.natoms)
+            np.testing.assert_array_equal(reference.coords, frame.coords)
+            reference._trajreader.set_window()
+
+    def test_frame_close_cached_prefetch(self):
+        xtc = self.copy_to_tmpdir("test/data/water.xtc", "water.xtc")
+        frame = Frame(gro="test/data/water.gro", xtc=xtc, cache="all", prefetch=2)
+        frame.next_frame()
+        with unittest.mock.patch.object(FrameReaderCached, "close", autospec=True) as close:
+            frame.close()
+        close.assert_called_once()
+        self.assertIsNone(frame._trajreader._thread)
+
+    def test_frame_read_xtc_cached_prefetch(self):
+        xtc = self.copy_to_tmpdir("test/data/water.xtc", "water.xtc")
+        frame = Frame(gro="test/data/water.gro", xtc=xtc, cache="all", prefetch=2, stride=3)
+        self.assertEqual([0, 3, 6, 9], self.helper_read_window(frame))
+        frame._trajreader.close()
+
+
+def tearDownModule():
+    remove_frame_offsets()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+import importlib.util
+
+import numpy as np
+
+from pycgtool.kernels import KernelRegistry, get_kernel, set_backend, lazy_kernels
+from pycgtool.frame import Frame
+from pycgtool.mapping import Mapping
+
+
+class DummyOptions:
+    map_center = "geom"
+
+
+numba_missing = importlib.util.find_spec("numba") is None
+
+
+class KernelTest(unittest.TestCase):
+    def tearDown(self):
+        set_backend("auto")
+
+    def test_registry_fallback(self):
+        registry = KernelRegistry()
+
+        @registry.register("double", "numpy")
+        def double(a):
+            return 2 * a
+
+        registry._backend = "numba-parallel"
+        self.assertIs(double, registry.get("double"))
+        with self.assertRaises(KeyError):
+            registry.get("triple")
+        with self.assertRaises(ValueError):
+            registry.register("double", "fortran")
+
+    def test_set_backend_invalid(self):
+        with self.assertRaises(ValueError):
+            set_backend("fortran")
+
+    def test_lazy_kernels_numpy(self):
+        set_backend("numpy")
+        self.assertEqual([], lazy_kernels())
+
+    @unittest.skipIf(numba_missing, "Numba is not installed")
+    def test_lazy_kernels_backend(self):
+        set_backend("numba")
+        serial = lazy_kernels()
+        self.assertTrue(serial)
+        self.assertFalse(any(kernel._jit_kwargs.get("parallel", False) for kernel in serial))
+        self.assertTrue(all(kernel._jit_kwargs["parallel"] for kernel in lazy_kernels("numba-parallel")))
+
+    @unittest.skipIf(numba_missing, "Numba is not installed")
+    def test_backends_bonds(self):
+        rng = np.random.RandomState(0)
+        coords = rng.uniform(0, 3, (50, 3)).astype(np.float32)
+        box = np.array([3, 3, 3], dtype=np.float32)
+
+        for name, natoms in (("bond_lengths", 2), ("bond_angles", 3), ("bond_dihedrals", 4)):
+            table = np.array([rng.choice(len(coords), natoms, replace=False) for _ in range(20)])
+            set_backend("numpy")
+            ref = get_kernel(name)(coords, table, box)
+            for backend in ("numba", "numba-parallel"):
+                set_backend(backend)
+                np.testing.assert_allclose(ref, get_kernel(name)(coords, table, box), rtol=1e-4, atol=1e-5)
+
+    @unittest.skipIf(numba_missing, "Numba is not installed")
+    def test_backends_zero_length(self):
+        coords = np.array([[0, 0, 0], [0, 0, 0], [1, 0, 0]], dtype=np.float32)
+        table = np.array([[2, 0, 1]])
+        box = np.zeros(3, dtype=np.float32)
+        for backend in ("numpy", "numba", "numba-parallel"):
+            set_backend(backend)
+            with self.assertRaises(ZeroDivisionError) as cm:
+                get_kernel("bond_angles")(coords, table, box)
+            self.assertEqual(0, cm.exception.args[1])
+
+    @unittest.skipIf(numba_missing, "Numba is not installed")
+    def test_backends_mapping(self):
+        for map_file, gro_file in (("test/data/sugar.map", "test/data/sugar.gro"),
+                                   ("test/data/water.map", "test/data/water.gro")):
+            mapping = Mapping(map_file, DummyOptions)
+            frame = Frame(gro_file)
+            set_backend("numpy")
+            ref = mapping.apply(frame).coords
+            for backend in ("numba", "numba-parallel"):
+                set_backend(backend)
+                np.testing.assert_array_equal(ref, mapping.apply(frame).coords)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,8 +4,10 @@ import os
 
 import numpy as np
 
-from pycgtool.mapping import Mapping
-from pycgtool.frame import Frame
+from pycgtool.mapping import Mapping, calc_coords_weight, calc_coords_weight_strided
+from pycgtool.frame import Atom, Residue, Frame
+
+from .helpers import remove_frame_offsets
 
 
 class DummyOptions:
@@ -79,5 +81,99 @@ class MappingTest(unittest.TestCase):
         cg = mapping.apply(frame)
         np.testing.assert_allclose(np.array([1., 1., 1.]), cg[0][0].coords)
 
+    def test_calc_coords_weight(self):
+        coords = np.array([[0.1, 0.1, 0.1],
+                           [1.9, 0.1, 0.1],
+                           [1., 1., 1.],
+                           [1.5, 1.5, 1.5]], dtype=np.float32)
+        weights = np.array([[0.5], [0.5], [1.], [0.5], [0.5]], dtype=np.float32)
+        ref_index = np.array([0, 2, 2])
+        atom_index = np.array([0, 1, 2, 2, 3])
+        bead_index = np.array([0, 0, 1, 2, 2])
+        bead_start = np.array([0, 2, 3])
+
+        box = np.array([2., 2., 2.], dtype=np.float32)
+        result = calc_coords_weight(coords, box, ref_index, atom_index, bead_index, bead_start, weights)
+        np.testing.assert_allclose(np.array([[0., 0.1, 0.1],
+                                             [1., 1., 1.],
+                                             [1.25, 1.25, 1.25]]), result, atol=1e-6)
+
+        box = np.zeros(3, dtype=np.float32)
+        result = calc_coords_weight(coords, box, ref_index, atom_index, bead_index, bead_start, weights)
+        np.testing.assert_allclose(np.array([1., 0.1, 0.1]), result[0], atol=1e-6)
+
+    def test_calc_coords_weight_strided(self):
+        coords = np.array([[0.9, 0.1, 0.1], [0.1, 0.1, 0.1], [2., 1., 1.], [2., 1., 3.]], dtype=np.float32)
+        box = np.array([1., 1., 1.], dtype=np.float32)
+        ref_index = np.array([0])
+        atom_index = np.array([0, 1])
+        bead_index = np.array([0, 0])
+        bead_start = np.array([0])
+        weights = np.array([[0.5], [0.5]], dtype=np.float32)
+
+        result = calc_coords_weight_strided(coords, box, 0, 2, 2, ref_index, atom_index, bead_index,
+                                            bead_start, weights)
+        np.testing.assert_allclose(np.array([[1., 0.1, 0.1], [2., 1., 1.]]), result, atol=1e-6)
+
+    def test_mapping_runs(self):
+        for map_file, gro_file in (("test/data/water.map", "test/data/water.gro"),
+                                   ("test/data/dppc.map", "test/data/dppc.gro")):
+            frame = Frame(gro_file)
+            mapping = Mapping(map_file, DummyOptions)
+            cgframe = mapping.apply(frame)
+            self.assertEqual(1, len(mapping._runs))
+            self.assertEqual(0, len(mapping._ref_index))
+
+            general = Mapping(map_file, DummyOptions)
+            general.min_run_length = len(frame) + 1
+            np.testing.assert_array_equal(general.apply(frame).coords, cgframe.coords)
+            self.assertEqual(0, len(general._runs))
+
+    def test_mapping_runs_irregular(self):
+        frame = Frame("test/data/water.gro")
+        mapping = Mapping("test/data/water.map", DummyOptions)
+        ref = mapping.apply(frame).coords
+
+        # Residue with a different atom order is mapped individually
+        res = frame[100]
+        reordered = Residue(name=res.name, num=res.num)
+        for i in (1, 0, 2):
+            reordered.add_atom(Atom(res.atom_names[i], i, coords=res.coords[i].copy()))
+        frame.residues[100] = reordered
+        frame.pack_coords()
+
+        mapping = Mapping("test/data/water.map", DummyOptions)
+        cgframe = mapping.apply(frame)
+        self.assertEqual(2, len(mapping._runs))
+        np.testing.assert_array_equal([100], mapping._general_beads)
+        np.testing.assert_array_equal(ref, cgframe.coords)
+
+    def test_mapping_apply_repeat(self):
+        mapping = Mapping("test/data/sugar.map", DummyOptions)
+        frame = Frame("test/data/sugar.gro", xtc="test/data/sugar.xtc")
+        cgframe = mapping.apply(frame)
+        frame.next_frame()
+        cgframe = mapping.apply(frame, cgframe=cgframe)
+
+        ref = mapping.apply(frame)
+        np.testing.assert_array_equal(ref.coords, cgframe.coords)
+        np.testing.assert_array_equal(cgframe.coords[4], cgframe[0][4].coords)
+
+    def test_mapping_apply_other_frame(self):
+        mapping = Mapping("test/data/water.map", DummyOptions)
+        cgframe = mapping.apply(Frame("test/data/water.gro"))
+
+        # Unmapped residue at the start shifts the atoms of every mapped residue
+        other = Frame("test/data/water.gro")
+        ion = Residue(name="ION", num=0)
+        ion.add_atom(Atom("NA", 0, coords=np.zeros(3)))
+        other.residues.insert(0, ion)
+        other.pack_coords()
+
+        cgframe = mapping.apply(other, cgframe=cgframe)
+        ref = Mapping("test/data/water.map", DummyOptions).apply(other)
+        np.testing.assert_array_equal(ref.coords, cgframe.coords)
 
 
+def tearDownModule():
+    remove_frame_offsets()
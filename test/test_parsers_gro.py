@@ -0,0 +1,88 @@
+import unittest
+import os
+import tempfile
+
+import numpy as np
+
+from pycgtool.parsers import GRO
+from pycgtool.util import FixedFormatUnpacker
+
+
+class TestParsersGRO(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_gro(self, lines):
+        filename = os.path.join(self.tmpdir.name, "test.gro")
+        with open(filename, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        return filename
+
+    def test_gro_read(self):
+        gro = GRO("test/data/sugar.gro")
+        self.assertEqual("Alpha-allose in water", gro.name)
+        self.assertEqual(gro.natoms, len(gro.coords))
+        np.testing.assert_allclose([3.74699, 3.74699, 2.67438], gro.box)
+
+        # Compare against reading one line at a time
+        unpacker = FixedFormatUnpacker("I5,2A5,5X,3F8", FixedFormatUnpacker.FormatStyle.Fortran)
+        with open("test/data/sugar.gro") as f:
+            lines = f.readlines()[2:2 + gro.natoms]
+        for i, line in enumerate(lines):
+            resnum, resname, atomname, *coords = unpacker.unpack(line)
+            self.assertEqual(resnum, gro.resnums[i])
+            self.assertEqual(atomname, gro.atomnames[i])
+            np.testing.assert_array_equal(np.array(coords, dtype=np.float32), gro.coords[i])
+
+        self.assertEqual(["ALLA"], gro.resnames.tolist())
+        np.testing.assert_array_equal([0], gro.residue_starts)
+
+    def test_gro_read_residues(self):
+        gro = GRO("test/data/water.gro")
+        self.assertEqual(gro.natoms // 3, len(gro))
+        self.assertTrue(all(name == "SOL" for name in gro.resnames))
+        np.testing.assert_array_equal(np.arange(0, gro.natoms, 3), gro.residue_starts)
+
+    def test_gro_read_ragged(self):
+        filename = self.write_gro(["Ragged", "    3",
+                                   "    1SOL     OW    1   0.126   1.624   1.679",
+                                   "    1SOL    HW1    2   0.190   1.661   1.747   0.1000  0.2000  0.3000",
+                                   "    2SOL     OW    3   1.000   2.000   3.000",
+                                   "   1.86206   1.86206   1.86206"])
+        gro = GRO(filename)
+        self.assertEqual(2, len(gro))
+        self.assertEqual(["OW", "HW1", "OW"], gro.atomnames.tolist())
+        np.testing.assert_allclose([1., 2., 3.], gro.coords[2])
+        np.testing.assert_allclose([1.86206, 1.86206, 1.86206], gro.box)
+
+    def test_gro_read_wrapped(self):
+        filename = self.write_gro(["Wrapped", "    4",
+                                   "99999SOL     OW99999   0.000   0.000   0.000",
+                                   "99999SOL    HW1    0   0.000   0.000   0.000",
+                                   "    0SOL     OW    1   0.000   0.000   0.000",
+                                   "    1SOL     OW    2   0.000   0.000   0.000",
+                                   "   1.00000   1.00000   1.00000"])
+        gro = GRO(filename)
+        self.assertEqual(3, len(gro))
+        np.testing.assert_array_equal([0, 2, 3], gro.residue_starts)
+        np.testing.assert_array_equal([99999, 0, 1], gro.resnums[gro.residue_starts])
+
+    def test_gro_read_precision(self):
+        filename = self.write_gro(["Precise", "    1",
+                                   "    1SOL     OW    1   0.12345   1.23456  12.34567",
+                                   "   1.00000   1.00000   1.00000"])
+        gro = GRO(filename)
+        np.testing.assert_allclose([[0.12345, 1.23456, 12.34567]], gro.coords)
+
+    def test_gro_read_truncated(self):
+        filename = self.write_gro(["Truncated", "    3",
+                                   "    1SOL     OW    1   0.126   1.624   1.679"])
+        with self.assertRaises(ValueError):
+            GRO(filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
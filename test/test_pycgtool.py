@@ -1,4 +1,5 @@
 import unittest
+import unittest.mock
 import subprocess
 import os
 import logging
@@ -14,8 +15,12 @@ except ImportError:
     mdtraj_present = False
 
 from pycgtool.interface import Options
-from pycgtool.util import cmp_whitespace_float
-from pycgtool.pycgtool import main, map_only
+from pycgtool.util import cmp_whitespace_float, vector_angle, vector_angle_signed, dist_with_pbc
+from pycgtool.pycgtool import main, map_only, warmup
+from pycgtool.kernels import lazy_kernels
+from pycgtool.frame import Frame
+
+from .helpers import remove_frame_offsets
 
 
 class Args:
@@ -27,6 +32,13 @@ class Args:
         self.begin = 0
         self.end = -1
         self.quiet = True
+        self.prefetch = 0
+        self.cache = None
+        self.jit_background = False
+        self.backend = "auto"
+        self.stride = 1
+        self.begin_time = None
+        self.end_time = None
 
 
 class PycgtoolTest(unittest.TestCase):
@@ -48,11 +60,24 @@ class PycgtoolTest(unittest.TestCase):
         path = os.path.dirname(os.path.dirname(__file__))
         self.assertEqual(0, subprocess.check_call([os.path.join(path, "pycgtool.py"), "-h"], stdout=subprocess.PIPE))
 
+    def test_run_warmup(self):
+        path = os.path.dirname(os.path.dirname(__file__))
+        self.assertEqual(0, subprocess.check_call([os.path.join(path, "pycgtool.py"), "warmup"], stdout=subprocess.PIPE))
+
+    def test_warmup_kernels(self):
+        with unittest.mock.patch("pycgtool.pycgtool.compile_kernels", side_effect=list):
+            kernels = warmup()
+        self.assertCountEqual(lazy_kernels("numba") + lazy_kernels("numba-parallel"), kernels)
+        for func in (vector_angle, vector_angle_signed, dist_with_pbc):
+            self.assertNotIn(func, kernels)
+
     @unittest.skipIf(not mdtraj_present, "MDTRAJ or Scipy not present")
     def test_map_only(self):
         logging.disable(logging.WARNING)
-        map_only(Args("sugar"), self.config)
+        with unittest.mock.patch.object(Frame, "close", autospec=True, side_effect=Frame.close) as close:
+            map_only(Args("sugar"), self.config)
         logging.disable(logging.NOTSET)
+        close.assert_called_once()
 
         xtc = XtcTrajectory("out.xtc")
         xtc_ref = XtcTrajectory("test/data/sugar_out.xtc")
@@ -74,8 +99,23 @@ class PycgtoolTest(unittest.TestCase):
                                                    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE))
         self.assertTrue(cmp_whitespace_float("out.itp", "test/data/sugar_out.itp", float_rel_error=0.001))
         self.assertTrue(cmp_whitespace_float("out.gro", "test/data/sugar_out.gro", float_rel_error=0.001))
+
+    def test_full_multiple_xtc(self):
+        # Measurements from a repeated trajectory have the same distribution as those from a single copy
+        path = os.path.dirname(os.path.dirname(__file__))
+        self.assertEqual(0, subprocess.check_call([os.path.join(path, "pycgtool.py"),
+                                                   "-g", "test/data/sugar.gro",
+                                                   "-x", "test/data/sugar.xtc", "test/data/sugar.xtc",
+                                                   "-m", "test/data/sugar_only.map",
+                                                   "-b", "test/data/sugar.bnd",
+                                                   ], stdout=subprocess.PIPE, stderr=subprocess.PIPE))
+        self.assertTrue(cmp_whitespace_float("out.itp", "test/data/sugar_out.itp", float_rel_error=0.001))
     # TODO more tests
 
 
+def tearDownModule():
+    remove_frame_offsets()
+
+
 if __name__ == '__main__':
     unittest.main()
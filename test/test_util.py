@@ -1,4 +1,5 @@
 import unittest
+import unittest.mock
 import os
 import logging
 
@@ -7,10 +8,19 @@ import numpy.testing
 
 from pycgtool.util import tuple_equivalent, extend_graph_chain, stat_moments, transpose_and_sample
 from pycgtool.util import dir_up, backup_file, sliding, r_squared, dist_with_pbc
-from pycgtool.util import SimpleEnum, FixedFormatUnpacker
+from pycgtool.util import SimpleEnum, FixedFormatUnpacker, RunningMoments, GrowableArray
+from pycgtool.util import LazyJit, lazy_jit, compile_kernels, vector_angle, Timer
+from pycgtool.util import dist_with_pbc_many, vector_angle_many, vector_angle_signed, vector_angle_signed_many
 
 
 class UtilTest(unittest.TestCase):
+    def setUp(self):
+        # Functions decorated by tests must not be compiled by later calls to compile_kernels
+        self._lazy_jit_instances = list(LazyJit.instances)
+
+    def tearDown(self):
+        LazyJit.instances[:] = self._lazy_jit_instances
+
     def test_tuple_equivalent(self):
         t1 = (0, 1, 2)
         t2 = (0, 1, 2)
@@ -30,6 +40,33 @@ class UtilTest(unittest.TestCase):
         numpy.testing.assert_equal(np.array([-2., -2., -2.]),
                                    dist_with_pbc(pos_a, pos_b, np.array([10., 10., 10.])))
 
+    def test_dist_with_pbc_many(self):
+        pos_a = np.array([[1., 1., 1.], [1., 1., 1.]])
+        pos_b = np.array([[9., 9., 9.], [2., 2., 2.]])
+        numpy.testing.assert_equal(np.array([[-2., -2., -2.], [1., 1., 1.]]),
+                                   dist_with_pbc_many(pos_a, pos_b, np.array([10., 10., 10.])))
+        numpy.testing.assert_equal(np.array([[8., 8., 8.], [1., 1., 1.]]),
+                                   dist_with_pbc_many(pos_a, pos_b, np.array([0., 0., 0.])))
+
+        # One box per frame, the second without periodicity
+        boxes = np.array([[[10., 10., 10.]], [[0., 0., 0.]]])
+        numpy.testing.assert_equal(np.array([[[-2., -2., -2.], [1., 1., 1.]], [[8., 8., 8.], [1., 1., 1.]]]),
+                                   dist_with_pbc_many(np.stack([pos_a, pos_a]), np.stack([pos_b, pos_b]), boxes))
+
+    def test_vector_angle_many(self):
+        rng = np.random.RandomState(0)
+        a = rng.uniform(-1, 1, (10, 3)).astype(np.float32)
+        b = rng.uniform(-1, 1, (10, 3)).astype(np.float32)
+        numpy.testing.assert_allclose([vector_angle(u, v) for u, v in zip(a, b)],
+                                      vector_angle_many(a, b), rtol=1e-5)
+        numpy.testing.assert_allclose([vector_angle_signed(u, v) for u, v in zip(a, b)],
+                                      vector_angle_signed_many(a, b), rtol=1e-5)
+
+        a[3] = 0
+        with self.assertRaises(ZeroDivisionError) as cm:
+            vector_angle_many(a, b)
+        self.assertEqual(3, cm.exception.args[1])
+
     def test_triplets_from_pairs(self):
         pairs = [(0, 1), (1, 2), (2, 3)]
         result = [(0, 1, 2), (1, 2, 3)]
@@ -59,6 +96,44 @@ class UtilTest(unittest.TestCase):
         np.testing.assert_allclose(np.array([3, 0]), stat_moments(t1))
         np.testing.assert_allclose(np.array([3, 2]), stat_moments(t2))
 
+    def test_growable_array(self):
+        arr = GrowableArray(capacity=2)
+        self.assertEqual(0, len(arr))
+        arr.append(1.)
+        arr.extend(np.array([2., 3., 4.]))
+        arr.extend([])
+        arr.append(5.)
+        self.assertEqual(5, len(arr))
+        self.assertEqual(3., arr[2])
+        np.testing.assert_array_equal([1., 2., 3., 4., 5.], np.array(arr))
+        self.assertEqual([1., 2., 3., 4., 5.], list(arr))
+
+        arr = GrowableArray(dtype=np.float32)
+        arr.extend(np.array([0.5, 1.5]))
+        self.assertEqual(np.float32, arr.array.dtype)
+
+    def test_running_moments(self):
+        vals = np.array([1, 2, 3, 4, 5, np.nan, 7, 8])
+        moments = RunningMoments()
+        moments.update(vals[:3])
+        moments.update([])
+        moments.update(vals[3:])
+        self.assertEqual(7, moments.count)
+        self.assertAlmostEqual(np.nanmean(vals), moments.mean)
+        self.assertAlmostEqual(np.nanvar(vals), moments.var)
+
+    def test_running_moments_periodic(self):
+        moments = RunningMoments(periodic=True)
+        moments.update([3.1, -3.1])
+        moments.update([3.0, -3.0])
+        self.assertAlmostEqual(np.pi, abs(moments.mean))
+        expected = np.var([np.pi - 3.1, 3.1 - np.pi, np.pi - 3.0, 3.0 - np.pi])
+        self.assertAlmostEqual(expected, moments.var)
+
+        moments = RunningMoments(periodic=True)
+        moments.update([0.1, 0.2, 0.3])
+        self.assertAlmostEqual(0.2, moments.mean)
+
     def test_dir_up(self):
         path = os.path.realpath(__file__)
         self.assertEqual(path, dir_up(path, 0))
@@ -198,6 +273,112 @@ class UtilTest(unittest.TestCase):
         self.assertEqual("hello", toks[2])
         self.assertAlmostEqual(12.3, toks[3])
 
+    def test_fixed_format_unpacker_many(self):
+        unpacker = FixedFormatUnpacker("I4,X3,A5,X2,F4.1",
+                                       FixedFormatUnpacker.FormatStyle.Fortran)
+        lines = ["1234 x hello x12.3", "  56 x  bye  x 4.5\n"]
+        nums, names, vals = unpacker.unpack_many(lines)
+        numpy.testing.assert_equal([1234, 56], nums)
+        self.assertEqual(["hello", "bye"], names.tolist())
+        numpy.testing.assert_allclose([12.3, 4.5], vals)
+
+        for i, line in enumerate(lines):
+            self.assertEqual(unpacker.unpack(line), [nums[i], names[i], vals[i]])
+
+        nums, names, vals = unpacker.unpack_many(line.encode() for line in lines)
+        self.assertEqual(["hello", "bye"], names.tolist())
+
+    def test_fixed_format_unpacker_skip_only(self):
+        unpacker = FixedFormatUnpacker("X4", FixedFormatUnpacker.FormatStyle.Fortran)
+        self.assertEqual([], unpacker.unpack("abcd"))
+        self.assertEqual([], unpacker.unpack_many(["abcd", "efgh"]))
+
+    def test_lazy_jit(self):
+        @lazy_jit("float64(float64, float64)")
+        def add(a, b):
+            return a + b
+
+        self.assertIsInstance(add, LazyJit)
+        self.assertEqual("add", add.__name__)
+        self.assertIsNone(add._compiled)
+        self.assertEqual(3, add(1, 2))
+        self.assertIsNotNone(add._compiled)
+
+    def test_lazy_jit_fallback(self):
+        @lazy_jit
+        def unsupported(a):
+            # Dictionary of mixed types cannot be compiled by numba
+            return {"a": a, 1: "b"}["a"]
+
+        logging.disable(logging.WARNING)
+        self.assertEqual(5, unsupported(5))
+        logging.disable(logging.NOTSET)
+        self.assertIs(unsupported.py_func, unsupported.compiled)
+
+    def test_lazy_jit_signature_mismatch(self):
+        @lazy_jit("float64(float64[:])")
+        def first(a):
+            if a[0] < 0:
+                raise TypeError("negative")
+            return a[0]
+
+        with self.assertLogs("pycgtool.util", logging.WARNING) as logs:
+            self.assertEqual(1, first([1.]))
+            self.assertEqual(2, first([2.]))
+        self.assertEqual(1, len(logs.output))
+
+        # Errors raised by the function itself are not hidden by running it again in Python
+        first.py_func = unittest.mock.Mock(wraps=first.py_func)
+        with self.assertRaises(TypeError):
+            first(np.array([-1.]))
+        first.py_func.assert_not_called()
+
+    def test_compile_kernels_background(self):
+        @lazy_jit("float64(float64)")
+        def double(a):
+            return 2 * a
+
+        @lazy_jit("float64(float64)", parallel=True)
+        def triple(a):
+            return 3 * a
+
+        thread = compile_kernels([double, triple], background=True)
+        self.assertEqual(4, double(2))  # Waits for compilation if necessary
+        thread.join()
+        self.assertIsNotNone(double._compiled)
+        self.assertIsNone(triple._compiled)
+
+    def test_compile_kernels_selected(self):
+        @lazy_jit("float64(float64)")
+        def double(a):
+            return 2 * a
+
+        @lazy_jit("float64(float64)")
+        def triple(a):
+            return 3 * a
+
+        compile_kernels([double])
+        self.assertIsNotNone(double._compiled)
+        self.assertIsNone(triple._compiled)
+
+    def test_lazy_jit_instances_restored(self):
+        self.assertNotIn("double", [kernel.__name__ for kernel in LazyJit.instances])
+
+    def test_lazy_jit_float64(self):
+        a = np.array([1., 0., 0.])
+        b = np.array([0., 1., 0.])
+        self.assertAlmostEqual(np.pi / 2, vector_angle(a, b))
+
+    def test_timer(self):
+        timer = Timer()
+        self.assertGreaterEqual(timer.lap("First"), 0)
+        timer.lap("Second")
+        self.assertEqual(["First", "Second"], [name for name, _ in timer.stages])
+        report = timer.report().splitlines()
+        self.assertEqual(3, len(report))
+        self.assertTrue(report[0].startswith("First"))
+        self.assertTrue(report[2].startswith("Total"))
+
 
 if __name__ == '__main__':
     unittest.main()